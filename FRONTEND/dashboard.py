@@ -1,7 +1,5 @@
-import requests
-from flask import Flask, render_template, jsonify
+from flask import Flask, render_template, jsonify, request
 import paho.mqtt.client as mqtt
-import json
 import threading
 from influxdb_client_3 import InfluxDBClient3
 import sys
@@ -11,31 +9,29 @@ import os
 import os, sys
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'MQTT')))
 from mqtt_client import Client
+from metrics import REGISTRY, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from service_log import get_logger, hot, WARNING
+
+log = get_logger('dashboard')
+log_alert = hot(log, 'alert', per_second=5)
+log_bad_message = hot(log, 'bad_message', WARNING, per_second=1)
 
 
 class Dashboard(Client):
     def __init__(self, catalog_url):
         super().__init__(catalog_url, type='dashboard')
         self.app = Flask(__name__)
-        self.port = requests.get(f"{catalog_url}/dashboard_port").json().get("dashboard_port", 8081)
+        self.port = 8081
         self.http_port = 0
         self.influx_host = ''
         self.influx_token = ''
         self.influx_db = ''
         self.catalog=catalog_url
-        self.get_db_info()
-
-        self.influx_conf = {"host": self.influx_host, "token": self.influx_token, "db": self.influx_db}
+        self.influxclient = None   # creato in setup(), con i dati di InfluxDB dal bootstrap
 
-        self.influxclient = InfluxDBClient3(
-            host=self.influx_conf["host"], 
-            token=self.influx_conf["token"], 
-            database=self.influx_conf["db"]
-        )
-
-        self.client.on_message = self.message
-        
         self.alerts = [] # Internal storage for alerts
+        self._poles = []        # last map list built from the catalog
+        self._poles_etag = None # catalog ETag of /gateways it was built from
 
         #routes for the frontend
         self.app.add_url_rule('/', 'index', self.serve_index)
@@ -44,16 +40,30 @@ class Dashboard(Client):
         # Add a route so the Frontend can "pull" the new alerts
         self.app.add_url_rule('/api/alerts', 'get_alerts', self.get_alerts)
         self.app.add_url_rule('/api/poles', 'get_poles', self.get_poles_for_map)
+        self.app.add_url_rule('/metrics', 'metrics', self.get_metrics)
+
+    def setup(self):
+        self.port = self.bootstrap_data.get("dashboard_port", 8081)
+        self.get_db_info()
+
+        self.influx_conf = {"host": self.influx_host, "token": self.influx_token, "db": self.influx_db}
+
+        self.influxclient = InfluxDBClient3(
+            host=self.influx_conf["host"], 
+            token=self.influx_conf["token"], 
+            database=self.influx_conf["db"]
+        )
     
     def get_db_info(self):
         try:
-            self.http_port = requests.get(f"{self.catalog_url}/writer_port").json().get("writer_port", 8090)
+            self.http_port = self.bootstrap_data.get("writer_port", 8090)
             print(f"[*] InfluxDB HTTP Port: {self.http_port}")
-            self.influx_host = requests.get(f"{self.catalog_url}/db_info").json().get("influx_host", "http://localhost:8181")
+            db_info = self.bootstrap_data.get("db_info", {})
+            self.influx_host = db_info.get("influx_host", "http://localhost:8181")
             print(f"[*] InfluxDB Host: {self.influx_host}")
-            self.influx_token = requests.get(f"{self.catalog_url}/db_info").json().get("token", "")
+            self.influx_token = db_info.get("token", "")
             print(f"[*] InfluxDB Token: {self.influx_token}")
-            self.influx_db = requests.get(f"{self.catalog_url}/db_info").json().get("db", "pole_measurements")
+            self.influx_db = db_info.get("db", "pole_measurements")
             print(f"[*] InfluxDB Database: {self.influx_db}")
         except Exception as e:
             print('Impossible GET db info, error: ', e)
@@ -72,12 +82,12 @@ class Dashboard(Client):
 
     def message(self, client, userdata, msg):
         try:
-            data = json.loads(msg.payload.decode("utf-8"))
+            data = self.decode(msg)
             # We assume data has {'pole_id': 'P01', 'alert': 'Tilt...'}
             self.alerts.append(data) 
-            print(f"Alert received: {data}")
+            log_alert('Alert received: %s', data)
         except Exception as e:
-            print(f"Error on message: {e}")
+            log_bad_message('Error on message: %s', e)
 
     def get_pole_history(self, pole_id):
         # SQL-like query for InfluxDB 3.0
@@ -99,31 +109,48 @@ class Dashboard(Client):
         self.alerts = [] 
         return jsonify(temp_alerts)
 
+    def get_metrics(self):
+        return REGISTRY.render(), 200, {'Content-Type': METRICS_CONTENT_TYPE}
+
     def get_poles_for_map(self):
         try:
-            # Request data from your Catalog
-            response = requests.get(f"{self.catalog}/gateways")
-            gateways = response.json()
-            
-            final_poles = []
-            
-            # We need to dive into each gateway to find the smart_poles list
-            for gw in gateways:
-                gw_id = gw.get("gateway_id")
-                for p in gw.get("smart_poles", []):
-                    # We map the Catalog fields to what the Javascript expects
+            # Only the fields the map needs, page by page, and only poles that are
+            # still alive. The first page is a conditional request: the catalog
+            # answers 304 if no pole changed
+            params = {"fields": "id,lat,long,region,gateway_id", "online": "true", "limit": 5000}
+            headers = {"If-None-Match": self._poles_etag} if self._poles_etag else {}
+            response = self.http.get('smart_poles', params=params, headers=headers)
+
+            if response.status_code != 304:
+                etag = response.headers.get("ETag")
+                final_poles = []
+                while True:
+                    page = response.json()
+                    for p in page["items"]:
+                        # We map the Catalog fields to what the Javascript expects
                         final_poles.append({
                             "id": p.get("id"),
                             "lat": p.get("lat"),
                             "lon": p.get("long"),  # Leaflet usually wants 'lon'
                             "region": p.get("region"),
-                            "gateway": gw_id,
+                            "gateway": p.get("gateway_id"),
                             "temperature": "N/A",  # Placeholder until Influx is back
                             "humidity": "N/A"
                         })
-            
-            print(f"[*] Found {len(final_poles)} poles in Catalog")
-            return jsonify(final_poles)
+                    if not page.get("next_cursor"):
+                        break
+                    params["cursor"] = page["next_cursor"]
+                    response = self.http.get('smart_poles', params=params)
+
+                self._poles = final_poles
+                self._poles_etag = etag
+                print(f"[*] Found {len(final_poles)} poles in Catalog")
+
+            # The browser revalidates with the same ETag, so unchanged maps cost a 304
+            resp = jsonify(self._poles)
+            if self._poles_etag:
+                resp.set_etag(self._poles_etag.strip('"'))
+            return resp.make_conditional(request)
         except Exception as e:
             print(f"[!] Catalog Error: {e}")
             return jsonify([])
@@ -6,7 +6,8 @@ let alarmedPoles = new Set();
 let poleDataCache = {}; // Stores the latest info for each pole
 
 async function loadPoles() {
-  const response = await fetch('/api/poles');
+  // no-cache: always revalidate with the ETag, an unchanged catalog costs a 304
+  const response = await fetch('/api/poles', { cache: 'no-cache' });
   const poles = await response.json();
   
   const totalEl = document.getElementById('totalPoles');
@@ -1,19 +1,438 @@
 import cherrypy
+from cherrypy.lib import cptools
 import json
 import time
-import os
+import sys
+import threading
+import base64
+import copy
+import gzip
+import bisect
+import heapq
+from collections import deque, OrderedDict
+import paho.mqtt.client as mqtt
+from regions import ITALIAN_REGIONS, RegionIndex
+from catalog_storage import open_storage
+from metrics import REGISTRY, CONTENT_TYPE as METRICS_CONTENT_TYPE
+
+class CowMap:
+    """
+    Dizionario a bucket per gli indici dello snapshot. copy() copia solo
+    l'elenco dei bucket; un bucket viene copiato alla prima scrittura dopo la
+    copia. Un commit costa quindi O(bucket toccati) invece di O(flotta).
+    Quando i bucket si riempiono (in media BUCKET_SIZE chiavi) il loro numero
+    raddoppia: copia completa, ma ammortizzata su tutte le scritture.
+    """
+    __slots__ = ('_buckets', '_owned', '_len')
+    BUCKET_SIZE = 64
+
+    def __init__(self, items=()):
+        self._buckets = [{} for _ in range(8)]
+        self._owned = set(range(8))
+        self._len = 0
+        for key, value in (items.items() if isinstance(items, dict) else items):
+            self[key] = value
+
+    def _bucket(self, key):
+        return self._buckets[hash(key) & (len(self._buckets) - 1)]
+
+    def _own(self, key):
+        i = hash(key) & (len(self._buckets) - 1)
+        if i not in self._owned:
+            self._buckets[i] = dict(self._buckets[i])
+            self._owned.add(i)
+        return self._buckets[i]
+
+    def copy(self):
+        other = object.__new__(CowMap)
+        other._buckets = list(self._buckets)
+        other._owned = set()
+        other._len = self._len
+        self._owned = set()   # i bucket ora sono condivisi: anche l'originale copia prima di scrivere
+        return other
+
+    def get(self, key, default=None):
+        return self._bucket(key).get(key, default)
+
+    def __getitem__(self, key):
+        return self._bucket(key)[key]
+
+    def __contains__(self, key):
+        return key in self._bucket(key)
+
+    def __setitem__(self, key, value):
+        bucket = self._own(key)
+        if key not in bucket:
+            self._len += 1
+        bucket[key] = value
+        if self._len > self.BUCKET_SIZE * len(self._buckets):
+            self._grow()
+
+    def __delitem__(self, key):
+        del self._own(key)[key]
+        self._len -= 1
+
+    def pop(self, key, *default):
+        if key not in self:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        self._len -= 1
+        return self._own(key).pop(key)
+
+    def _grow(self):
+        buckets = [{} for _ in range(len(self._buckets) * 2)]
+        mask = len(buckets) - 1
+        for bucket in self._buckets:
+            for key, value in bucket.items():
+                buckets[hash(key) & mask][key] = value
+        self._buckets = buckets
+        self._owned = set(range(len(buckets)))
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for bucket in self._buckets:
+            yield from bucket
+
+    def keys(self):
+        return iter(self)
+
+    def values(self):
+        for bucket in self._buckets:
+            yield from bucket.values()
+
+    def items(self):
+        for bucket in self._buckets:
+            yield from bucket.items()
+
+
+class CatalogSnapshot:
+    """
+    Vista immutabile del catalog: dati, indici e versioni coerenti tra loro.
+    I lettori lavorano sempre su uno snapshot intero; un commit ne clona uno,
+    copia solo i contenitori che modifica (copy-on-write) e lo pubblica con
+    un singolo assegnamento. Nessuno modifica uno snapshot gia' pubblicato.
+    """
+    def __init__(self, data, epoch):
+        self.data = data
+        self.epoch = epoch
+        # versione globale monotona + versione dell'ultima modifica per sezione
+        self.version = 0
+        self.section_versions = {}
+        # indici in memoria: ogni lookup e' O(1) invece di scorrere le liste;
+        # CowMap: un commit copia solo i bucket che tocca, non l'intero indice
+        self.gateways = CowMap()          # gateway_id -> gateway
+        self.gateway_slots = CowMap()     # gateway_id -> posizione in data["gateways"]
+        self.zones = CowMap()             # zone -> gateway_id
+        self.poles = CowMap()             # pole_id -> (gateway_id, pole)
+        self.pole_slots = CowMap()        # pole_id -> posizione in gateway["smart_poles"]
+        self.gateway_versions = CowMap()  # gateway_id -> versione dell'ultima modifica (pali inclusi)
+        self.pole_versions = CowMap()     # pole_id -> versione in cui e' stato registrato
+        # cache calcolate dai lettori, condivise finche' la sezione non cambia
+        self._sorted_ids = {}       # "poles"/"gateways" -> id ordinati
+        self._region_index = None
+        self._copied = None         # solo durante un commit: contenitori gia' copiati
+
+        for j, gw in enumerate(data.setdefault("gateways", [])):
+            gw.setdefault("smart_poles", [])
+            self.gateways[gw.get("gateway_id")] = gw
+            self.gateway_slots[gw.get("gateway_id")] = j
+            if gw.get("zone") is not None:
+                self.zones[gw["zone"]] = gw.get("gateway_id")
+            for k, pole in enumerate(gw["smart_poles"]):
+                self.poles[pole.get("id")] = (gw.get("gateway_id"), pole)
+                self.pole_slots[pole.get("id")] = k
+
+    # --- letture ---
+    def find_gateway(self, gateway_id):
+        return self.gateways.get(gateway_id)
+
+    def find_pole(self, pole_id):
+        entry = self.poles.get(pole_id)
+        if entry is None:
+            return None, None
+        return self.gateways[entry[0]], entry[1]
+
+    def gateway_in_zone(self, zone):
+        return self.gateways.get(self.zones.get(zone))
+
+    def etag(self, section=None):
+        version = self.version if section is None else self.section_versions.get(section, 0)
+        return f'"{self.epoch}-{version}"'
+
+    def pole_active(self, pole_id):
+        # attivo = registrato: solo la cancellazione dal catalog lo disattiva (il gateway
+        # manda allora "deactivate"); la liveness non c'entra, vedi pole_online
+        return pole_id in self.poles
+
+    def pole_online(self, pole_id):
+        # stato di liveness: False se il palo (o il suo gateway) e' scaduto, None se non registrato
+        _, pole = self.find_pole(pole_id)
+        return None if pole is None else pole.get("online") is not False
+
+    def region_index(self):
+        if self._region_index is None:
+            self._region_index = RegionIndex(self.data.get("regions", {}))
+        return self._region_index
+
+    # --- listing paginato (cursore = ultimo id restituito, ordine per id) ---
+    def _sorted(self, name, keys):
+        ids = self._sorted_ids.get(name)
+        if ids is None:
+            ids = self._sorted_ids[name] = sorted(keys, key=str)
+        return ids
+
+    def _page(self, ids, lookup, match, after, limit):
+        start = bisect.bisect_right(ids, str(after), key=str) if after is not None else 0
+        items = []
+        last = None
+        for i in range(start, len(ids)):
+            item = lookup(ids[i])
+            if item is None or not match(ids[i], item):
+                continue
+            if limit is not None and len(items) == limit:
+                return items, last  # c'e' almeno un altro elemento: serve un cursore
+            items.append(item)
+            last = ids[i]
+        return items, None
+
+    def list_poles(self, gateway_id=None, zone=None, bbox=None, updated_since=None, online=None, after=None,
+                   limit=None):
+        # gateway/zona passano dagli indici: si scorrono solo i pali di quel gateway
+        if gateway_id is not None or zone is not None:
+            gw = self.find_gateway(gateway_id) if gateway_id is not None else self.gateway_in_zone(zone)
+            if gw is None or (zone is not None and gw.get("zone") != zone):
+                return [], None
+            ids = sorted((p.get("id") for p in gw.get("smart_poles", [])), key=str)
+        else:
+            ids = self._sorted("poles", self.poles)
+
+        def match(pole_id, pole):
+            if updated_since is not None and self.pole_versions.get(pole_id, 0) <= updated_since:
+                return False
+            if online is not None and (pole.get("online") is not False) != online:
+                return False
+            if bbox is not None:
+                try:
+                    lat, lon = float(pole.get("lat")), float(pole.get("long"))
+                except (TypeError, ValueError):
+                    return False
+                return bbox[0] <= lat <= bbox[2] and bbox[1] <= lon <= bbox[3]
+            return True
+
+        return self._page(ids, lambda pid: self.find_pole(pid)[1], match, after, limit)
+
+    def list_gateways(self, zone=None, updated_since=None, online=None, after=None, limit=None):
+        if zone is not None:
+            ids = [self.zones[zone]] if zone in self.zones else []
+        else:
+            ids = self._sorted("gateways", self.gateways)
+
+        def match(gateway_id, gw):
+            if online is not None and (gw.get("online") is not False) != online:
+                return False
+            return updated_since is None or self.gateway_versions.get(gateway_id, 0) > updated_since
+
+        return self._page(ids, self.gateways.get, match, after, limit)
+
+    # --- commit copy-on-write ---
+    def clone(self):
+        work = object.__new__(CatalogSnapshot)
+        work.__dict__.update(self.__dict__)
+        work._copied = set()
+        return work
+
+    def _own(self, name):
+        # il contenitore viene copiato alla prima modifica nel commit, poi riusato
+        if name not in self._copied:
+            setattr(self, name, getattr(self, name).copy())
+            self._copied.add(name)
+        return getattr(self, name)
+
+    def _own_gateway_list(self):
+        data = self._own("data")
+        if "gateway_list" not in self._copied:
+            data["gateways"] = list(data["gateways"])
+            self._copied.add("gateway_list")
+        return data["gateways"]
+
+    def _own_gateway(self, gateway_id):
+        # copia del gateway (e della sua lista pali) una volta per commit
+        key = ("gateway", gateway_id)
+        gw = self.gateways[gateway_id]
+        if key not in self._copied:
+            gw = dict(gw)
+            gw["smart_poles"] = list(gw.get("smart_poles", []))
+            self._own("gateways")[gateway_id] = gw
+            self._own_gateway_list()[self.gateway_slots[gateway_id]] = gw
+            self._copied.add(key)
+        return gw
+
+    def apply(self, op):
+        args = dict(op)
+        kind = args.pop("op")
+        getattr(self, f"_op_{kind}")(**args)
+
+    def publish(self, sections):
+        # chiude il commit: nuova versione, cache invalidate solo per le sezioni toccate
+        self.version += 1
+        self._own("section_versions")
+        for section in sections:
+            self.section_versions[section] = self.version
+        if "gateways" in sections:
+            self._sorted_ids = {}
+        if "regions" in sections:
+            self._region_index = None
+        self._copied = None
+
+    def _op_upsert_gateway(self, gateway, ts):
+        gateway_id = gateway["gateway_id"]
+        # la versione del commit in corso e' self.version + 1
+        self._own("gateway_versions")[gateway_id] = self.version + 1
+
+        if gateway_id not in self.gateways:
+            gw = dict(gateway)
+            gw["smart_poles"] = list(gw.get("smart_poles", []))
+            gw["last_update"] = ts
+            gateways = self._own_gateway_list()
+            self._own("gateway_slots")[gateway_id] = len(gateways)
+            gateways.append(gw)
+            self._own("gateways")[gateway_id] = gw
+            self._copied.add(("gateway", gateway_id))
+            if gw.get("zone") is not None:
+                self._own("zones")[gw["zone"]] = gateway_id
+            for k, pole in enumerate(gw["smart_poles"]):
+                self._own("poles")[pole.get("id")] = (gateway_id, pole)
+                self._own("pole_slots")[pole.get("id")] = k
+            return
+
+        # aggiorna SOLO i campi gateway, non la lista pali
+        gw = self._own_gateway(gateway_id)
+        incoming = dict(gateway)
+        incoming.pop("smart_poles", None)
+        old_zone = gw.get("zone")
+        gw.update(incoming)
+        gw["last_update"] = ts
+        if gw.get("zone") != old_zone:
+            zones = self._own("zones")
+            if zones.get(old_zone) == gateway_id:
+                del zones[old_zone]
+            if gw.get("zone") is not None:
+                zones[gw["zone"]] = gateway_id
+
+    def _op_add_pole(self, gateway_id, pole):
+        self._op_remove_pole(pole["id"])  # idempotente in caso di replay
+        gw = self._own_gateway(gateway_id)
+        poles = gw["smart_poles"]
+        self._own("poles")[pole["id"]] = (gateway_id, pole)
+        self._own("pole_slots")[pole["id"]] = len(poles)
+        poles.append(pole)
+        self._own("pole_versions")[pole["id"]] = self.version + 1
+        self._own("gateway_versions")[gateway_id] = self.version + 1
+
+    def _op_remove_pole(self, pole_id):
+        if pole_id not in self.poles:
+            return
+        gateway_id, pole = self._own("poles").pop(pole_id)
+        j = self._own("pole_slots").pop(pole_id)
+        self._own("pole_versions").pop(pole_id, None)
+        self._own("gateway_versions")[gateway_id] = self.version + 1
+        poles = self._own_gateway(gateway_id)["smart_poles"]
+        # swap con l'ultimo elemento e pop: O(1), l'ordine dei pali non conta
+        last = poles.pop()
+        if last is not pole:
+            poles[j] = last
+            self.pole_slots[last.get("id")] = j
+
+    def _op_liveness(self, online, gateway_id=None, pole_id=None):
+        # stato di liveness deciso dal LivenessTracker: online False = scaduto
+        if pole_id is not None:
+            if pole_id not in self.poles:
+                return
+            gateway_id, pole = self.poles[pole_id]
+            pole = dict(pole, online=online)
+            self._own_gateway(gateway_id)["smart_poles"][self.pole_slots[pole_id]] = pole
+            self._own("poles")[pole_id] = (gateway_id, pole)
+            self._own("pole_versions")[pole_id] = self.version + 1
+        else:
+            if gateway_id not in self.gateways:
+                return
+            self._own_gateway(gateway_id)["online"] = online
+        self._own("gateway_versions")[gateway_id] = self.version + 1
+
+    def _op_set(self, path, value):
+        # copia dei soli dizionari lungo il percorso
+        node = self._own("data")
+        for key in path[:-1]:
+            child = dict(node[key]) if isinstance(node.get(key), dict) else {}
+            node[key] = child
+            node = child
+        node[path[-1]] = value
+
+    def event_for(self, op):
+        # delta tipizzato per il change feed (calcolato prima di applicare l'op)
+        kind = op["op"]
+        if kind == "add_pole":
+            return {"type": "pole_added", "gateway_id": op["gateway_id"], "pole": op["pole"]}
+        if kind == "remove_pole":
+            entry = self.poles.get(op["pole_id"])
+            if entry is None:
+                return None
+            return {"type": "pole_removed", "gateway_id": entry[0], "pole_id": op["pole_id"]}
+        if kind == "upsert_gateway":
+            gateway = {k: v for k, v in op["gateway"].items() if k != "smart_poles"}
+            return {"type": "gateway_updated", "gateway": gateway}
+        if kind == "liveness":
+            state = "online" if op["online"] else "offline"
+            if op.get("pole_id") is not None:
+                entry = self.poles.get(op["pole_id"])
+                if entry is None:
+                    return None
+                return {"type": f"pole_{state}", "gateway_id": entry[0], "pole_id": op["pole_id"]}
+            return {"type": f"gateway_{state}", "gateway_id": op["gateway_id"]}
+        path = op["path"]
+        if path[0] == "threshold":
+            return {"type": "threshold_changed", "threshold": op["value"]}
+        if path[0] == "topic" and len(path) == 2:
+            return {"type": "topics_changed", "service": path[1], "topics": op["value"]}
+        return {"type": "value_changed", "path": path, "value": op["value"]}
+
 
 class SmartCityCatalog:
-    def __init__(self, filename='catalog.json'):
+    """
+    Persistenza delegata a uno storage (catalog_storage): ogni commit viene
+    registrato con storage.append(); uno thread in background chiama save()
+    ogni snapshot_interval secondi o dopo snapshot_every mutazioni.
+    All'avvio: storage.load() + replay delle op non ancora compattate
+    (tutta la flotta in memoria, con qualsiasi backend).
+
+    Concorrenza: i lettori prendono snapshot() senza lock; i writer sono
+    serializzati da writing() e pubblicano un nuovo CatalogSnapshot per commit.
+    """
+    def __init__(self, filename='catalog.json', snapshot_every=1000, snapshot_interval=30, fsync=False,
+                 changes_kept=10000, storage=None):
         self.filename = filename
-        self.data = {}
+        self.storage = storage or open_storage(filename, fsync=fsync)
+        self.snapshot_every = snapshot_every
+        self.snapshot_interval = snapshot_interval
+        self._lock = threading.RLock()       # writer: commit + append sullo storage
+        self._save_lock = threading.Lock()   # un solo snapshot su disco alla volta
+        self._pending = 0                    # mutazioni non ancora compattate
+        self._snapshot_wanted = threading.Event()
+        # l'epoch distingue gli ETag e i seq emessi prima di un riavvio
+        self._epoch = format(int(time.time()), 'x')
+        # change feed: ultimi delta tipizzati, uno per commit, con seq = version
+        self.changes = deque(maxlen=changes_kept)
+        self._listeners = []
 
-        if os.path.exists(self.filename):
-            with open(self.filename, 'r') as f:
-                self.data = json.load(f)
+        data = self.storage.load()
+        existed = data is not None
+        if existed:
             print(f"Catalogo caricato da {self.filename}")
         else:
-            self.data = {
+            data = {
                 "owner": "Group 6",
                 "topic": {
                     "computeDecay":["poleData"],
@@ -39,147 +458,385 @@ class SmartCityCatalog:
                             "db": "pole_measurements", "table":"pole_measurements"},
                 "dashboard":"",
                 "threshold": 20,
-                "regions": {  "Piemonte": {
-                "minLat": 44.1,
-                "maxLat": 46.5,
-                "minLon": 6.6,
-                "maxLon": 9.2
-            },
-            "Valle d'Aosta": {
-                "minLat": 45.6,
-                "maxLat": 46.5,
-                "minLon": 6.8,
-                "maxLon": 7.9
-            },
-            "Lombardia": {
-                "minLat": 44.8,
-                "maxLat": 46.6,
-                "minLon": 8.5,
-                "maxLon": 11.5
-            },
-            "Trentino-Alto Adige": {
-                "minLat": 45.7,
-                "maxLat": 47.1,
-                "minLon": 10.4,
-                "maxLon": 12.5
-            },
-            "Veneto": {
-                "minLat": 44.8,
-                "maxLat": 46.6,
-                "minLon": 10.7,
-                "maxLon": 13.1
-            },
-            "Friuli-Venezia Giulia": {
-                "minLat": 45.5,
-                "maxLat": 46.7,
-                "minLon": 12.3,
-                "maxLon": 13.9
-            },
-            "Liguria": {
-                "minLat": 43.8,
-                "maxLat": 44.7,
-                "minLon": 7.5,
-                "maxLon": 10.1
-            },
-            "Emilia-Romagna": {
-                "minLat": 43.7,
-                "maxLat": 45.1,
-                "minLon": 9.2,
-                "maxLon": 12.8
-            },
-            "Toscana": {
-                "minLat": 42.2,
-                "maxLat": 44.5,
-                "minLon": 9.6,
-                "maxLon": 11.8
-            },
-            "Umbria": {
-                "minLat": 42.6,
-                "maxLat": 43.6,
-                "minLon": 11.9,
-                "maxLon": 12.9
-            },
-            "Marche": {
-                "minLat": 42.7,
-                "maxLat": 44.0,
-                "minLon": 12.2,
-                "maxLon": 13.9
-            },
-            "Lazio": {
-                "minLat": 41.2,
-                "maxLat": 42.9,
-                "minLon": 11.4,
-                "maxLon": 14.0
-            },
-            "Abruzzo": {
-                "minLat": 41.6,
-                "maxLat": 42.9,
-                "minLon": 13.0,
-                "maxLon": 14.8
-            },
-            "Molise": {
-                "minLat": 41.4,
-                "maxLat": 42.0,
-                "minLon": 14.3,
-                "maxLon": 15.1
-            },
-            "Campania": {
-                "minLat": 40.0,
-                "maxLat": 41.5,
-                "minLon": 13.7,
-                "maxLon": 15.8
-            },
-            "Puglia": {
-                "minLat": 39.8,
-                "maxLat": 42.1,
-                "minLon": 14.8,
-                "maxLon": 18.5
-            },
-            "Basilicata": {
-                "minLat": 39.9,
-                "maxLat": 41.3,
-                "minLon": 15.3,
-                "maxLon": 16.9
-            },
-            "Calabria": {
-                "minLat": 37.9,
-                "maxLat": 40.2,
-                "minLon": 15.6,
-                "maxLon": 17.2
-            },
-            "Sicilia": {
-                "minLat": 36.6,
-                "maxLat": 38.3,
-                "minLon": 12.3,
-                "maxLon": 15.7
-            },
-            "Sardegna": {
-                "minLat": 38.9,
-                "maxLat": 41.3,
-                "minLon": 8.1,
-                "maxLon": 9.9
-            }
-                },
+                # codec dei payload per radice del topic (nomi di mqtt_client.CODECS)
+                "codecs": {"default": "json", "topics": {"poleData": "json", "alert": "json"}},
+                # porta di /metrics per i servizi senza server web proprio (uno per processo)
+                "metrics_ports": {"computeDecay": 9101, "checkThreshold": 9102, "gateway": 9103},
+                # servizi senza stato che girano in piu' istanze: il broker divide i messaggi nel gruppo
+                "scaling": {"computeDecay": {"share_group": "computeDecay"},
+                            "checkThreshold": {"share_group": "checkThreshold"}},
+                "instances": {},
+                # tabella locale dello stato dei pali nei gateway
+                "pole_status": {"fail_open": True, "max_age": 120, "refresh_interval": 60},
+                # letture dei gateway verso il broker centrale a blocchi (batch=False: un messaggio per lettura)
+                "uplink": {"batch": False, "max_readings": 200, "max_bytes": 65536, "max_delay": 0.5, "compress": True},
+                # filtro ai gateway: passano solo le variazioni oltre la deadband del sensore, almeno
+                # una lettura ogni heartbeat secondi e sempre le letture vicine alla threshold del tilt
+                "edge_filter": copy.deepcopy(DEFAULT_EDGE_FILTER),
+                # store-and-forward su disco nei gateway quando il broker centrale non e' raggiungibile
+                "spool": {"enabled": True, "directory": "spool", "max_bytes": 268435456, "segment_bytes": 4194304,
+                          "max_age": 86400, "replay_rate": 200, "ack_timeout": 5},
+                "regions": {name: dict(box) for name, box in ITALIAN_REGIONS.items()},
                 "gateways": []
             }
-            self.save()
+
+        self._reset(data)
+        replayed = self._replay()
+        if replayed:
+            print(f"Replay di {replayed} mutazioni in {self.filename}")
+        if not existed or replayed:
+            self.storage.write_all(self._snap.data)
+        if not existed:
             print(f"Creato nuovo file {self.filename}")
+        self.storage.open()
+
+        self._snapshot_thread = threading.Thread(target=self._snapshot_loop, daemon=True)
+        self._snapshot_thread.start()
+
+    def _reset(self, data):
+        self._snap = CatalogSnapshot(data, self._epoch)
 
+    def snapshot(self):
+        return self._snap
+
+    def writing(self):
+        # per validare e fare commit senza che un altro writer si inserisca in mezzo
+        return self._lock
+
+    @property
+    def data(self):
+        return self._snap.data
+
+    @property
+    def version(self):
+        return self._snap.version
+
+    @property
+    def section_versions(self):
+        return self._snap.section_versions
+
+    # --- persistenza ---
     def save(self):
-        with open(self.filename, 'w') as f:
-            json.dump(self.data, f, indent=4)
+        # lo storage ruota il suo log sotto il lock, poi scrive fuori dal lock:
+        # lo snapshot e' immutabile, i commit nel frattempo non lo toccano
+        with self._save_lock:
+            with self._lock:
+                snap = self._snap
+                rotated = self.storage.rotate()
+                self._pending = 0
+            self.storage.checkpoint(snap.data, rotated)
+
+    def _replay(self):
+        # le operazioni sono idempotenti: riapplicarle su uno snapshot che
+        # le contiene gia' non cambia lo stato
+        work = self._snap.clone()
+        count = 0
+        for op in self.storage.replay():
+            work.apply(op)
+            count += 1
+        work._copied = None
+        self._snap = work
+        return count
+
+    def _snapshot_loop(self):
+        while True:
+            self._snapshot_wanted.wait(self.snapshot_interval)
+            self._snapshot_wanted.clear()
+            if self._pending:
+                try:
+                    self.save()
+                except Exception as e:
+                    print('Snapshot del catalog fallito: ', e)
+
+    def commit(self, *ops):
+        # applica su una copia, registra sullo storage e pubblica: costo proporzionale alle sole ops
+        with self._lock:
+            work = self._snap.clone()
+            events = []
+            for op in ops:
+                event = work.event_for(op)
+                work.apply(op)
+                if event is not None:
+                    events.append(event)
+            work.publish({self._op_section(op) for op in ops})
+            self.storage.append(ops, work)
+            self._snap = work
+            self._publish_change(events)
+            self._pending += len(ops)
+            if self._pending >= self.snapshot_every:
+                self._snapshot_wanted.set()
+
+    def _op_section(self, op):
+        if op["op"] == "set":
+            return op["path"][0]
+        return "gateways"
+
+    def _publish_change(self, events):
+        change = {"epoch": self._epoch, "seq": self._snap.version, "events": events}
+        self.changes.append(change)
+        for listener in self._listeners:
+            try:
+                listener(change)
+            except Exception as e:
+                print('Errore listener change feed: ', e)
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def changes_since(self, seq):
+        # None se i delta richiesti non sono piu' nel buffer: il client deve rileggere tutto
+        with self._lock:
+            if seq >= self._snap.version:
+                return []
+            if not self.changes or self.changes[0]["seq"] > seq + 1:
+                return None
+            return [c for c in self.changes if c["seq"] > seq]
+
+    # --- letture puntuali sullo snapshot corrente ---
+    def etag(self, section=None):
+        return self._snap.etag(section)
 
     def _find_gateway(self, gateway_id):
-        for i, gw in enumerate(self.data.get("gateways", [])):
-            if gw.get("gateway_id") == gateway_id:
-                return i, gw
-        return None, None
-    
-    def _find_pole(self, gateway, pole_id):
-        for i, pole in enumerate(gateway.get("smart_poles", [])):
-            if pole.get("id") == pole_id:
-                return i, pole
-        return None, None
+        return self._snap.find_gateway(gateway_id)
+
+    def _find_pole(self, pole_id):
+        return self._snap.find_pole(pole_id)
+
+    def gateway_in_zone(self, zone):
+        return self._snap.gateway_in_zone(zone)
+
+    def region_index(self):
+        return self._snap.region_index()
+
+    def list_poles(self, **query):
+        return self._snap.list_poles(**query)
+
+    def list_gateways(self, **query):
+        return self._snap.list_gateways(**query)
+
+    # --- mutazioni: ognuna diventa una op nel journal ---
+    def upsert_gateway(self, input_data):
+        self.commit({"op": "upsert_gateway", "gateway": input_data, "ts": time.time()})
+
+    def add_pole(self, gateway_id, pole):
+        self.commit({"op": "add_pole", "gateway_id": gateway_id, "pole": pole})
+
+    def remove_pole(self, pole_id):
+        self.commit({"op": "remove_pole", "pole_id": pole_id})
+
+    def add_poles(self, gateway_id, poles):
+        # un solo commit (una sola scrittura sul journal) per tutto il batch
+        self.commit(*({"op": "add_pole", "gateway_id": gateway_id, "pole": p} for p in poles))
+
+    def remove_poles(self, pole_ids):
+        self.commit(*({"op": "remove_pole", "pole_id": pid} for pid in pole_ids))
+
+    def set_value(self, path, value):
+        self.commit({"op": "set", "path": list(path), "value": value})
+
+class ChangeFeedPublisher:
+    """
+    Pubblica ogni commit del catalog sul central broker (QoS 1, retained):
+    i servizi applicano i delta invece di rileggere il catalog ogni 5 minuti.
+    """
+    def __init__(self, catalog: SmartCityCatalog, topic='catalog/changes'):
+        self.catalog = catalog
+        self.topic = topic
+        broker = catalog.data.get('central_broker', {})
+        self.client = mqtt.Client(
+            callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
+            client_id=f'catalog_feed_{catalog._epoch}'
+        )
+        # connect_async: il catalog parte anche se il broker non e' ancora su
+        self.client.connect_async(broker.get('address', '127.0.0.1'), int(broker.get('port', 1884)))
+        self.client.loop_start()
+        catalog.add_listener(self.publish)
+
+    def publish(self, change):
+        self.client.publish(self.topic, json.dumps(change), qos=1, retain=True)
+
+    def stop(self):
+        self.client.loop_stop()
+        self.client.disconnect()
+
+LIVENESS_DEFAULTS = {
+    "gateway_ttl": 90,          # secondi senza heartbeat prima che un gateway scada
+    "pole_ttl": 0,              # 0 = i pali scadono solo insieme al loro gateway
+    "heartbeat_interval": 30,   # suggerito ai gateway nella risposta all'heartbeat
+    "sweep_interval": 5,
+}
+
+class LivenessTracker:
+    """
+    Scadenze di gateway e pali in un min-heap: ogni sweep estrae solo le voci
+    scadute, quindi costa O(scaduti) e non O(flotta). Un heartbeat aggiorna
+    solo la scadenza nel dizionario; la voce nell'heap viene riposizionata
+    quando arriva in cima. Le transizioni online/offline sono op del catalog
+    ("liveness"), quindi finiscono nel journal e nel change feed.
+    """
+    def __init__(self, catalog: SmartCityCatalog, start=True):
+        self.catalog = catalog
+        self._lock = threading.Lock()
+        self._deadlines = {}    # (kind, id) -> scadenza
+        self._heap = []         # (scadenza, kind, id), al piu' una voce per chiave
+        self._queued = set()    # chiavi con una voce nell'heap
+        self.expired = {"gateway": 0, "pole": 0}
+        self.revived = {"gateway": 0, "pole": 0}
+        self.last_sweep = None
+        self._stop = threading.Event()
+
+        # dopo un riavvio tutti ripartono con un periodo di grazia pieno
+        now = time.time()
+        snap = catalog.snapshot()
+        cfg = self.config()
+        with self._lock:
+            for gateway_id in snap.gateways:
+                self._touch("gateway", gateway_id, now, cfg)
+            for pole_id in snap.poles:
+                self._touch("pole", pole_id, now, cfg)
+        catalog.add_listener(self._on_change)
+        self._thread = threading.Thread(target=self._sweep_loop, daemon=True)
+        if start:
+            self._thread.start()
+
+    def config(self):
+        cfg = dict(LIVENESS_DEFAULTS)
+        cfg.update(self.catalog.data.get("liveness") or {})
+        return cfg
+
+    def _touch(self, kind, key_id, now, cfg):
+        key = (kind, key_id)
+        ttl = cfg[f"{kind}_ttl"]
+        if not ttl:
+            self._deadlines.pop(key, None)
+            return
+        self._deadlines[key] = now + ttl
+        if key not in self._queued:
+            heapq.heappush(self._heap, (now + ttl, kind, key_id))
+            self._queued.add(key)
+
+    def _on_change(self, change):
+        # registrazioni e cancellazioni arrivano dal change feed del catalog
+        now = time.time()
+        cfg = self.config()
+        with self._lock:
+            for event in change["events"]:
+                if event["type"] == "gateway_updated":
+                    self._touch("gateway", event["gateway"]["gateway_id"], now, cfg)
+                elif event["type"] == "pole_added":
+                    self._touch("pole", event["pole"]["id"], now, cfg)
+                elif event["type"] == "pole_removed":
+                    self._deadlines.pop(("pole", event["pole_id"]), None)
+
+    def heartbeat(self, gateway_id, pole_ids=()):
+        now = time.time()
+        cfg = self.config()
+        # solo il gateway registrato e i suoi pali: id sconosciuti o di altri gateway non entrano nello heap
+        snap = self.catalog.snapshot()
+        if snap.find_gateway(gateway_id) is None:
+            return False
+        pole_ids = [pid for pid in pole_ids if snap.poles.get(pid, (None,))[0] == gateway_id]
+        with self._lock:
+            self._touch("gateway", gateway_id, now, cfg)
+            for pole_id in pole_ids:
+                self._touch("pole", pole_id, now, cfg)
+
+        # solo chi era scaduto produce una op: gli heartbeat normali non toccano il journal
+        with self.catalog.writing():
+            snap = self.catalog.snapshot()
+            gw = snap.find_gateway(gateway_id)
+            if gw is None:
+                return False
+            ops = []
+            revive = set(pole_ids)
+            if gw.get("online") is False:
+                ops.append({"op": "liveness", "gateway_id": gateway_id, "online": True})
+                self.revived["gateway"] += 1
+                # tornano online anche i pali che non sono scaduti per conto loro
+                with self._lock:
+                    revive.update(p.get("id") for p in gw.get("smart_poles", [])
+                                  if not cfg["pole_ttl"] or ("pole", p.get("id")) in self._deadlines)
+            for pole_id in revive:
+                owner, pole = snap.find_pole(pole_id)
+                if pole is not None and owner.get("gateway_id") == gateway_id and pole.get("online") is False:
+                    ops.append({"op": "liveness", "pole_id": pole_id, "online": True})
+                    self.revived["pole"] += 1
+            if ops:
+                self.catalog.commit(*ops)
+        return True
+
+    def sweep(self, now=None):
+        now = time.time() if now is None else now
+        expired = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                _, kind, key_id = heapq.heappop(self._heap)
+                key = (kind, key_id)
+                self._queued.discard(key)
+                deadline = self._deadlines.get(key)
+                if deadline is None:
+                    continue        # cancellato nel frattempo
+                if deadline > now:
+                    # heartbeat ricevuto dopo l'inserimento: si riposiziona
+                    heapq.heappush(self._heap, (deadline, kind, key_id))
+                    self._queued.add(key)
+                    continue
+                del self._deadlines[key]
+                expired.append(key)
+        self.last_sweep = now
+        if not expired:
+            return 0
+
+        with self.catalog.writing():
+            snap = self.catalog.snapshot()
+            ops = []
+            offline = set()
+            for kind, key_id in expired:
+                if kind == "gateway":
+                    gw = snap.find_gateway(key_id)
+                    if gw is None or gw.get("online") is False:
+                        continue
+                    ops.append({"op": "liveness", "gateway_id": key_id, "online": False})
+                    self.expired["gateway"] += 1
+                    print(f"[!] Gateway {key_id} scaduto: nessun heartbeat")
+                    pole_ids = [p.get("id") for p in gw.get("smart_poles", [])]
+                else:
+                    pole_ids = [key_id]
+                for pole_id in pole_ids:
+                    _, pole = snap.find_pole(pole_id)
+                    if pole is None or pole.get("online") is False or pole_id in offline:
+                        continue
+                    offline.add(pole_id)
+                    ops.append({"op": "liveness", "pole_id": pole_id, "online": False})
+                    self.expired["pole"] += 1
+            if ops:
+                self.catalog.commit(*ops)
+        return len(ops)
+
+    def _sweep_loop(self):
+        while not self._stop.wait(self.config()["sweep_interval"]):
+            try:
+                self.sweep()
+            except Exception as e:
+                print('Sweep liveness fallito: ', e)
+
+    def status(self):
+        with self._lock:
+            tracked = {"gateway": 0, "pole": 0}
+            for kind, _ in self._deadlines:
+                tracked[kind] += 1
+        snap = self.catalog.snapshot()
+        return {
+            "config": self.config(),
+            "tracked": tracked,
+            "expired_total": dict(self.expired),
+            "revived_total": dict(self.revived),
+            "offline_gateways": sorted((gid for gid, gw in snap.gateways.items() if gw.get("online") is False), key=str),
+            "last_sweep": self.last_sweep,
+        }
+
+    def stop(self):
+        self._stop.set()
 
 class computeDecay:
     exposed = True
@@ -191,16 +848,7 @@ class computeDecay:
     @cherrypy.tools.json_out()
     def POST(self, *uri, **params):
         body = cherrypy.request.json
-        
-            # 1. Assicuriamoci che la struttura esista nel dizionario data
-        if 'BackEnd' not in self.catalog.data:
-                self.catalog.data['BackEnd'] = {}
-            
-            # 2. Salviamo l'ID
-        self.catalog.data['BackEnd']['computeDecay'] = body['id']
-            
-            # 3. Salviamo su file
-        self.catalog.save()
+        self.catalog.set_value(['BackEnd', 'computeDecay'], body['id'])
         print(f"[*] Catalog aggiornato: computeDecay registrato con ID {body['id']}")
         return {"status": "success", "message": "computeDecay registered"}
     
@@ -214,64 +862,78 @@ class checkThreshold:
     @cherrypy.tools.json_out()
     def POST(self, *uri, **params):
         body = cherrypy.request.json
-            # 1. Assicuriamoci che la struttura esista nel dizionario data
-        if 'BackEnd' not in self.catalog.data:
-                self.catalog.data['BackEnd'] = {}
-            
-            # 2. Salviamo l'ID
-        self.catalog.data['BackEnd']['checkThreshold'] = body['id']
-            
-            # 3. Salviamo su file
-        self.catalog.save()
+        self.catalog.set_value(['BackEnd', 'checkThreshold'], body['id'])
         print(f"[*] Catalog aggiornato: checkThreshold registrato con ID {body['id']}")
         return {"status": "success", "message": "checkThreshold registered"}
         
         
 
-class GatewayAPI:
+class InstanceAPI:
+    """
+    POST /instance {"type": <servizio>}: client id univoco per una nuova istanza
+    di un servizio scalato (computeDecay-1, computeDecay-2, ...) e il gruppo della
+    shared subscription. Il contatore e' nel catalog: gli id non si ripetono
+    neanche dopo un riavvio.
+    """
     exposed = True
 
     def __init__(self, catalog: SmartCityCatalog):
         self.catalog = catalog
 
+    @cherrypy.tools.json_in()
+    @cherrypy.tools.json_out()
+    def POST(self, *uri, **params):
+        service = (cherrypy.request.json or {}).get('type')
+        if not service:
+            raise cherrypy.HTTPError(400, "Manca type")
+        with self.catalog.writing():
+            n = self.catalog.data.get('instances', {}).get(service, 0) + 1
+            self.catalog.set_value(['instances', service], n)
+        group = self.catalog.data.get('scaling', {}).get(service, {}).get('share_group')
+        print(f"[*] Nuova istanza {service}-{n} (gruppo {group})")
+        return {"client_id": f"{service}-{n}", "instance": n, "share_group": group}
+
+
+class GatewayAPI:
+    exposed = True
+
+    def __init__(self, catalog: SmartCityCatalog, liveness=None):
+        self.catalog = catalog
+        self.liveness = liveness
+
     @cherrypy.tools.json_in()
     @cherrypy.tools.json_out()
     def POST(self, *uri, **params):
         input_data = cherrypy.request.json
 
+        # POST /gateway/<gateway_id>/heartbeat {"poles": [id, ...]}
+        if len(uri) == 2 and uri[1] == 'heartbeat':
+            if not self.liveness.heartbeat(uri[0], input_data.get("poles") or []):
+                raise cherrypy.HTTPError(404, "Gateway non trovato")
+            return {"status": "alive", "gateway_id": uri[0],
+                    "heartbeat_interval": self.liveness.config()["heartbeat_interval"]}
+
         if 'gateway_id' not in input_data:
             raise cherrypy.HTTPError(400, "Manca gateway_id")
 
         zone = input_data.get("zone")
         gateway_id = input_data.get("gateway_id")
         # 1 gateway per zona (se già esiste un altro gateway in quella zona -> blocca)
-        for gw in self.catalog.data.get("gateways", []):
-            if gw.get("zone") == zone and gw.get("gateway_id") != gateway_id:
+        with self.catalog.writing():
+            gw = self.catalog.gateway_in_zone(zone)
+            if gw is not None and gw.get("gateway_id") != gateway_id:
                 raise cherrypy.HTTPError(409, f"Gateway già presente in zona {zone}")
 
-
-        gateway_id = input_data["gateway_id"]
-        i, gw = self.catalog._find_gateway(gateway_id)
-
-        if gw is None:
-            new_gw = dict(input_data)
-            new_gw.setdefault("smart_poles", [])
-            new_gw["last_update"] = time.time()
-            self.catalog.data["gateways"].append(new_gw)
-        else:
-            # aggiorna SOLO i campi gateway, non la lista pali
-            #se togli questo tranne time non ti aggiorna i campi gateway ogni volta che fa la richiesta post
-            incoming = dict(input_data)
-            incoming.pop("smart_poles", None)  
-            self.catalog.data["gateways"][i].update(incoming)
-            self.catalog.data["gateways"][i]["last_update"] = time.time()
-
-        self.catalog.save()
+            self.catalog.upsert_gateway(input_data)
+        # una nuova registrazione vale come heartbeat (e riporta online un gateway scaduto)
+        self.liveness.heartbeat(gateway_id)
         return {"status": "gateway_registered", "gateway_id": gateway_id}
 
 
 class PoleAPI:
     exposed = True
+    # DELETE /pole batch porta gli id nel body
+    _cp_config = {'request.methods_with_bodies': ('POST', 'PUT', 'PATCH', 'DELETE')}
 
     def __init__(self, catalog: SmartCityCatalog):
         self.catalog = catalog
@@ -286,6 +948,11 @@ class PoleAPI:
     @cherrypy.tools.json_out()
     def POST(self, *uri, **params):
         input_data = cherrypy.request.json
+        # batch: {"gateway_id": ..., "poles": [{...}, ...]}
+        if "poles" in input_data:
+            with self.catalog.writing():
+                return self._post_batch(input_data)
+
         gateway_id = input_data.get("gateway_id")
         pole = dict(input_data)  # copia
 
@@ -301,39 +968,85 @@ class PoleAPI:
         pole_id = pole["id"]
         
 
-        i, gw = self.catalog._find_gateway(gateway_id)
-        if gw is None:
-            raise cherrypy.HTTPError(404, "Gateway non trovato")  
-
-        current_poles = self.catalog.data["gateways"][i].get("smart_poles", [])
-        if any(p.get("id") == pole_id for p in current_poles):
-            raise cherrypy.HTTPError(400, "Il palo con questo id esiste già.")
-        current_poles.append(pole)
-        self.catalog.data["gateways"][i]["smart_poles"] = current_poles
-        self.catalog.save()
+        # controllo + commit sotto il lock dei writer: nessuna registrazione doppia
+        with self.catalog.writing():
+            gw = self.catalog._find_gateway(gateway_id)
+            if gw is None:
+                raise cherrypy.HTTPError(404, "Gateway non trovato")  
+
+            _, existing = self.catalog._find_pole(pole_id)
+            if existing is not None:
+                raise cherrypy.HTTPError(400, "Il palo con questo id esiste già.")
+            self.catalog.add_pole(gateway_id, pole)
         return {
             "status": "pole_created",
             "gateway_id": gateway_id,
             "id": pole_id,
         }
-    
+
+    def _post_batch(self, input_data):
+        gateway_id = input_data.get("gateway_id")
+        if not gateway_id:
+            raise cherrypy.HTTPError(400, "Manca gateway_id")
+        gw = self.catalog._find_gateway(gateway_id)
+        if gw is None:
+            raise cherrypy.HTTPError(404, "Gateway non trovato")
+
+        # validazione in un solo passaggio sull'indice, risultato per ogni palo
+        results = []
+        to_add = []
+        seen = set()
+        for item in input_data.get("poles") or []:
+            pole = dict(item)
+            pole["gateway_id"] = gateway_id
+            pole_id = pole.get("id")
+            if pole_id is None:
+                results.append({"id": None, "status": "error", "code": 400, "message": "Manca pole.id"})
+                continue
+            if "lat" not in pole or "long" not in pole:
+                results.append({"id": pole_id, "status": "error", "code": 400, "message": "Manca lat/long nel payload"})
+                continue
+            owner, existing = self.catalog._find_pole(pole_id)
+            if pole_id in seen or (existing is not None and owner.get("gateway_id") == gateway_id):
+                # gia' registrato su questo gateway: la registrazione e' idempotente
+                results.append({"id": pole_id, "status": "pole_exists"})
+                continue
+            if existing is not None:
+                results.append({"id": pole_id, "status": "error", "code": 409, "message": "Palo registrato su un altro gateway"})
+                continue
+            seen.add(pole_id)
+            to_add.append(pole)
+            results.append({"id": pole_id, "status": "pole_created"})
+
+        if to_add:
+            self.catalog.add_poles(gateway_id, to_add)
+        return {"status": "batch", "gateway_id": gateway_id, "created": len(to_add), "results": results}
+
+    @cherrypy.tools.json_in(force=False)
+    @cherrypy.tools.json_out()
     def DELETE(self, *uri, **params):
+        # batch: DELETE /pole con body {"gateway_id": ..., "ids": [...]}
+        body = getattr(cherrypy.request, 'json', None)
+        if len(uri) < 2 and isinstance(body, dict) and "ids" in body:
+            with self.catalog.writing():
+                return self._delete_batch(body)
+
         if len(uri) < 2:
             raise cherrypy.HTTPError(400, "Manca gateway_id o pole_id")
 
         gateway_id = uri[0]
         pole_id = uri[1]
 
-        i, gw = self.catalog._find_gateway(gateway_id)
-        if gw is None:
-            raise cherrypy.HTTPError(404, "Gateway non trovato")  
+        with self.catalog.writing():
+            gw = self.catalog._find_gateway(gateway_id)
+            if gw is None:
+                raise cherrypy.HTTPError(404, "Gateway non trovato")  
 
-        j, pole = self.catalog._find_pole(gw, pole_id)
-        if pole is None:
-            raise cherrypy.HTTPError(404, "Palo non trovato")  
+            owner, pole = self.catalog._find_pole(pole_id)
+            if pole is None or owner.get("gateway_id") != gateway_id:
+                raise cherrypy.HTTPError(404, "Palo non trovato")  
 
-        del self.catalog.data["gateways"][i]["smart_poles"][j]
-        self.catalog.save()
+            self.catalog.remove_pole(pole_id)
 
         return {
             "status": "pole_deleted",
@@ -341,6 +1054,26 @@ class PoleAPI:
             "id": pole_id,
         }
 
+    def _delete_batch(self, body):
+        gateway_id = body.get("gateway_id")
+        gw = self.catalog._find_gateway(gateway_id)
+        if gw is None:
+            raise cherrypy.HTTPError(404, "Gateway non trovato")
+
+        results = []
+        to_remove = []
+        for pole_id in dict.fromkeys(body.get("ids") or []):
+            owner, pole = self.catalog._find_pole(pole_id)
+            if pole is None or owner.get("gateway_id") != gateway_id:
+                results.append({"id": pole_id, "status": "error", "code": 404, "message": "Palo non trovato"})
+                continue
+            to_remove.append(pole_id)
+            results.append({"id": pole_id, "status": "pole_deleted"})
+
+        if to_remove:
+            self.catalog.remove_poles(to_remove)
+        return {"status": "batch", "gateway_id": gateway_id, "deleted": len(to_remove), "results": results}
+
 class DashboardAPI:
     exposed = True
 
@@ -353,15 +1086,7 @@ class DashboardAPI:
         body = cherrypy.request.json
         
         if body['id']:
-            # 1. Assicuriamoci che la struttura esista nel dizionario data
-            if 'dashboard' not in self.catalog.data:
-                self.catalog.data['dashboard'] = ''
-            
-            # 2. Salviamo l'ID
-            self.catalog.data['dashboard'] = body['id']
-            
-            # 3. Salviamo su file
-            self.catalog.save()
+            self.catalog.set_value(['dashboard'], body['id'])
             print(f"[*] Catalog aggiornato: ComputeDecay registrato con ID {body['id']}")
             return {"status": "success", "message": "ComputeDecay registered"}
         
@@ -378,39 +1103,210 @@ class interfaccia_dbAPI:
             body = cherrypy.request.json
             
             if body['id']:
-                # 1. Assicuriamoci che la struttura esista nel dizionario data
-                if 'interfaccia' not in self.catalog.data:
-                    self.catalog.data['interfaccia'] = ''
-                
-                # 2. Salviamo l'ID
-                self.catalog.data['interfaccia'] = body['id']
-                
-                # 3. Salviamo su file
-                self.catalog.save()
+                self.catalog.set_value(['interfaccia'], body['id'])
                 print(f"[*] Catalog aggiornato: interfaccia registrato con ID {body['id']}")
                 return {"status": "success", "message": "interfaccia registered"}
             
             return {"status": "error", "message": "Unknown type"}
 
 
+DEFAULT_PAGE = 1000
+MAX_PAGE = 10000
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode()
+
+def decode_cursor(token):
+    try:
+        return json.loads(base64.urlsafe_b64decode(token.encode()))
+    except Exception:
+        raise cherrypy.HTTPError(400, "cursor non valido")
+
+def listing_params(params):
+    # filtri comuni: region/zone, gateway, bbox=minLat,minLon,maxLat,maxLon, updated_since=<versione>,
+    # online=true|false (liveness)
+    # paginazione: limit, cursor; proiezione: fields=a,b,c
+    try:
+        query = {
+            "zone": params.get('region', params.get('zone')),
+            "updated_since": int(params['updated_since']) if 'updated_since' in params else None,
+            "bbox": [float(x) for x in params['bbox'].split(',')] if 'bbox' in params else None,
+            "online": {'true': True, 'false': False}[params['online']] if 'online' in params else None,
+        }
+        paged = 'limit' in params or 'cursor' in params
+        limit = min(int(params.get('limit', DEFAULT_PAGE)), MAX_PAGE) if paged else None
+    except (ValueError, KeyError):
+        raise cherrypy.HTTPError(400, "Parametri di listing non validi")
+    if query["bbox"] is not None and len(query["bbox"]) != 4:
+        raise cherrypy.HTTPError(400, "bbox = minLat,minLon,maxLat,maxLon")
+    fields = params['fields'].split(',') if params.get('fields') else None
+    after = decode_cursor(params['cursor']) if params.get('cursor') else None
+    return query, fields, after, limit
+
+def project(items, fields):
+    if fields is None:
+        return items
+    return [{k: item[k] for k in fields if k in item} for item in items]
+
+def listing_response(items, next_key, fields, limit):
+    items = project(items, fields)
+    if limit is None:
+        return items
+    return {"items": items, "next_cursor": encode_cursor(next_key) if next_key is not None else None}
+
+# codec dei payload MQTT che il catalog puo' assegnare ai topic (mqtt_client.CODECS)
+CODEC_NAMES = ('json', 'msgpack', 'telemetry')
+DEFAULT_CODECS = {"default": "json", "topics": {}}
+# gateway: con la tabella dei pali troppo vecchia (o un palo assente) fail_open decide se inoltrare
+DEFAULT_POLE_STATUS = {"fail_open": True, "max_age": 120, "refresh_interval": 60}
+# filtro ai bordi spento finche' non lo si accende (PUT /edge_filter {"enabled": true}): stesso
+# default per i catalog nuovi e per quelli senza la sezione
+DEFAULT_EDGE_FILTER = {"enabled": False, "heartbeat": 60, "near_threshold": 0.8,
+                       "sensors": {"thermometer": {"field": "temperature", "deadband": 1.0},
+                                   "hygrometer": {"field": "humidity", "deadband": 5},
+                                   "accelerometer": {"field": "tilt", "deadband": 0.1}}}
+DEFAULT_SPOOL = {"enabled": True, "directory": "spool", "max_bytes": 268435456, "segment_bytes": 4194304,
+                 "max_age": 86400, "replay_rate": 200, "ack_timeout": 5}
+DEFAULT_UPLINK = {"batch": False, "max_readings": 200, "max_bytes": 65536, "max_delay": 0.5, "compress": True}
+
+# sezione del catalog da cui dipende ogni route GET (per l'ETag)
+GET_SECTIONS = {
+    'gateways': 'gateways', 'smart_poles': 'gateways', 'pole_status': 'gateways',
+    'local_broker': 'local_broker', 'central_broker': 'central_broker',
+    'regions': 'regions', 'threshold': 'threshold', 'topic': 'topic', 'owner': 'owner',
+    'checkThreshold': 'checkThreshold', 'computeDecay': 'computeDecay',
+    'dashboard': 'dashboard', 'db_info': 'db_info', 'writer_port': 'writer_port',
+    'c_d_url': 'c_d_url', 'dashboard_port': 'dashboard_port', 'codecs': 'codecs',
+    'bootstrap': None,   # dipende da piu' sezioni: versione globale
+}
+
+# route di GET servite dalla cache: le altre dipendono dal singolo id o da stato non versionato
+CACHED_ROUTES = set(GET_SECTIONS) - {'pole_status'}
+
+class ResponseCache:
+    """
+    Body JSON gia' serializzati (e la variante gzip) per le GET piu' frequenti.
+    La chiave e' route + parametri, il tag e' l'ETag della sezione: dopo una
+    mutazione il tag cambia e la voce viene rigenerata alla prima richiesta.
+    """
+    def __init__(self, max_entries=512, gzip_min=1024):
+        self.max_entries = max_entries
+        self.gzip_min = gzip_min   # sotto questa soglia la compressione non conviene
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, tag):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry["tag"] != tag:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key, tag, body):
+        entry = {"tag": tag, "body": body, "gzip": None}
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def encoded(self, entry, accept_gzip):
+        # la variante gzip viene calcolata una volta sola, alla prima richiesta che la accetta
+        if not accept_gzip or len(entry["body"]) < self.gzip_min:
+            return entry["body"], False
+        if entry["gzip"] is None:
+            entry["gzip"] = gzip.compress(entry["body"], 6)
+        return entry["gzip"], True
+
+CACHE_LOOKUPS = REGISTRY.counter('catalog_response_cache_total', 'GET servite dalla cache delle risposte o serializzate',
+                                 ('route', 'result'))
+
+
 class RootAPI:
     exposed = True
 
-    def __init__(self, catalog: SmartCityCatalog):
+    def __init__(self, catalog: SmartCityCatalog, liveness=None):
         self.catalog = catalog
-        self.gateway = GatewayAPI(catalog)  # /gateway
+        self.liveness = liveness or LivenessTracker(catalog)
+        self.gateway = GatewayAPI(catalog, self.liveness)  # /gateway
         self.pole = PoleAPI(catalog)        # /pole
         self.computeDecay = computeDecay(catalog)  # 
         self.checkThreshold = checkThreshold(catalog)
         self.dashboard = DashboardAPI(catalog)
         self.interfaccia = interfaccia_dbAPI(catalog)
+        self.instance = InstanceAPI(catalog)  # /instance
+        self.responses = ResponseCache()
+        REGISTRY.gauge('catalog_version', 'Versione corrente del catalog').set_function(lambda: catalog.version)
+        REGISTRY.gauge('catalog_gateways', 'Gateway registrati').set_function(lambda: len(catalog.snapshot().gateways))
+        REGISTRY.gauge('catalog_poles', 'Pali registrati').set_function(lambda: len(catalog.snapshot().poles))
 
-    @cherrypy.tools.json_out()
     @cherrypy.tools.json_in()
     def GET(self, *uri, **params):
+        if uri == ('metrics',):
+            cherrypy.response.headers['Content-Type'] = METRICS_CONTENT_TYPE
+            return REGISTRY.render().encode('utf-8')
+        # un solo snapshot per richiesta: ETag e body descrivono la stessa versione
+        snap = self.catalog.snapshot()
+        tag = None
+        # GET condizionale: se il client ha gia' questa versione -> 304 senza body
+        if len(uri) == 0 or uri[0] in GET_SECTIONS:
+            section = GET_SECTIONS[uri[0]] if uri else None
+            tag = snap.etag(section)
+            cherrypy.response.headers['ETag'] = tag
+            cptools.validate_etags()
+
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        if tag is None or (uri and uri[0] not in CACHED_ROUTES):
+            return json.dumps(self._get(snap, uri, params)).encode('utf-8')
+
+        # stessa sezione alla stessa versione -> stessi byte, senza ri-serializzare
+        key = (uri, json.dumps(params, sort_keys=True))
+        entry = self.responses.get(key, tag)
+        CACHE_LOOKUPS.inc(uri[0] if uri else '/', 'hit' if entry is not None else 'miss')
+        if entry is None:
+            entry = self.responses.put(key, tag, json.dumps(self._get(snap, uri, params)).encode('utf-8'))
+        accept_gzip = 'gzip' in cherrypy.request.headers.get('Accept-Encoding', '')
+        body, compressed = self.responses.encoded(entry, accept_gzip)
+        cherrypy.response.headers['Vary'] = 'Accept-Encoding'
+        if compressed:
+            cherrypy.response.headers['Content-Encoding'] = 'gzip'
+        return body
+
+    def _get(self, snap, uri, params):
         if len(uri) == 0:
-            return self.catalog.data
+            if params.get('fields'):
+                return {k: snap.data[k] for k in params['fields'].split(',') if k in snap.data}
+            return snap.data
+
+        if uri[0] == 'version':
+            return {"epoch": snap.epoch, "version": snap.version,
+                    "sections": snap.section_versions}
+
+        if uri[0] == 'liveness':
+            return self.liveness.status()
+
+        if uri[0] == 'changes':
+            # GET /changes?since=N -> delta successivi a N, oppure resync se sono andati persi
+            try:
+                since = int(params.get('since', 0))
+            except ValueError:
+                raise cherrypy.HTTPError(400, "since deve essere un intero")
+            changes = self.catalog.changes_since(since)
+            if changes is None:
+                return {"epoch": snap.epoch, "seq": self.catalog.version, "resync": True}
+            # il seq restituito non deve superare l'ultimo delta incluso nella risposta
+            seq = changes[-1]["seq"] if changes else min(since, self.catalog.version)
+            return {"epoch": snap.epoch, "seq": seq, "changes": changes}
         
+        if uri[0] == 'bootstrap':
+            return self._bootstrap(snap, params)
+
         if uri[0] == 'compute_id':
             if params:
                 try:
@@ -426,103 +1322,318 @@ class RootAPI:
         if uri[0] == 'gateways':
             if len(uri) > 1:
                 target_id = uri[1]
-                _, gw = self.catalog._find_gateway(target_id)
+                gw = snap.find_gateway(target_id)
                 if gw is not None:
                     return gw
                 raise cherrypy.HTTPError(404, "Gateway non trovato")
-            return self.catalog.data['gateways']
+            if not params:
+                return snap.data['gateways']
+            query, fields, after, limit = listing_params(params)
+            items, next_key = snap.list_gateways(zone=query["zone"], updated_since=query["updated_since"],
+                                                 online=query["online"], after=after, limit=limit)
+            return listing_response(items, next_key, fields, limit)
 
         if uri[0] == 'smart_poles':
             if len(uri) > 2: 
                 gateway_id = uri[1]
                 pole_id = uri[2]
-                _, gw = self.catalog._find_gateway(gateway_id)
+                gw = snap.find_gateway(gateway_id)
                 if gw is not None:
-                    _, pole = self.catalog._find_pole(gw, pole_id)
-                    if pole is not None:
+                    owner, pole = snap.find_pole(pole_id)
+                    if pole is not None and owner.get("gateway_id") == gateway_id:
                         return pole
                     raise cherrypy.HTTPError(404, "Palo non trovato")
                 raise cherrypy.HTTPError(404, "Gateway non trovato")
             elif len(uri) == 2:
                 gateway_id = uri[1]
-                _, gw = self.catalog._find_gateway(gateway_id)
-                if gw is not None:
+                gw = snap.find_gateway(gateway_id)
+                if gw is None:
+                    raise cherrypy.HTTPError(404, "Gateway non trovato")
+                if not params:
                     return gw.get("smart_poles", [])
-                raise cherrypy.HTTPError(404, "Gateway non trovato")
+            else:
+                # GET /smart_poles: tutti i pali del catalog, filtrabili per gateway
+                gateway_id = params.get('gateway')
+            query, fields, after, limit = listing_params(params)
+            items, next_key = snap.list_poles(gateway_id=gateway_id, after=after, limit=limit, **query)
+            return listing_response(items, next_key, fields, limit)
 
         if uri[0] == 'local_broker':
-                return self.catalog.data['local_broker']
+                return snap.data['local_broker']
         if uri[0] == 'central_broker':
-                return self.catalog.data['central_broker']
+                return snap.data['central_broker']
 
         if uri[0] == 'regions':
+            if len(uri) > 1 and uri[1] == 'lookup':
+                try:
+                    lat, lon = float(params['lat']), float(params['lon'])
+                except (KeyError, ValueError):
+                    raise cherrypy.HTTPError(400, "Servono lat e lon numerici")
+                return {"region": snap.region_index().lookup(lat, lon)}
             if params.get('region'):
                 region_name = params.get('region')
-                regions = self.catalog.data['regions']
+                regions = snap.data['regions']
                 if region_name in regions:
                     return regions[region_name]
                 else:
                     raise cherrypy.HTTPError(404, "Regione non trovata")
-            return self.catalog.data['regions']
+            return snap.data['regions']
         
         if uri[0] == "pole_status":
             if len(uri) < 2:
                 raise cherrypy.HTTPError(400, "Missing pole_id")
             pole_id = uri[1]
-
-            for gw in self.catalog.data.get("gateways", []):
-                for p in gw.get("smart_poles", []):
-                    if p.get("id") == pole_id:
-                        return {"active": True}
-
-            return {"active": False}  
+            return {"active": snap.pole_active(pole_id), "online": snap.pole_online(pole_id)}
 
         if uri[0] == 'threshold':
-            return {"threshold": self.catalog.data.get('threshold', None)}
+            return {"threshold": snap.data.get('threshold', None)}
         
         if uri[0] == 'topic':
             if params:
                 try:
-                    return self.catalog.data['topic'][params['type']]
+                    return snap.data['topic'][params['type']]
                 except Exception as ex:
                     print('Error: ', ex)
-            return self.catalog.data['topic']
+            return snap.data['topic']
         
         if uri[0]=='owner':
-            return {"owner": self.catalog.data.get('owner', '')}
+            return {"owner": snap.data.get('owner', '')}
         
         if uri[0]=='checkThreshold':
-            return self.catalog.data.get('checkThreshold', {})
+            return snap.data.get('checkThreshold', {})
         
         if uri[0]=='computeDecay':
-            return self.catalog.data.get('computeDecay', {})
+            return snap.data.get('computeDecay', {})
         
         if uri[0]=='dashboard':
-            return self.catalog.data.get('dashboard', '')
+            return snap.data.get('dashboard', '')
         if uri[0]=='db_info':
-            return self.catalog.data.get('db_info', {})
+            return snap.data.get('db_info', {})
         if uri[0]=='writer_port':
-            return {"writer_port": self.catalog.data.get('writer_port', 8090)}
+            return {"writer_port": snap.data.get('writer_port', 8090)}
         if uri[0]=='c_d_url':
-            return {"c_d_url": self.catalog.data.get('c_d_url','')}
+            return {"c_d_url": snap.data.get('c_d_url','')}
         if uri[0]=='dashboard_port':
-            return {"dashboard_port": self.catalog.data.get('dashboard_port',8081)}
+            return {"dashboard_port": snap.data.get('dashboard_port',8081)}
+        if uri[0] == 'codecs':
+            return snap.data.get('codecs', DEFAULT_CODECS)
                 
 
         raise cherrypy.HTTPError(400, "Comando non riconosciuto")
 
+    def _bootstrap(self, snap, params):
+        # GET /bootstrap?type=<servizio>[&lat=..&lon=..]: tutto quello che serve all'avvio in una risposta
+        service = params.get('type')
+        if not service:
+            raise cherrypy.HTTPError(400, "Manca type")
+        data = snap.data
+        client_id = service
+        region = None
+        if 'lat' in params and 'lon' in params:
+            try:
+                region = snap.region_index().lookup(float(params['lat']), float(params['lon']))
+            except ValueError:
+                raise cherrypy.HTTPError(400, "Servono lat e lon numerici")
+            if service == 'gateway':
+                client_id = 'gateway_' + str(params['lat']) + str(params['lon'])
+        return {
+            "epoch": snap.epoch,
+            "version": snap.version,
+            "type": service,
+            "client_id": client_id,
+            "region": region,
+            "central_broker": data.get('central_broker'),
+            "local_broker": data.get('local_broker'),
+            "topics": data.get('topic', {}).get(service, []),
+            "cmd_topic": data.get('topic', {}).get('cmd_topic'),
+            "threshold": data.get('threshold'),
+            "db_info": data.get('db_info', {}),
+            "writer_port": data.get('writer_port', 8090),
+            "dashboard_port": data.get('dashboard_port', 8081),
+            "c_d_url": data.get('c_d_url', ''),
+            "codecs": data.get('codecs', DEFAULT_CODECS),
+            "metrics_port": data.get('metrics_ports', {}).get(service),
+            "share_group": data.get('scaling', {}).get(service, {}).get('share_group'),
+            "pole_status": data.get('pole_status', DEFAULT_POLE_STATUS),
+            "uplink": data.get('uplink', DEFAULT_UPLINK),
+            "spool": data.get('spool', DEFAULT_SPOOL),
+            "edge_filter": data.get('edge_filter', DEFAULT_EDGE_FILTER),
+        }
+
+    @cherrypy.tools.json_in()
+    @cherrypy.tools.json_out()
+    def POST(self, *uri, **params):
+        body = cherrypy.request.json
+
+        if uri[:2] == ('regions', 'lookup'):
+            # batch: {"points": [[lat, lon], ...]} -> {"regions": [...]} nello stesso ordine
+            try:
+                points = [(float(lat), float(lon)) for lat, lon in body.get('points', [])]
+            except (TypeError, ValueError):
+                raise cherrypy.HTTPError(400, "points deve essere una lista di [lat, lon]")
+            return {"regions": self.catalog.region_index().lookup_many(points)}
+
+        if uri[:1] == ('pole_status',):
+            return self._pole_status_batch(body)
+
+        raise cherrypy.HTTPError(400, "Comando non riconosciuto")
+
+    def _pole_status_batch(self, body):
+        # {"ids": [...]} oppure {"gateway_id": ...}, opzionale "since": <versione> con il suo "epoch"
+        # -> {"version", "active": {id: bool}, "online": {id: bool}}; con since solo i pali cambiati
+        # dopo quella versione. active = registrato, online = liveness (solo per i pali registrati)
+        snap = self.catalog.snapshot()
+        since = body.get("since")
+        if since is not None and not isinstance(since, int):
+            raise cherrypy.HTTPError(400, "since deve essere un intero")
+        # versione di un altro avvio del catalog (epoch diverso) o mai emessa: si riparte dalla mappa completa
+        epoch = body.get("epoch")
+        if since is not None and ((epoch is not None and epoch != snap.epoch) or since > snap.version):
+            since = None
+        ids = body.get("ids")
+        gateway_id = body.get("gateway_id")
+        if ids is None and gateway_id is None:
+            raise cherrypy.HTTPError(400, "Servono ids o gateway_id")
+
+        response = {"epoch": snap.epoch, "version": snap.version, "full": since is None}
+
+        def status(pole_ids):
+            response["active"] = {pid: snap.pole_active(pid) for pid in pole_ids}
+            response["online"] = {pid: snap.pole_online(pid) for pid in pole_ids if pid in snap.poles}
+            return response
+
+        if ids is not None:
+            if not isinstance(ids, list):
+                raise cherrypy.HTTPError(400, "ids deve essere una lista")
+            if since is not None:
+                # un id assente dall'indice e' stato cancellato: va sempre riportato
+                ids = [pid for pid in ids if pid not in snap.poles or snap.pole_versions.get(pid, 0) > since]
+            return status(ids)
+
+        gw = snap.find_gateway(gateway_id)
+        if gw is None:
+            raise cherrypy.HTTPError(404, "Gateway non trovato")
+        poles = [p.get("id") for p in gw.get("smart_poles", [])]
+        if since is None:
+            return status(poles)
+
+        # pali cancellati dopo since: dal change feed; se non copre piu' quel tratto -> mappa completa
+        changes = self.catalog.changes_since(since)
+        if changes is None:
+            response["full"] = True
+            return status(poles)
+        status([pid for pid in poles if snap.pole_versions.get(pid, 0) > since])
+        active = response["active"]
+        for change in changes:
+            if change["seq"] > snap.version:
+                break
+            for event in change["events"]:
+                if event["type"] == "pole_removed" and event["gateway_id"] == gateway_id \
+                        and snap.poles.get(event["pole_id"], (None,))[0] != gateway_id:
+                    active[event["pole_id"]] = False
+        return response
+
     @cherrypy.tools.json_in()
     @cherrypy.tools.json_out()
     def PUT(self, *uri, **params):
         body = cherrypy.request.json
 
+        if uri[0] == 'liveness':
+            cfg = self.liveness.config()
+            for key, value in body.items():
+                if key not in LIVENESS_DEFAULTS or not isinstance(value, (int, float)) or value < 0:
+                    raise cherrypy.HTTPError(400, f"Valore di liveness non valido: {key}")
+                cfg[key] = value
+            if cfg["sweep_interval"] <= 0:
+                raise cherrypy.HTTPError(400, "sweep_interval deve essere positivo")
+            self.catalog.set_value(['liveness'], cfg)
+            print(f"[*] Catalog aggiornato: liveness {cfg}")
+            return {"status": "success", "liveness": cfg}
+
+        if uri[0] == 'threshold':
+            value = body.get('threshold')
+            if not isinstance(value, (int, float)):
+                raise cherrypy.HTTPError(400, "threshold deve essere un numero")
+            self.catalog.set_value(['threshold'], value)
+            print(f"[*] Catalog aggiornato: threshold {value}")
+            return {"status": "success", "threshold": value}
+
+        if uri[0] == 'edge_filter':
+            # {"heartbeat": 30, "sensors": {"accelerometer": {"field": "tilt", "deadband": 0.05}}};
+            # un sensore a null viene tolto dal filtro
+            with self.catalog.writing():
+                cfg = dict(DEFAULT_EDGE_FILTER, **self.catalog.data.get('edge_filter', {}))
+                cfg['sensors'] = dict(cfg['sensors'])
+                if 'enabled' in body:
+                    if not isinstance(body['enabled'], bool):
+                        raise cherrypy.HTTPError(400, "enabled deve essere true o false")
+                    cfg['enabled'] = body['enabled']
+                for key in ('heartbeat', 'near_threshold'):
+                    if key in body:
+                        value = body[key]
+                        if not isinstance(value, (int, float)) or isinstance(value, bool) or value <= 0:
+                            raise cherrypy.HTTPError(400, f"{key} deve essere un numero positivo")
+                        cfg[key] = value
+                for sensor_type, rule in (body.get('sensors') or {}).items():
+                    if rule is None:
+                        cfg['sensors'].pop(sensor_type, None)
+                        continue
+                    deadband = rule.get('deadband') if isinstance(rule, dict) else None
+                    if not isinstance(rule, dict) or not isinstance(rule.get('field'), str) \
+                            or not isinstance(deadband, (int, float)) or isinstance(deadband, bool) or deadband < 0:
+                        raise cherrypy.HTTPError(400, f"Regola non valida per {sensor_type}: servono field e deadband >= 0")
+                    cfg['sensors'][sensor_type] = {"field": rule['field'], "deadband": deadband}
+                self.catalog.set_value(['edge_filter'], cfg)
+            print(f"[*] Catalog aggiornato: edge_filter {cfg}")
+            return {"status": "success", "edge_filter": cfg}
+
+        if uri[0] == 'uplink':
+            # {"batch": true, "max_delay": 0.2, ...}: i gateway lo ricevono dal change feed
+            with self.catalog.writing():
+                cfg = dict(DEFAULT_UPLINK, **self.catalog.data.get('uplink', {}))
+                for key, value in body.items():
+                    if key not in DEFAULT_UPLINK:
+                        raise cherrypy.HTTPError(400, f"Valore di uplink non valido: {key}")
+                    # batch e compress sono bool, gli altri numeri (un bool non vale come numero)
+                    if isinstance(DEFAULT_UPLINK[key], bool):
+                        valid = isinstance(value, bool)
+                    else:
+                        valid = isinstance(value, (int, float)) and not isinstance(value, bool)
+                    if not valid:
+                        raise cherrypy.HTTPError(400, f"Valore di uplink non valido: {key}")
+                    cfg[key] = value
+                if not 1 <= cfg["max_readings"] <= 65535 or cfg["max_bytes"] <= 0 or cfg["max_delay"] <= 0:
+                    raise cherrypy.HTTPError(400, "max_readings, max_bytes e max_delay devono essere positivi")
+                self.catalog.set_value(['uplink'], cfg)
+            print(f"[*] Catalog aggiornato: uplink {cfg}")
+            return {"status": "success", "uplink": cfg}
+
+        if uri[0] == 'codecs':
+            # {"default": "json"} e/o {"topics": {"poleData": "telemetry"}}; un topic a null torna al default
+            with self.catalog.writing():
+                current = self.catalog.data.get('codecs', DEFAULT_CODECS)
+                codecs = {"default": current.get("default", "json"), "topics": dict(current.get("topics", {}))}
+                if 'default' in body:
+                    if body['default'] not in CODEC_NAMES:
+                        raise cherrypy.HTTPError(400, f"Codec sconosciuto: {body['default']}")
+                    codecs['default'] = body['default']
+                for topic, codec in (body.get('topics') or {}).items():
+                    if codec is None:
+                        codecs['topics'].pop(topic, None)
+                    elif codec not in CODEC_NAMES:
+                        raise cherrypy.HTTPError(400, f"Codec sconosciuto: {codec}")
+                    else:
+                        codecs['topics'][topic] = codec
+                self.catalog.set_value(['codecs'], codecs)
+            print(f"[*] Catalog aggiornato: codecs {codecs}")
+            return {"status": "success", "codecs": codecs}
+
         if uri[0] == 'topic':
             if params:
                 type = params.get('type')
                 try:
                     topics = body.get('new_topics',[])
-                    self.catalog.data['topic'][type]=topics
-                    self.catalog.save()
+                    self.catalog.set_value(['topic', type], topics)
 
                     print(f"[*] Catalog aggiornato: {self.catalog.data['topic'][type]}")
                     return {"status": "success", "message": f"Topics adjourned for {type}"}
@@ -538,8 +1649,14 @@ if __name__ == '__main__':
         }
     }
 
-    catalog = SmartCityCatalog('catalog.json')
-    cherrypy.tree.mount(RootAPI(catalog), '/', conf)
+    # python Catalog1.py [catalog.json | catalog.db]
+    catalog = SmartCityCatalog(sys.argv[1] if len(sys.argv) > 1 else 'catalog.json')
+    liveness = LivenessTracker(catalog)
+    cherrypy.tree.mount(RootAPI(catalog, liveness), '/', conf)
+    cherrypy.engine.subscribe('stop', liveness.stop)
+    cherrypy.engine.subscribe('stop', catalog.save)
+    feed = ChangeFeedPublisher(catalog)
+    cherrypy.engine.subscribe('stop', feed.stop)
 
     cherrypy.config.update({'server.socket_host': '0.0.0.0'})
     cherrypy.config.update({'server.socket_port': 8080})
@@ -0,0 +1,576 @@
+# Variante asyncio di mqtt_client.Client, stesso ciclo di vita:
+# 1. bootstrap dal catalog (GET /bootstrap, copia su disco come Client)
+# 2. POST registrazione nel catalog
+# 3. connessione al central broker: il socket di paho e' guidato dall'event loop
+#    (add_reader/add_writer + loop_misc), nessun thread di rete
+# 4. handler async def: i messaggi entrano in una coda limitata servita da
+#    max_concurrency task consumatori; a coda piena si smette di leggere dal socket
+#    (backpressure verso il broker, come la policy 'block' di MessageDispatcher)
+# 5. change feed del catalog e refresh periodico come task
+#
+# Porting di un servizio: si eredita da AsyncClient invece che da Client,
+# message() diventa async def e quello che nel costruttore leggeva bootstrap_data
+# va in setup(), chiamato da start() dopo il bootstrap.
+#
+# HTTP: il default e' la RestSession sincrona (requests) eseguita con
+# asyncio.to_thread, quindi non serve nessuna dipendenza in piu'. aiohttp e'
+# opzionale: se e' installato (pip install aiohttp) le chiamate diventano native
+# e il pool di connessioni e' condiviso. Il circuit breaker e' comunque quello
+# della RestSession del servizio.
+import asyncio
+import inspect
+import json
+import random
+import socket
+import threading
+import time
+import uuid
+
+import paho.mqtt.client as mqtt
+import requests
+
+from mqtt_client import (Client, ServiceUnavailable, rest_session, _topic_root, log, log_handler_error, CATALOG_SEQ,
+                         DISPATCH_BLOCKED, DISPATCH_DEPTH, MQTT_HANDLER_SECONDS, MQTT_PUBLISHED, MQTT_RECEIVED,
+                         REST_SECONDS)
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+
+class AsyncResponse:
+    """Risposta aiohttp gia' letta, con gli attributi di requests.Response usati dai servizi."""
+    def __init__(self, status_code, headers, content, url):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.url = url
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8', errors='replace')
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise requests.HTTPError(f'{self.status_code} Error for url: {self.url}', response=self)
+
+
+class AsyncRestSession:
+    """
+    Versione async di RestSession: stessi retry (solo metodi idempotenti se non
+    richiesto), stesso backoff con jitter e stesso circuito, condiviso con la
+    sessione sincrona dello stesso servizio.
+    """
+    def __init__(self, base_url, pool_size=100):
+        self.sync = rest_session(base_url)
+        self.base_url = self.sync.base_url
+        self.pool_size = pool_size
+        self._session = None
+
+    def _client_session(self):
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            self._session = aiohttp.ClientSession(connector=connector)
+        return self._session
+
+    def _timeout(self, timeout):
+        timeout = timeout or self.sync.timeout
+        if isinstance(timeout, tuple):
+            return aiohttp.ClientTimeout(sock_connect=timeout[0], sock_read=timeout[1])
+        return aiohttp.ClientTimeout(total=timeout)
+
+    async def request(self, method, path, retry=None, timeout=None, **kwargs):
+        if aiohttp is None:
+            return await asyncio.to_thread(self.sync.request, method, path, retry=retry, timeout=timeout, **kwargs)
+        rest = self.sync
+        if not rest.allow():
+            raise ServiceUnavailable(f'{self.base_url} temporaneamente non disponibile')
+        if retry is None:
+            retry = method in ('GET', 'PUT', 'DELETE', 'HEAD')
+        attempts = 1 + (rest.retries if retry else 0)
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        route = path.lstrip('/').split('/', 1)[0]
+        for attempt in range(attempts):
+            error = None
+            start = time.perf_counter()
+            try:
+                async with self._client_session().request(method, url, timeout=self._timeout(timeout), **kwargs) as r:
+                    response = AsyncResponse(r.status, r.headers, await r.read(), url)
+                REST_SECONDS.observe(time.perf_counter() - start, self.base_url, method, route, response.status_code)
+                if response.status_code not in rest.RETRY_STATUS:
+                    rest.record(True)
+                    return response
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                REST_SECONDS.observe(time.perf_counter() - start, self.base_url, method, route, 'error')
+                error = e
+            except Exception:
+                rest.record(False)
+                raise
+            if attempt + 1 < attempts:
+                await asyncio.sleep(random.uniform(0, min(rest.backoff_max, rest.backoff * 2 ** attempt)))
+        rest.record(False)
+        if error is not None:
+            raise error
+        return response
+
+    async def get(self, path, **kwargs):
+        return await self.request('GET', path, **kwargs)
+
+    async def post(self, path, **kwargs):
+        return await self.request('POST', path, **kwargs)
+
+    async def put(self, path, **kwargs):
+        return await self.request('PUT', path, **kwargs)
+
+    async def delete(self, path, **kwargs):
+        return await self.request('DELETE', path, **kwargs)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
+class AsyncClient():
+    # senza stato di rete: sono gli stessi metodi di Client
+    bootstrap_params = Client.bootstrap_params
+    apply_bootstrap = Client.apply_bootstrap
+    load_bootstrap = Client.load_bootstrap
+    save_bootstrap = Client.save_bootstrap
+    _topic_list = Client._topic_list
+    codec_for = Client.codec_for
+    encode = Client.encode
+    decode = Client.decode
+    start_metrics = Client.start_metrics
+    subscription = Client.subscription
+    _unbatch = Client._unbatch
+    track_batch = Client.track_batch
+
+    refresh_interval = 300
+
+    def __init__(self, catalog_url, type='', max_concurrency=1000, queue_size=10000):
+        self.catalog_url = catalog_url
+        self.http = AsyncRestSession(catalog_url)
+        self.client_id = ''
+        self.broker = {}
+        self.topics = []
+        self.type = type
+        self.client = None   # creato in start(): il client id arriva dal bootstrap
+        self._catalog_cache = {}  # (path, params) -> (ETag, body)
+        self.feed_topic = 'catalog/changes'
+        self.catalog_epoch = None
+        self.catalog_seq = 0
+        self._feed_lock = threading.RLock()  # usato da apply_bootstrap
+        self._feed = asyncio.Lock()
+        self.bootstrap_data = {}
+        self.codecs = {}
+        self.share_group = None
+        self.instance_id = None
+        self._batch_seq = {}
+        self.bootstrap_file = 'bootstrap_' + '_'.join(str(v) for v in self.bootstrap_params().values()) + '.json'
+        # max_concurrency consumatori servono la coda; oltre queue_size messaggi in attesa
+        # si toglie il socket dall'event loop e si riprende a leggere a coda mezza vuota
+        self.max_concurrency = max_concurrency
+        self.queue_size = queue_size
+        self._queue = asyncio.Queue()
+        self._read_fd = None
+        self._read_paused = False
+        self.read_pauses = 0
+        self._tasks = set()
+        self._loop = None
+        self._loop_thread = None
+        self._stopped = None
+
+    # --- catalog ---
+
+    async def request_instance_id(self):
+        try:
+            r = await self.http.post('instance', json={'type': self.type}, retry=False)
+            r.raise_for_status()
+            self.instance_id = r.json()['client_id']
+        except Exception as e:
+            self.instance_id = f'{self.type}-{uuid.uuid4().hex[:8]}'
+            print(f'Impossible POST instance ({e}), id locale {self.instance_id}')
+        self.client_id = self.instance_id
+        print(f'Istanza {self.client_id}, shared subscription {self.share_group}')
+
+    async def register(self):
+        data = {'type': self.type, 'id': self.client_id}
+        try:
+            r = await self.http.post(self.type, json=data, retry=True)
+            print('Registration status code: ', r.status_code)
+        except Exception as e:
+            print('Impossible registration, error: ', e)
+
+    async def get_connection_info(self, use_cache=False):
+        cached = self.load_bootstrap() if use_cache else None
+        try:
+            kwargs = {'timeout': (1, 2), 'retry': False} if cached else {}
+            data = await self.get_catalog('bootstrap', params=list(self.bootstrap_params().items()), **kwargs)
+        except Exception as e:
+            if cached is None:
+                print('GET bootstrap error: ', e)
+                return False
+            print(f'Catalog non raggiungibile ({e}): avvio dal bootstrap salvato, riallineamento in background')
+            self.apply_bootstrap(cached)
+            self.spawn(self._reconcile_bootstrap())
+            return False
+        self.apply_bootstrap(data)
+        self.save_bootstrap(data)
+        return True
+
+    async def _reconcile_bootstrap(self):
+        delay = 1
+        while not await self.get_connection_info():
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+        print('Bootstrap riallineato con il catalog')
+        await self._maybe_await(self.on_catalog_resync())
+
+    async def get_catalog(self, path, params=None, **kwargs):
+        key = (path, tuple(params or ()))
+        cached = self._catalog_cache.get(key)
+        headers = {'If-None-Match': cached[0]} if cached else {}
+        r = await self.http.get(path, params=params, headers=headers, **kwargs)
+        if r.status_code == 304 and cached:
+            return json.loads(cached[1])
+        r.raise_for_status()
+        data = r.json()
+        if r.headers.get('ETag'):
+            self._catalog_cache[key] = (r.headers['ETag'], r.content)
+        return data
+
+    # --- change feed ---
+
+    async def on_catalog_feed(self, client, userdata, msg):
+        try:
+            change = json.loads(msg.payload)
+        except ValueError:
+            return
+        await self.apply_catalog_change(change)
+
+    async def apply_catalog_change(self, change):
+        async with self._feed:
+            if change.get('epoch') != self.catalog_epoch or change['seq'] > self.catalog_seq + 1:
+                await self._catch_up()
+                return
+            if change['seq'] <= self.catalog_seq:
+                return
+            for event in change['events']:
+                await self._maybe_await(self.on_catalog_event(event))
+            self.catalog_seq = change['seq']
+
+    async def catch_up(self):
+        async with self._feed:
+            await self._catch_up()
+
+    async def _catch_up(self):
+        try:
+            r = (await self.http.get('changes', params={'since': self.catalog_seq})).json()
+        except Exception as e:
+            print('Impossible GET catalog changes, error: ', e)
+            return
+        if r.get('resync') or r.get('epoch') != self.catalog_epoch:
+            print('Catalog change feed out of sync, full refresh...')
+            await self._resync()
+            return
+        for change in r['changes']:
+            for event in change['events']:
+                await self._maybe_await(self.on_catalog_event(event))
+            self.catalog_seq = change['seq']
+
+    async def resync(self):
+        async with self._feed:
+            await self._resync()
+
+    async def _resync(self):
+        await self.get_connection_info()
+        await self._maybe_await(self.on_catalog_resync())
+
+    def on_catalog_event(self, event):
+        # come Client.on_catalog_event; le sottoclassi possono ridefinirlo anche async
+        if event['type'] == 'topics_changed' and event['service'] == self.type:
+            old = self._topic_list(self.topics)
+            self.topics = event['topics']
+            if self.client is not None and self.client.is_connected():
+                for topic in self._topic_list(self.topics):
+                    if topic not in old:
+                        self.client.subscribe(self.subscription(topic))
+                for topic in old:
+                    if topic not in self._topic_list(self.topics):
+                        self.client.unsubscribe(self.subscription(topic))
+        elif event['type'] == 'value_changed' and event['path'] == ['central_broker']:
+            self.broker = event['value']
+        elif event['type'] == 'value_changed' and event['path'] == ['codecs']:
+            self.codecs = event['value']
+
+    def on_catalog_resync(self):
+        pass
+
+    async def refresh_get(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            print('Refreshing info from catalog...')
+            try:
+                await self.resync()
+            except Exception as e:
+                print(f"Update failed: {e}")
+
+    # --- MQTT ---
+
+    def _attach_socket(self):
+        # paho non apre thread: l'event loop chiama loop_read/loop_write quando il socket e' pronto.
+        # Le callback possono arrivare dal thread del connect: in quel caso passano da call_soon_threadsafe.
+        # Si usa il numero del descrittore, letto subito: alla chiusura il socket viene chiuso subito dopo
+        loop = self._loop
+        client = self.client
+
+        def in_loop(fn, *args):
+            if threading.get_ident() == self._loop_thread:
+                fn(*args)
+            else:
+                loop.call_soon_threadsafe(fn, *args)
+
+        def on_open(c, userdata, sock):
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 2048 * 1024)
+            in_loop(self._open_reader, sock.fileno())
+
+        def on_close(c, userdata, sock):
+            fd = sock.fileno()
+            in_loop(self._close_reader, fd)
+            in_loop(loop.remove_writer, fd)
+
+        def on_register_write(c, userdata, sock):
+            in_loop(loop.add_writer, sock.fileno(), client.loop_write)
+
+        def on_unregister_write(c, userdata, sock):
+            in_loop(loop.remove_writer, sock.fileno())
+
+        client.on_socket_open = on_open
+        client.on_socket_close = on_close
+        client.on_socket_register_write = on_register_write
+        client.on_socket_unregister_write = on_unregister_write
+
+    def _open_reader(self, fd):
+        # socket nuovo (anche dopo una riconnessione): si legge sempre, la coda decide se fermarsi
+        self._read_fd = fd
+        self._read_paused = False
+        self._loop.add_reader(fd, self.client.loop_read)
+
+    def _close_reader(self, fd):
+        self._loop.remove_reader(fd)
+        if self._read_fd == fd:
+            self._read_fd = None
+
+    def _pause_read(self):
+        # i messaggi restano nel buffer TCP e poi nel broker, che rallenta l'invio
+        self._read_paused = True
+        self.read_pauses += 1
+        if self._read_fd is not None:
+            self._loop.remove_reader(self._read_fd)
+
+    def _resume_read(self):
+        self._read_paused = False
+        if self._read_fd is not None:
+            self._loop.add_reader(self._read_fd, self.client.loop_read)
+
+    async def _misc_loop(self):
+        # keepalive/ping e ritrasmissioni QoS; se la connessione cade si riconnette con backoff
+        delay = 1
+        while True:
+            if self.client.loop_misc() == mqtt.MQTT_ERR_SUCCESS:
+                delay = 1
+                await asyncio.sleep(1)
+                continue
+            await asyncio.sleep(delay)
+            try:
+                print('Reconnecting to broker...')
+                await self._loop.run_in_executor(None, self.client.reconnect)
+            except Exception as e:
+                print('Reconnect failed: ', e)
+                delay = min(delay * 2, 30)
+
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
+        self.spawn(self._maybe_await(self.connect(client, userdata, flags, reason_code, properties)))
+        self.subscribe_catalog_feed(client)
+
+    def subscribe_catalog_feed(self, client):
+        client.subscribe(self.feed_topic, qos=1)
+
+    def connect(self, client, userdata, flags, reason_code, properties):
+        print(f"Connection status: {reason_code}")
+        for topic in self.topics:
+            client.subscribe(self.subscription(topic))
+            print(f"Subscribed to {topic}")
+
+    def disconnect(self, client, userdata, disconnect_flags, reason_code, properties):
+        print('Disconnection code: ', reason_code)
+
+    def _on_message(self, client, userdata, msg):
+        # siamo dentro loop_read, sul thread dell'event loop: si accoda e si torna subito
+        self._enqueue(self.message, client, userdata, msg)
+
+    def _on_feed(self, client, userdata, msg):
+        self._enqueue(self.on_catalog_feed, client, userdata, msg)
+
+    def _enqueue(self, handler, client, userdata, msg):
+        # una loop_read puo' consegnare piu' pacchetti: la coda supera queue_size al massimo di quelli
+        self._queue.put_nowait((handler, client, userdata, msg))
+        if not self._read_paused and self._queue.qsize() >= self.queue_size:
+            self._pause_read()
+
+    async def _consume(self):
+        while True:
+            handler, client, userdata, msg = await self._queue.get()
+            try:
+                await self._handle(handler, client, userdata, msg)
+            finally:
+                self._queue.task_done()
+            if self._read_paused and self._queue.qsize() <= self.queue_size // 2:
+                self._resume_read()
+
+    async def _handle(self, handler, client, userdata, msg):
+        topic = _topic_root(msg.topic)
+        MQTT_RECEIVED.inc(self.client_id, topic)
+        start = time.perf_counter()
+        try:
+            await self._maybe_await(handler(client, userdata, msg))
+        except Exception as e:
+            log_handler_error('Error on mqtt message: %s', e)
+        finally:
+            MQTT_HANDLER_SECONDS.observe(time.perf_counter() - start, self.client_id, topic)
+
+    async def message(self, client, userdata, msg):
+        try:
+            data = self.decode(msg)
+            log.debug('Received data on %s: %s', msg.topic, data)
+        except Exception as e:
+            log_handler_error('Error on mqtt message: %s', e)
+
+    def publish(self, topic, payload, qos=0, retain=False):
+        # non blocca: paho accoda il pacchetto e registra il socket in scrittura
+        if not isinstance(payload, (str, bytes, bytearray)):
+            payload = self.encode(topic, payload)
+        MQTT_PUBLISHED.inc(self.client_id, _topic_root(topic))
+        return self.client.publish(topic, payload, qos=qos, retain=retain)
+
+    async def subscribe(self, topic, qos=0):
+        if topic in self.topics:
+            print(f"Already subscribed to topic {topic}")
+            return
+        try:
+            self.client.subscribe(self.subscription(topic), qos)
+            self.topics.append(topic)
+            await self.http.put('topic', params=[('type', self.type)], json={'new_topics': self.topics})
+            print(f'Successfully subscribed to {topic}')
+        except Exception as e:
+            print('Impossible to subscribe, error: ', e)
+
+    async def unsubscribe(self, topic):
+        if topic not in self.topics:
+            print(f"Topic {topic} not found in subscription list.")
+            return
+        try:
+            self.client.unsubscribe(self.subscription(topic))
+            self.topics.remove(topic)
+            await self.http.put('topic', params=[('type', self.type)], json={'new_topics': self.topics})
+            print(f'Successfully unsubscribed from {topic}')
+        except Exception as e:
+            print('Impossible to unsubscribe, error: ', e)
+
+    # --- ciclo di vita ---
+
+    def spawn(self, coro):
+        # si tiene un riferimento ai task finche' non finiscono (asyncio tiene solo weakref)
+        task = self._loop.create_task(coro)
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return task
+
+    async def _maybe_await(self, result):
+        if inspect.isawaitable(result):
+            return await result
+        return result
+
+    async def setup(self):
+        # le sottoclassi leggono qui bootstrap_data (come Client.setup)
+        pass
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._stopped = asyncio.Event()
+        await self.get_connection_info(use_cache=True)
+        while not self.broker:
+            print('Catalog non raggiungibile e nessun bootstrap salvato, nuovo tentativo tra 5s...')
+            await asyncio.sleep(5)
+            await self.get_connection_info()
+        if self.share_group:
+            await self.request_instance_id()
+        await self.setup()
+        CATALOG_SEQ.set_function(lambda: self.catalog_seq, self.client_id)
+        DISPATCH_DEPTH.set_function(self._queue.qsize, self.client_id)
+        DISPATCH_BLOCKED.set_function(lambda: self.read_pauses, self.client_id)
+        self.start_metrics()
+
+        self.client = mqtt.Client(
+            callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
+            client_id=self.client_id
+        )
+        self.client.on_connect = self._on_connect
+        self.client.on_message = self._unbatch(self._on_message)
+        self.client.message_callback_add(self.feed_topic, self._on_feed)
+        self.client.on_disconnect = self.disconnect
+        self._attach_socket()
+
+        await self.register()
+        # il connect TCP e' bloccante: nel thread pool, l'event loop resta libero
+        await self._loop.run_in_executor(None, self.client.connect, self.broker['address'], int(self.broker['port']))
+        for _ in range(self.max_concurrency):
+            self.spawn(self._consume())
+        self.spawn(self._misc_loop())
+        self.spawn(self.refresh_get())
+        print("MQTT event loop integration started.")
+
+    async def stop(self):
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        if self.client is not None:
+            self.client.disconnect()
+        await self.http.close()
+        if self._stopped is not None:
+            self._stopped.set()
+
+    async def run(self):
+        # start + attesa fino a stop() (o Ctrl-C)
+        await self.start()
+        try:
+            await self._stopped.wait()
+        finally:
+            if not self._stopped.is_set():
+                await self.stop()
+
+
+# --- MAIN BLOCK ---
+if __name__ == '__main__':
+    async def main():
+        mqtt_client = AsyncClient('http://localhost:8080', 'dashboard')
+        await mqtt_client.start()
+        await asyncio.sleep(2)
+        await mqtt_client.subscribe('ciao')
+        await asyncio.sleep(5)
+        await mqtt_client.unsubscribe('ciao')
+        try:
+            await mqtt_client._stopped.wait()
+        finally:
+            await mqtt_client.stop()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        print("Shutting down...")
@@ -0,0 +1,139 @@
+# Stress test del catalog: N thread lettori su snapshot() mentre M writer
+# registrano/cancellano pali. Controlla che ogni snapshot letto sia coerente
+# (indici == liste, nessun palo duplicato o perso) e misura le letture/s.
+# Poi misura la latenza di un commit (add_pole/remove_pole) al crescere della
+# flotta: con il copy-on-write a bucket deve restare quasi costante.
+#
+#   python bench_catalog_concurrency.py [--readers 1 2 4 8] [--writers 2] [--seconds 3]
+#                                       [--fleet 1000 10000 100000] [--commits 2000]
+#
+# Nota: con il GIL i lettori non scalano linearmente sulla CPU; quello che
+# conta e' che non vengano bloccati dai writer e che non vedano stati a meta'.
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from Catalog1 import SmartCityCatalog
+
+
+def build_catalog(n_gateways, poles_per_gateway, snapshot_interval=1, snapshot_every=1000):
+    tmp = tempfile.mkdtemp()
+    catalog = SmartCityCatalog(os.path.join(tmp, 'catalog.json'), snapshot_interval=snapshot_interval,
+                               snapshot_every=snapshot_every)
+    gateways = []
+    for g in range(n_gateways):
+        poles = [{"id": f"pole_{g}_{k}", "gateway_id": f"gateway_{g}", "lat": 45.0, "long": 7.0}
+                 for k in range(poles_per_gateway)]
+        gateways.append({"gateway_id": f"gateway_{g}", "zone": f"zone_{g}", "smart_poles": poles})
+    catalog._reset(dict(catalog.data, gateways=gateways))
+    return catalog
+
+
+def check_snapshot(snap):
+    # ogni palo nelle liste e' nell'indice, sotto il gateway giusto e nella posizione giusta
+    count = 0
+    for gw in snap.data["gateways"]:
+        gateway_id = gw["gateway_id"]
+        if snap.gateways.get(gateway_id) is not gw:
+            return f"gateway {gateway_id} non indicizzato"
+        for k, pole in enumerate(gw["smart_poles"]):
+            owner, indexed = snap.find_pole(pole["id"])
+            if indexed is not pole or owner is not gw or snap.pole_slots[pole["id"]] != k:
+                return f"palo {pole['id']} non coerente"
+            count += 1
+    if count != len(snap.poles):
+        return f"{len(snap.poles)} pali nell'indice, {count} nelle liste"
+    return None
+
+
+def run(catalog, n_readers, n_writers, seconds):
+    stop = threading.Event()
+    reads = [0] * n_readers
+    writes = [0] * n_writers
+    errors = []
+    pole_ids = list(catalog.snapshot().poles)
+
+    def reader(i):
+        k = 0
+        while not stop.is_set():
+            snap = catalog.snapshot()
+            snap.find_pole(pole_ids[k % len(pole_ids)])
+            snap.list_poles(gateway_id=f"gateway_{k % 10}", limit=20)
+            if k % 200 == 0:
+                error = check_snapshot(snap)
+                if error:
+                    errors.append(error)
+            k += 1
+        reads[i] = k
+
+    def writer(i):
+        gateway_id = f"gateway_{i % 10}"
+        k = 0
+        while not stop.is_set():
+            pole_id = f"stress_{i}_{k % 50}"
+            if catalog.snapshot().find_pole(pole_id)[1] is None:
+                catalog.add_pole(gateway_id, {"id": pole_id, "gateway_id": gateway_id, "lat": 45.0, "long": 7.0})
+            else:
+                catalog.remove_pole(pole_id)
+            k += 1
+        writes[i] = k
+
+    threads = [threading.Thread(target=reader, args=(i,)) for i in range(n_readers)]
+    threads += [threading.Thread(target=writer, args=(i,)) for i in range(n_writers)]
+    for t in threads:
+        t.start()
+    time.sleep(seconds)
+    stop.set()
+    for t in threads:
+        t.join()
+
+    error = check_snapshot(catalog.snapshot())
+    if error:
+        errors.append(error)
+    return sum(reads) / seconds, sum(writes) / seconds, errors
+
+
+def write_latency(n_poles, poles_per_gateway, commits):
+    # ms medi per commit, un palo aggiunto e poi tolto su un gateway esistente
+    # niente compattazione durante la misura: lo snapshot su disco e' O(flotta) per costruzione
+    catalog = build_catalog(max(1, n_poles // poles_per_gateway), poles_per_gateway,
+                            snapshot_interval=3600, snapshot_every=10 ** 9)
+    start = time.perf_counter()
+    for k in range(commits // 2):
+        gateway_id = f"gateway_{k % 10}"
+        catalog.add_pole(gateway_id, {"id": f"latency_{k}", "gateway_id": gateway_id, "lat": 45.0, "long": 7.0})
+        catalog.remove_pole(f"latency_{k}")
+    elapsed = time.perf_counter() - start
+    error = check_snapshot(catalog.snapshot())
+    return elapsed / commits * 1000, error
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--readers', type=int, nargs='+', default=[1, 2, 4, 8])
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--gateways', type=int, default=100)
+    parser.add_argument('--poles-per-gateway', type=int, default=100)
+    parser.add_argument('--seconds', type=float, default=3)
+    parser.add_argument('--fleet', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--commits', type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"{'readers':>8} {'reads/s':>10} {'writes/s':>9} {'errors':>7}")
+    for n in args.readers:
+        catalog = build_catalog(args.gateways, args.poles_per_gateway)
+        reads, writes, errors = run(catalog, n, args.writers, args.seconds)
+        print(f"{n:>8} {reads:>10.0f} {writes:>9.0f} {len(errors):>7}")
+        for error in errors[:5]:
+            print('   ', error)
+
+    print(f"\n{'pali':>8} {'ms/commit':>10}")
+    for n in args.fleet:
+        ms, error = write_latency(n, args.poles_per_gateway, args.commits)
+        print(f"{n:>8} {ms:>10.4f}" + (f"  {error}" if error else ''))
+
+
+if __name__ == '__main__':
+    main()
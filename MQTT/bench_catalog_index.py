@@ -0,0 +1,57 @@
+# Benchmark dei lookup del catalog: la latenza deve restare piatta
+# passando da 100 a 100k pali (indici dict invece di scansioni lineari).
+#
+#   python bench_catalog_index.py [--poles 100 1000 10000 100000] [--lookups 20000]
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from Catalog1 import SmartCityCatalog
+
+
+def build_catalog(n_poles, poles_per_gateway=100):
+    tmp = tempfile.mkdtemp()
+    catalog = SmartCityCatalog(os.path.join(tmp, 'catalog.json'))
+    gateways = []
+    for g in range((n_poles + poles_per_gateway - 1) // poles_per_gateway):
+        gw_id = f"gateway_{g}"
+        poles = [
+            {"id": f"PolePublisher_{g}_{k}", "lat": 45.0, "long": 7.0, "region": f"zone_{g}"}
+            for k in range(min(poles_per_gateway, n_poles - g * poles_per_gateway))
+        ]
+        gateways.append({"gateway_id": gw_id, "zone": f"zone_{g}", "smart_poles": poles})
+    catalog._reset(dict(catalog.data, gateways=gateways))
+    return catalog
+
+
+def time_per_call(fn, keys):
+    start = time.perf_counter()
+    for k in keys:
+        fn(k)
+    return (time.perf_counter() - start) / len(keys) * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--poles', type=int, nargs='+', default=[100, 1000, 10000, 100000])
+    parser.add_argument('--lookups', type=int, default=20000)
+    args = parser.parse_args()
+
+    print(f"{'poles':>8} {'pole_status us':>15} {'gateway us':>11} {'zone us':>8}")
+    for n in args.poles:
+        catalog = build_catalog(n)
+        snap = catalog.snapshot()
+        pole_ids = random.choices(list(snap.poles), k=args.lookups)
+        gw_ids = random.choices(list(snap.gateways), k=args.lookups)
+        zones = random.choices(list(snap.zones), k=args.lookups)
+
+        t_pole = time_per_call(lambda p: catalog._find_pole(p)[1] is not None, pole_ids)
+        t_gw = time_per_call(catalog._find_gateway, gw_ids)
+        t_zone = time_per_call(catalog.gateway_in_zone, zones)
+        print(f"{n:>8} {t_pole:>15.3f} {t_gw:>11.3f} {t_zone:>8.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,235 @@
+# Load test del catalog con il mix di chiamate prodotto dai servizi:
+#   pole_status - gateway, una GET per ogni messaggio dati
+#   register    - raffiche di registrazioni (POST /pole batch da register_new_pole)
+#   gateways    - dashboard, polling di /gateways ogni 5 secondi
+#   bootstrap   - ogni Client all'avvio/refresh: GET /bootstrap?type=... (lat/lon per i gateway)
+#
+# Il catalog gira in-process su localhost con una flotta sintetica; il risultato
+# (throughput e p50/p95/p99 per route) e' JSON, per confrontare run diverse.
+#
+#   python bench_catalog_load.py [--gateways 100] [--poles-per-gateway 100] [--threads 8]
+#                                [--seconds 10] [--mix pole_status=85,register=2,gateways=5,bootstrap=8]
+#                                [--storage json|sqlite] [--out result.json] [--compare baseline.json]
+import argparse
+import json
+import math
+import os
+import platform
+import random
+import tempfile
+import threading
+import time
+
+import cherrypy
+import requests
+
+from Catalog1 import SmartCityCatalog, RootAPI
+
+DEFAULT_MIX = "pole_status=85,register=2,gateways=5,bootstrap=8"
+SERVICES = ["computeDecay", "checkThreshold", "dashboard", "gateway"]
+
+
+def start_catalog(args):
+    tmp = tempfile.mkdtemp()
+    filename = os.path.join(tmp, 'catalog.db' if args.storage == 'sqlite' else 'catalog.json')
+    catalog = SmartCityCatalog(filename)
+    gateways = []
+    for g in range(args.gateways):
+        poles = [{"id": f"pole_{g}_{k}", "gateway_id": f"gateway_{g}", "lat": 45.0 + k / 1000, "long": 7.0 + g / 100,
+                  "region": f"zone_{g}"} for k in range(args.poles_per_gateway)]
+        gateways.append({"gateway_id": f"gateway_{g}", "zone": f"zone_{g}", "smart_poles": poles})
+    catalog._reset(dict(catalog.data, gateways=gateways))
+    catalog.storage.write_all(catalog.data)
+
+    conf = {'/': {'request.dispatch': cherrypy.dispatch.MethodDispatcher()}}
+    cherrypy.tree.mount(RootAPI(catalog), '/', conf)
+    cherrypy.config.update({
+        'server.socket_host': '127.0.0.1',
+        'server.socket_port': args.port,
+        'server.thread_pool': max(10, args.threads * 2),
+        'log.screen': False,
+        'engine.autoreload.on': False,
+    })
+    cherrypy.engine.start()
+    cherrypy.engine.wait(cherrypy.engine.states.STARTED)
+    return catalog
+
+
+def parse_mix(text):
+    mix = {}
+    for item in text.split(','):
+        name, weight = item.split('=')
+        mix[name.strip()] = float(weight)
+    return mix
+
+
+class Worker(threading.Thread):
+    def __init__(self, n, url, args, mix, stop):
+        super().__init__(daemon=True)
+        self.url = url
+        self.args = args
+        self.names = list(mix)
+        self.weights = [mix[k] for k in self.names]
+        self.stop = stop
+        self.rng = random.Random(args.seed + n)
+        self.session = requests.Session()
+        self.n = n
+        self.samples = {}    # route -> [latenze in secondi]
+        self.errors = {}
+        self.registered = 0
+
+    def timed(self, route, method, path, **kwargs):
+        start = time.perf_counter()
+        try:
+            r = self.session.request(method, self.url + path, timeout=10, **kwargs)
+            ok = r.status_code < 400
+        except requests.RequestException:
+            ok = False
+        elapsed = time.perf_counter() - start
+        if ok:
+            self.samples.setdefault(route, []).append(elapsed)
+        else:
+            self.errors[route] = self.errors.get(route, 0) + 1
+
+    def run(self):
+        args = self.args
+        while not self.stop.is_set():
+            kind = self.rng.choices(self.names, self.weights)[0]
+            if kind == 'pole_status':
+                g = self.rng.randrange(args.gateways)
+                k = self.rng.randrange(args.poles_per_gateway)
+                self.timed('GET /pole_status', 'GET', f'/pole_status/pole_{g}_{k}')
+            elif kind == 'register':
+                g = self.rng.randrange(args.gateways)
+                poles = [{"id": f"burst_{self.n}_{self.registered + i}", "lat": 45.0, "long": 7.0}
+                         for i in range(args.burst)]
+                self.registered += args.burst
+                self.timed('POST /pole', 'POST', '/pole', json={"gateway_id": f"gateway_{g}", "poles": poles})
+            elif kind == 'gateways':
+                self.timed('GET /gateways', 'GET', '/gateways')
+            elif kind == 'bootstrap':
+                service = self.rng.choice(SERVICES)
+                params = {'type': service}
+                if service == 'gateway':
+                    g = self.rng.randrange(args.gateways)
+                    params.update(lat=45.0, lon=7.0 + g / 100)
+                self.timed('GET /bootstrap', 'GET', '/bootstrap', params=params)
+
+
+def percentile(sorted_values, p):
+    # nearest-rank
+    if not sorted_values:
+        return None
+    k = max(0, math.ceil(p / 100 * len(sorted_values)) - 1)
+    return sorted_values[k]
+
+
+def summarize(workers, seconds):
+    routes = {}
+    for w in workers:
+        for route, values in w.samples.items():
+            routes.setdefault(route, {"samples": [], "errors": 0})["samples"].extend(values)
+        for route, count in w.errors.items():
+            routes.setdefault(route, {"samples": [], "errors": 0})["errors"] += count
+
+    result = {}
+    total = 0
+    for route, r in sorted(routes.items()):
+        values = sorted(r["samples"])
+        total += len(values)
+        result[route] = {
+            "requests": len(values),
+            "errors": r["errors"],
+            "throughput_rps": round(len(values) / seconds, 1),
+            "p50_ms": round(percentile(values, 50) * 1000, 3) if values else None,
+            "p95_ms": round(percentile(values, 95) * 1000, 3) if values else None,
+            "p99_ms": round(percentile(values, 99) * 1000, 3) if values else None,
+            "max_ms": round(values[-1] * 1000, 3) if values else None,
+        }
+    return total, result
+
+
+def compare(result, baseline):
+    # variazione percentuale per route rispetto alla run di riferimento (positivo = piu' lento)
+    print(f"{'route':<22} {'p50 %':>8} {'p95 %':>8} {'p99 %':>8} {'rps %':>8}")
+    for route, now in result["routes"].items():
+        before = baseline["routes"].get(route)
+        if not before:
+            continue
+        deltas = []
+        for key in ("p50_ms", "p95_ms", "p99_ms", "throughput_rps"):
+            if now[key] is None or not before[key]:
+                deltas.append("-")
+            else:
+                deltas.append(f"{(now[key] - before[key]) / before[key] * 100:+.1f}")
+        print(f"{route:<22} {deltas[0]:>8} {deltas[1]:>8} {deltas[2]:>8} {deltas[3]:>8}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--gateways', type=int, default=100)
+    parser.add_argument('--poles-per-gateway', type=int, default=100)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--warmup', type=float, default=1)
+    parser.add_argument('--mix', default=DEFAULT_MIX)
+    parser.add_argument('--burst', type=int, default=20, help='pali per POST /pole di registrazione')
+    parser.add_argument('--storage', choices=['json', 'sqlite'], default='json')
+    parser.add_argument('--port', type=int, default=18090)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--out', help='file JSON dove salvare il risultato (default: stdout)')
+    parser.add_argument('--compare', help='risultato JSON di una run precedente da confrontare')
+    args = parser.parse_args()
+    mix = parse_mix(args.mix)
+
+    catalog = start_catalog(args)
+    url = f'http://127.0.0.1:{args.port}'
+    try:
+        if args.warmup:
+            stop = threading.Event()
+            warm = [Worker(1000 + i, url, args, mix, stop) for i in range(args.threads)]
+            for w in warm:
+                w.start()
+            time.sleep(args.warmup)
+            stop.set()
+            for w in warm:
+                w.join()
+
+        stop = threading.Event()
+        workers = [Worker(i, url, args, mix, stop) for i in range(args.threads)]
+        start = time.perf_counter()
+        for w in workers:
+            w.start()
+        time.sleep(args.seconds)
+        stop.set()
+        for w in workers:
+            w.join()
+        elapsed = time.perf_counter() - start
+    finally:
+        cherrypy.engine.exit()
+
+    total, routes = summarize(workers, elapsed)
+    result = {
+        "config": {k: v for k, v in vars(args).items() if k != 'out'},
+        "python": platform.python_version(),
+        "fleet_poles": args.gateways * args.poles_per_gateway,
+        "duration_s": round(elapsed, 3),
+        "total_requests": total,
+        "throughput_rps": round(total / elapsed, 1),
+        "catalog_version": catalog.version,
+        "routes": routes,
+    }
+    text = json.dumps(result, indent=2)
+    if args.out:
+        with open(args.out, 'w') as f:
+            f.write(text)
+        print(f"Risultato salvato in {args.out}")
+    else:
+        print(text)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(result, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,87 @@
+# Confronto tra i backend di storage del catalog (JSON + journal vs SQLite):
+# tempo di avvio, latenza di commit (registrazione/cancellazione palo) e
+# dimensione su disco, per flotte di dimensione crescente.
+# "load s" cresce con la flotta per entrambi i backend (load() legge tutti i
+# pali) ed e' piu' alto con SQLite; SQLite conviene sul commit/salvataggio.
+#
+#   python bench_catalog_storage.py [--poles 1000 10000 100000] [--commits 2000]
+import argparse
+import os
+import tempfile
+import time
+
+from Catalog1 import SmartCityCatalog
+from catalog_storage import open_storage
+
+SENSORS = [
+    {"sensor_type": "thermometer", "unit": "Celsius"},
+    {"sensor_type": "hygrometer", "unit": "%"},
+    {"sensor_type": "accelerometer", "unit": "degrees"},
+]
+
+
+def fleet(n_poles, poles_per_gateway=100):
+    catalog = SmartCityCatalog(os.path.join(tempfile.mkdtemp(), 'catalog.json'))
+    data = dict(catalog.data)
+    data["gateways"] = []
+    for g in range((n_poles + poles_per_gateway - 1) // poles_per_gateway):
+        gw_id = f"gateway_{g}"
+        poles = [
+            {"id": f"PolePublisher_{g}_{k}", "gateway_id": gw_id, "lat": 45.0 + k / 1000, "long": 7.0,
+             "region": f"zone_{g}", "topic": f"poleData/zone_{g}/PolePublisher_{g}_{k}", "sensors": SENSORS}
+            for k in range(min(poles_per_gateway, n_poles - g * poles_per_gateway))
+        ]
+        data["gateways"].append({"gateway_id": gw_id, "zone": f"zone_{g}", "smart_poles": poles})
+    return data
+
+
+def size(filename):
+    return sum(os.path.getsize(p) for p in (filename, filename + '.journal', filename + '-wal')
+               if os.path.exists(p))
+
+
+def bench(data, filename, commits):
+    storage = open_storage(filename)
+    storage.write_all(data)
+    storage.close()
+
+    start = time.perf_counter()
+    catalog = SmartCityCatalog(filename, snapshot_interval=3600)
+    t_load = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for k in range(commits):
+        pole_id = f"bench_{k % 100}"
+        if k % 2 == 0:
+            catalog.add_pole("gateway_0", {"id": pole_id, "gateway_id": "gateway_0", "lat": 45.0, "long": 7.0,
+                                           "sensors": SENSORS})
+        else:
+            catalog.remove_pole(pole_id)
+    t_commit = (time.perf_counter() - start) / commits * 1e6
+
+    start = time.perf_counter()
+    catalog.save()
+    t_save = time.perf_counter() - start
+    return t_load, t_commit, t_save, size(filename)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--poles', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--commits', type=int, default=2000)
+    args = parser.parse_args()
+
+    rows = []
+    for n in args.poles:
+        data = fleet(n)
+        tmp = tempfile.mkdtemp()
+        for backend, name in (("json", "catalog.json"), ("sqlite", "catalog.db")):
+            rows.append((n, backend) + bench(data, os.path.join(tmp, name), args.commits))
+
+    print(f"{'poles':>8} {'backend':>8} {'load s':>8} {'commit us':>10} {'save s':>8} {'disk KB':>9}")
+    for n, backend, t_load, t_commit, t_save, disk in rows:
+        print(f"{n:>8} {backend:>8} {t_load:>8.3f} {t_commit:>10.1f} {t_save:>8.3f} {disk / 1024:>9.0f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+# Micro-benchmark dei codec dei payload MQTT: costo di encode/decode e
+# dimensione per lettura di un palo (il messaggio dati di PolePublisher).
+#
+#   python bench_codecs.py [--readings 100000]
+#
+# "json (stdlib)" e' il json.dumps/json.loads usato finora da tutti i servizi;
+# i codec non disponibili (libreria opzionale mancante) vengono saltati.
+import argparse
+import json
+import random
+import time
+
+from mqtt_client import CODECS, JsonCodec, decode_payload, encode_payload, msgpack, _fast_json
+
+
+def readings(n):
+    rng = random.Random(1)
+    out = []
+    for k in range(n):
+        pole_id = f"PolePublisher_{45 + rng.random():.4f}_{7 + rng.random():.4f}"
+        out.append({
+            "id": pole_id,
+            "timestamp": 1760000000 + k,
+            "temperature": round(rng.uniform(20.0, 25.0), 2),
+            "humidity": int(rng.uniform(40, 60)),
+            "tilt": round(rng.uniform(0.0, 5.0), 2),
+            "topic": f"poleData/Piemonte/{pole_id}",
+        })
+    return out
+
+
+class StdlibJson(JsonCodec):
+    name = 'json (stdlib)'
+
+    def encode(self, obj):
+        return json.dumps(obj).encode('utf-8')
+
+    def decode(self, payload):
+        return json.loads(payload.decode('utf-8'))
+
+
+def bench(codec, data):
+    start = time.perf_counter()
+    encoded = [codec.encode(obj) for obj in data]
+    t_enc = time.perf_counter() - start
+    start = time.perf_counter()
+    for payload in encoded:
+        codec.decode(payload)
+    t_dec = time.perf_counter() - start
+    size = sum(len(p) for p in encoded) / len(encoded)
+    return t_enc / len(data) * 1e6, t_dec / len(data) * 1e6, size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--readings', type=int, default=100000)
+    args = parser.parse_args()
+    data = readings(args.readings)
+
+    # i codec binari devono restituire la stessa lettura (a meno dei float32 del record telemetry)
+    for obj in data[:100]:
+        assert decode_payload(encode_payload(obj, 'telemetry')) == obj
+
+    codecs = [('json (stdlib)', StdlibJson())]
+    codecs.append(('json (orjson)' if _fast_json else 'json', CODECS['json']))
+    if msgpack is not None:
+        codecs.append(('msgpack', CODECS['msgpack']))
+    else:
+        print("msgpack non installato: codec saltato")
+    codecs.append(('telemetry', CODECS['telemetry']))
+
+    print(f"{'codec':<16} {'encode us':>10} {'decode us':>10} {'bytes':>7}")
+    for name, codec in codecs:
+        t_enc, t_dec, size = bench(codec, data)
+        print(f"{name:<16} {t_enc:>10.3f} {t_dec:>10.3f} {size:>7.1f}")
+
+
+if __name__ == '__main__':
+    main()
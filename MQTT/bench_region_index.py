@@ -0,0 +1,47 @@
+# Benchmark dell'assegnazione regione: scansione lineare (vecchio get_region),
+# griglia RegionIndex punto per punto e lookup_many vettoriale.
+#
+#   python bench_region_index.py [--points 100000]
+import argparse
+import random
+import time
+
+from regions import ITALIAN_REGIONS, RegionIndex, np
+
+
+def linear_scan(lat, lon, regions):
+    for region_name, bounds in regions.items():
+        if bounds["minLat"] <= lat <= bounds["maxLat"] and bounds["minLon"] <= lon <= bounds["maxLon"]:
+            return region_name
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--points', type=int, default=100000)
+    args = parser.parse_args()
+
+    points = [(random.uniform(36.5, 47.2), random.uniform(6.5, 18.6)) for _ in range(args.points)]
+    index = RegionIndex(ITALIAN_REGIONS)
+
+    start = time.perf_counter()
+    [linear_scan(lat, lon, ITALIAN_REGIONS) for lat, lon in points]
+    t_linear = time.perf_counter() - start
+
+    start = time.perf_counter()
+    grid = [index.lookup(lat, lon) for lat, lon in points]
+    t_grid = time.perf_counter() - start
+
+    start = time.perf_counter()
+    batch = index.lookup_many(points)
+    t_batch = time.perf_counter() - start
+
+    assert grid == batch, "lookup e lookup_many non coincidono"
+    print(f"points: {args.points}  (numpy: {'si' if np is not None else 'no'})")
+    print(f"linear scan : {t_linear:8.3f} s")
+    print(f"grid lookup : {t_grid:8.3f} s")
+    print(f"lookup_many : {t_batch:8.3f} s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,99 @@
+# Throughput di un servizio di analisi con 1, 2, 4... istanze in una
+# shared subscription ($share/<gruppo>/poleData/#): un publisher manda
+# --messages letture, ogni istanza (un processo) le consuma con un costo
+# per messaggio simulato, si misura il tempo fino all'ultimo messaggio.
+#
+#   python bench_shared_subscription.py [--host localhost --port 1883]
+#                                       [--messages 5000] [--work io|cpu] [--ms 2]
+#
+# --work io  simula la POST al writer (attesa): scala anche su un solo core
+# --work cpu simula calcolo: scala fino al numero di core della macchina
+# Serve un broker con shared subscription MQTT (mosquitto >= 1.6, EMQX, ...).
+import argparse
+import json
+import multiprocessing
+import time
+import uuid
+
+import paho.mqtt.client as mqtt
+
+GROUP = 'bench'
+TOPIC = 'bench/poleData'
+
+
+def worker(args, ready, done, counts, index):
+    got = 0
+
+    def on_message(client, userdata, msg):
+        nonlocal got
+        json.loads(msg.payload)
+        if args.work == 'cpu':
+            end = time.perf_counter() + args.ms / 1000
+            while time.perf_counter() < end:
+                pass
+        else:
+            time.sleep(args.ms / 1000)
+        got += 1
+        counts[index] = got
+
+    client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
+                         client_id=f'bench-{uuid.uuid4().hex[:8]}')
+    client.on_message = on_message
+    client.on_connect = lambda c, u, f, rc, p: c.subscribe(f'$share/{GROUP}/{TOPIC}/#', 1)
+    client.on_subscribe = lambda c, u, mid, rc, p: ready.release()
+    client.connect(args.host, args.port)
+    client.loop_start()
+    done.wait()
+    client.loop_stop()
+    client.disconnect()
+
+
+def run(args, instances):
+    ready = multiprocessing.Semaphore(0)
+    done = multiprocessing.Event()
+    counts = multiprocessing.Array('i', instances)
+    procs = [multiprocessing.Process(target=worker, args=(args, ready, done, counts, k)) for k in range(instances)]
+    for p in procs:
+        p.start()
+    for _ in procs:
+        ready.acquire()
+
+    pub = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION2, client_id=f'bench-pub-{uuid.uuid4().hex[:8]}')
+    pub.connect(args.host, args.port)
+    pub.loop_start()
+    start = time.perf_counter()
+    for k in range(args.messages):
+        pub.publish(f'{TOPIC}/pole_{k % 100}', json.dumps({'id': f'pole_{k % 100}', 'timestamp': k, 'tilt': 1.0}), qos=1)
+    while sum(counts) < args.messages and time.perf_counter() - start < args.timeout:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    received = sum(counts)
+    done.set()
+    for p in procs:
+        p.join(5)
+        if p.is_alive():
+            p.terminate()
+    pub.loop_stop()
+    pub.disconnect()
+    return received, elapsed, list(counts)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='localhost')
+    parser.add_argument('--port', type=int, default=1883)
+    parser.add_argument('--messages', type=int, default=5000)
+    parser.add_argument('--work', choices=('io', 'cpu'), default='io')
+    parser.add_argument('--ms', type=float, default=2.0, help='costo per messaggio in millisecondi')
+    parser.add_argument('--instances', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--timeout', type=float, default=120)
+    args = parser.parse_args()
+
+    print(f"{'istanze':>8} {'msg/s':>10} {'ricevuti':>9}  per istanza")
+    for n in args.instances:
+        received, elapsed, counts = run(args, n)
+        print(f"{n:>8} {received / elapsed:>10.0f} {received:>9}  {counts}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+# Uplink gateway -> broker centrale: messaggi e byte sul filo per le stesse
+# letture inoltrate una per messaggio o a blocchi (UplinkBatcher + pack_batch),
+# e costo di unpack_batch lato consumer.
+#
+#   python bench_uplink_batching.py [--readings 20000] [--codec json] [--max-readings 200]
+#
+# I byte contano il pacchetto PUBLISH QoS 1 (header fisso, topic, packet id,
+# payload) e il PUBACK di ritorno, senza TCP/TLS.
+import argparse
+import time
+
+from bench_codecs import readings
+from gatewaySubscriber import UplinkBatcher
+from mqtt_client import encode_payload, unpack_batch
+
+GATEWAY_ID = 'gateway_45.07.0'
+PUBACK = 4
+
+
+def publish_size(topic, payload):
+    body = 2 + len(topic.encode('utf-8')) + 2 + len(payload)
+    length = 1
+    while body >= 128 ** length:
+        length += 1
+    return 1 + length + body + PUBACK
+
+
+def forwarded(data, codec):
+    # cio' che il gateway inoltra: topic centrale e payload nel codec del catalog
+    return [(f"{obj['topic']}/{GATEWAY_ID}", encode_payload(obj, codec)) for obj in data]
+
+
+def single(messages):
+    return len(messages), sum(publish_size(t, p) for t, p in messages)
+
+
+def batched(messages, max_readings, compress):
+    sent = []
+    batcher = UplinkBatcher(lambda root, seq, payload, entries: sent.append((f'{root}/{GATEWAY_ID}', payload)),
+                            max_readings=max_readings, max_bytes=1 << 30, max_delay=3600, compress=compress)
+    start = time.perf_counter()
+    for topic, payload in messages:
+        batcher.add(topic.split('/', 1)[0], topic, payload)
+    batcher.stop()
+    t_pack = time.perf_counter() - start
+    start = time.perf_counter()
+    unpacked = sum(len(unpack_batch(payload)[1]) for _, payload in sent)
+    t_unpack = time.perf_counter() - start
+    assert unpacked == len(messages)
+    return len(sent), sum(publish_size(t, p) for t, p in sent), t_pack, t_unpack
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--readings', type=int, default=20000)
+    parser.add_argument('--codec', default='json')
+    parser.add_argument('--max-readings', type=int, nargs='+', default=[50, 200])
+    args = parser.parse_args()
+    messages = forwarded(readings(args.readings), args.codec)
+
+    n, size = single(messages)
+    print(f"{'uplink':<22} {'messaggi':>9} {'byte':>11} {'byte/lettura':>13} {'pack us':>8} {'unpack us':>10}")
+    print(f"{'una lettura/messaggio':<22} {n:>9} {size:>11} {size / len(messages):>13.1f} {'-':>8} {'-':>10}")
+    for max_readings in args.max_readings:
+        for compress in (False, True):
+            n, size, t_pack, t_unpack = batched(messages, max_readings, compress)
+            name = f"batch {max_readings}" + (" zlib" if compress else "")
+            print(f"{name:<22} {n:>9} {size:>11} {size / len(messages):>13.1f} "
+                  f"{t_pack / len(messages) * 1e6:>8.2f} {t_unpack / len(messages) * 1e6:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,263 @@
+# Storage del catalog: SmartCityCatalog tiene in memoria lo snapshot corrente
+# e delega qui solo la persistenza. Due backend con la stessa interfaccia:
+#
+#   JsonStorage   - catalog.json compattato + journal append-only delle op
+#   SqliteStorage - tabelle gateways/poles/sensors/config, una transazione per commit
+#
+# open_storage() sceglie il backend dall'estensione del file (.db/.sqlite -> SQLite).
+#
+# Si passa da un backend all'altro con migrate_catalog.py.
+#
+# Lo storage e' solo persistenza: il catalog resta tutto in memoria e le
+# richieste HTTP leggono dallo snapshot, con entrambi i backend. SQLite salva
+# per righe (un commit scrive solo quelle cambiate, niente journal da
+# compattare) ma l'avvio e' piu' lento di JSON: load() ricostruisce la flotta
+# riga per riga (vedi bench_catalog_storage.py).
+import json
+import os
+import sqlite3
+import threading
+
+
+def open_storage(filename, fsync=False):
+    if os.path.splitext(filename)[1] in ('.db', '.sqlite', '.sqlite3'):
+        return SqliteStorage(filename)
+    return JsonStorage(filename, fsync=fsync)
+
+
+class JsonStorage:
+    """
+    catalog.json e' uno snapshot compattato, ogni mutazione viene aggiunta in
+    coda a catalog.json.journal. checkpoint() riscrive lo snapshot (file
+    temporaneo + rename atomico) e scarta il journal ruotato da rotate().
+    """
+    def __init__(self, filename, fsync=False):
+        self.filename = filename
+        self.journal_file = filename + '.journal'
+        self.fsync = fsync
+        self._journal = None
+
+    def load(self):
+        if not os.path.exists(self.filename):
+            return None
+        with open(self.filename, 'r') as f:
+            return json.load(f)
+
+    def replay(self):
+        # .old esiste solo se uno snapshot e' stato interrotto: va riapplicato prima
+        for path in (self.journal_file + '.old', self.journal_file):
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r') as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        continue  # ultima riga troncata da un crash
+
+    def write_all(self, data):
+        # snapshot completo; i journal riapplicati non servono piu'
+        self.checkpoint(data, None)
+        for path in (self.journal_file + '.old', self.journal_file):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def open(self):
+        self._journal = open(self.journal_file, 'a')
+
+    def append(self, ops, snapshot):
+        self._journal.write(''.join(json.dumps(op) + '\n' for op in ops))
+        self._journal.flush()
+        if self.fsync:
+            os.fsync(self._journal.fileno())
+
+    def rotate(self):
+        # chiamato sotto il lock dei writer: le op successive vanno nel journal nuovo
+        if self._journal is None:
+            return None
+        self._journal.close()
+        rotated = self.journal_file + '.old'
+        os.replace(self.journal_file, rotated)
+        self._journal = open(self.journal_file, 'a')
+        return rotated
+
+    def checkpoint(self, data, rotated):
+        text = json.dumps(data, indent=4)
+        tmp = self.filename + '.tmp'
+        with open(tmp, 'w') as f:
+            f.write(text)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.filename)
+        if rotated and os.path.exists(rotated):
+            os.remove(rotated)
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS config (
+    key TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS gateways (
+    gateway_id TEXT PRIMARY KEY,
+    zone TEXT,
+    last_update REAL,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS poles (
+    id TEXT PRIMARY KEY,
+    gateway_id TEXT NOT NULL,
+    lat REAL,
+    long REAL,
+    region TEXT,
+    data TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS sensors (
+    pole_id TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    sensor_type TEXT,
+    unit TEXT,
+    data TEXT NOT NULL,
+    PRIMARY KEY (pole_id, position)
+);
+CREATE INDEX IF NOT EXISTS gateways_zone ON gateways(zone);
+CREATE INDEX IF NOT EXISTS poles_gateway ON poles(gateway_id);
+CREATE INDEX IF NOT EXISTS poles_coords ON poles(lat, long);
+"""
+
+# statement fissi: sqlite3 li compila una volta e li riusa dalla sua cache
+UPSERT_CONFIG = "INSERT INTO config (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value = excluded.value"
+UPSERT_GATEWAY = ("INSERT INTO gateways (gateway_id, zone, last_update, data) VALUES (?, ?, ?, ?) "
+                  "ON CONFLICT(gateway_id) DO UPDATE SET zone = excluded.zone, "
+                  "last_update = excluded.last_update, data = excluded.data")
+INSERT_POLE = "INSERT OR REPLACE INTO poles (id, gateway_id, lat, long, region, data) VALUES (?, ?, ?, ?, ?, ?)"
+INSERT_SENSOR = "INSERT INTO sensors (pole_id, position, sensor_type, unit, data) VALUES (?, ?, ?, ?, ?)"
+DELETE_POLE = "DELETE FROM poles WHERE id = ?"
+DELETE_SENSORS = "DELETE FROM sensors WHERE pole_id = ?"
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class SqliteStorage:
+    """
+    Una riga per gateway, palo e sensore; le sezioni di configurazione
+    (topic, regions, threshold, ...) sono righe JSON della tabella config.
+    Ogni commit del catalog e' una transazione che tocca solo le righe
+    cambiate: non c'e' journal da compattare. WAL: i checkpoint non
+    bloccano le scritture. load() legge tutta la flotta.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self._lock = threading.Lock()
+        self.db = sqlite3.connect(filename, check_same_thread=False, cached_statements=128)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("PRAGMA foreign_keys=OFF")
+        self.db.executescript(SCHEMA)
+
+    def load(self):
+        # config + tutta la flotta per lo snapshot in memoria
+        with self._lock:
+            config = self.db.execute("SELECT key, value FROM config").fetchall()
+            if not config:
+                return None
+            data = {key: json.loads(value) for key, value in config}
+
+            sensors = {}
+            for pole_id, value in self.db.execute("SELECT pole_id, data FROM sensors ORDER BY pole_id, position"):
+                sensors.setdefault(pole_id, []).append(json.loads(value))
+            poles = {}
+            for pole_id, gateway_id, value in self.db.execute("SELECT id, gateway_id, data FROM poles ORDER BY rowid"):
+                pole = json.loads(value)
+                if pole_id in sensors:
+                    pole["sensors"] = sensors[pole_id]
+                poles.setdefault(gateway_id, []).append(pole)
+            data["gateways"] = []
+            for gateway_id, value in self.db.execute("SELECT gateway_id, data FROM gateways ORDER BY rowid"):
+                gw = json.loads(value)
+                gw["smart_poles"] = poles.get(gateway_id, [])
+                data["gateways"].append(gw)
+        return data
+
+    def replay(self):
+        return []
+
+    def write_all(self, data):
+        with self._lock, self.db:
+            for table in ("config", "gateways", "poles", "sensors"):
+                self.db.execute(f"DELETE FROM {table}")
+            for key, value in data.items():
+                if key != "gateways":
+                    self.db.execute(UPSERT_CONFIG, (key, json.dumps(value)))
+            for gw in data.get("gateways", []):
+                self._put_gateway(gw)
+                for pole in gw.get("smart_poles", []):
+                    self._put_pole(gw.get("gateway_id"), pole)
+
+    def open(self):
+        pass
+
+    def append(self, ops, snapshot):
+        # le righe vengono scritte dallo stato gia' applicato nello snapshot
+        with self._lock, self.db:
+            for op in ops:
+                kind = op["op"]
+                if kind == "upsert_gateway":
+                    gw = snapshot.find_gateway(op["gateway"]["gateway_id"])
+                    self._put_gateway(gw)
+                    for pole in op["gateway"].get("smart_poles", []):
+                        self._put_pole(gw.get("gateway_id"), pole)
+                elif kind == "add_pole":
+                    self._put_pole(op["gateway_id"], op["pole"])
+                elif kind == "remove_pole":
+                    self.db.execute(DELETE_POLE, (op["pole_id"],))
+                    self.db.execute(DELETE_SENSORS, (op["pole_id"],))
+                elif kind == "liveness":
+                    if op.get("pole_id") is not None:
+                        entry = snapshot.poles.get(op["pole_id"])
+                        if entry is not None:
+                            self._put_pole(entry[0], entry[1])
+                    elif snapshot.find_gateway(op["gateway_id"]) is not None:
+                        self._put_gateway(snapshot.find_gateway(op["gateway_id"]))
+                elif kind == "set":
+                    key = op["path"][0]
+                    self.db.execute(UPSERT_CONFIG, (key, json.dumps(snapshot.data.get(key))))
+
+    def _put_gateway(self, gw):
+        row = {k: v for k, v in gw.items() if k != "smart_poles"}
+        self.db.execute(UPSERT_GATEWAY, (gw.get("gateway_id"), gw.get("zone"), gw.get("last_update"), json.dumps(row)))
+
+    def _put_pole(self, gateway_id, pole):
+        sensors = pole.get("sensors")
+        # i sensori vanno nella loro tabella solo se hanno la forma attesa, altrimenti restano nel palo
+        split = isinstance(sensors, list) and sensors and all(isinstance(s, dict) for s in sensors)
+        row = {k: v for k, v in pole.items() if k != "sensors" or not split}
+        self.db.execute(DELETE_SENSORS, (pole["id"],))
+        self.db.execute(INSERT_POLE, (pole["id"], gateway_id, _number(pole.get("lat")), _number(pole.get("long")),
+                                      pole.get("region"), json.dumps(row)))
+        if split:
+            self.db.executemany(INSERT_SENSOR, [
+                (pole["id"], k, s.get("sensor_type"), s.get("unit"), json.dumps(s)) for k, s in enumerate(sensors)
+            ])
+
+    def rotate(self):
+        return None
+
+    def checkpoint(self, data, rotated):
+        # le righe sono gia' su disco: si riversa solo il WAL nel file principale
+        with self._lock:
+            self.db.execute("PRAGMA wal_checkpoint(PASSIVE)")
+
+    def close(self):
+        with self._lock:
+            self.db.close()
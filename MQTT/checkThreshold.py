@@ -1,30 +1,34 @@
-import json
 import time
-import requests
-import paho.mqtt.client as mqtt
 from mqtt_client import Client
+from service_log import get_logger, hot, DEBUG, WARNING
+
+log = get_logger('checkThreshold')
+log_below = hot(log, 'below_threshold', DEBUG, every=100)
+log_alert = hot(log, 'alert', WARNING, per_second=10)
 
 
 class CheckThreshold (Client):
     def __init__(self, catalog_url):
         super().__init__( catalog_url, type='checkThreshold')
         self.catalog_url = catalog_url
+
+    def setup(self):
         self.load_from_catalog()     # numero 
     
     def connect(self, client, userdata, flags, reason_code, properties):
         print(f"Connection status: {reason_code}")
         # Automatically subscribe to topics found in catalog upon connection
         for topic in self.topics['subscribe']:
-            client.subscribe(f'{topic}/#')
+            client.subscribe(self.subscription(topic))
             print(f"Subscribed to {topic}")
 
     def subscribe(self, topic, qos=0):
         if topic not in self.topics["subscribe"]:
             try:
-                self.client.subscribe(topic + '/#', qos)
+                self.client.subscribe(self.subscription(topic), qos)
                 self.topics["subscribe"].append(topic)
                 data = {'new_topics': self.topics}
-                requests.put(f'{self.catalog_url}/topic', params=[('type', self.type)], json=data)
+                self.http.put('topic', params=[('type', self.type)], json=data)
                 print(f'Successfully subscribed to {topic}/#')
             except Exception as e:
                 print('Impossible to subscribe, error: ', e)
@@ -32,14 +36,22 @@ class CheckThreshold (Client):
             print(f"Already subscribed to topic {topic}")
 
     def load_from_catalog(self):
-        # Catalog espone /threshold e ritorna un valore numerico (o null) 
-        self.threshold = requests.get(
-            f"{self.catalog_url}/threshold").json()
+        # la threshold arriva con il bootstrap (numero o null), poi dal change feed
+        self.threshold = {'threshold': self.bootstrap_data.get('threshold')}
         print(f"[*] Threshold ottenuta: {self.threshold}")
 
         if self.threshold['threshold'] is None:
             raise ValueError("Threshold non presente nel catalog (/threshold).")
 
+    def on_catalog_event(self, event):
+        super().on_catalog_event(event)
+        if event['type'] == 'threshold_changed':
+            self.threshold = {'threshold': event['threshold']}
+            print(f"[*] Threshold aggiornata: {self.threshold}")
+
+    def on_catalog_resync(self):
+        self.load_from_catalog()
+
     def message(self, client, userdata, msg):
         
         # gateway_id preso dal topic: poleData/pole_id/<gateway_id> 
@@ -49,7 +61,7 @@ class CheckThreshold (Client):
             return
 
         try:
-            data = json.loads(msg.payload.decode("utf-8"))
+            data = self.decode(msg)
         except Exception:
             return
 
@@ -62,7 +74,7 @@ class CheckThreshold (Client):
             return
 
         if tilt <= self.threshold['threshold']:
-            print(f"[!] Tilt {tilt} <= threshold {self.threshold['threshold']}")  # threshold unica dal catalog (/threshold) 
+            log_below('Tilt %s <= threshold %s', tilt, self.threshold['threshold'])  # threshold unica dal catalog (/threshold)
             return
 
         alert = {
@@ -75,8 +87,8 @@ class CheckThreshold (Client):
         for topic in self.topics["publish"]:
             self.alert_base = topic  # alert/<gateway_id>/<pole_id>
             alert_topic = f"{self.alert_base}/{gateway_id}/{pole_id}"  # alert/<gw>/<pole> 
-            self.client.publish(alert_topic, json.dumps(alert), qos=1)
-            print(f"[!] Alert pubblicato su {alert_topic}: {alert}")
+            self.client.publish(alert_topic, self.encode(alert_topic, alert), qos=1)
+            log_alert('Alert pubblicato su %s: %s', alert_topic, alert)
 
 
 
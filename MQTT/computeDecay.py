@@ -1,24 +1,49 @@
+import asyncio
+import sys
 import time
-import requests
-import paho.mqtt.client as mqtt
-import json
-from mqtt_client import Client
+from mqtt_client import Client, rest_session
+from async_mqtt_client import AsyncClient, AsyncRestSession
+from service_log import get_logger, hot, WARNING
+
+log = get_logger('computeDecay')
+log_decay = hot(log, 'decay', every=100, per_second=5)
+log_writer_error = hot(log, 'writer_error', WARNING, per_second=1)
 
 class ComputeDecay(Client):
     def __init__(self, catalog_url: str):
         super().__init__( catalog_url, type='computeDecay')
         self._uri = catalog_url.rstrip("/")
-        self._writer_url = requests.get(f"{self._uri}/c_d_url").json().get("c_d_url")
+
+    def setup(self):
+        self._writer_url = self.bootstrap_data.get("c_d_url")
+        self.writer = rest_session(self._writer_url)
+        # la POST al writer non gira sul thread di rete; se il writer rallenta si tengono i dati piu' recenti
+        self.enable_dispatch(workers=8, maxsize=5000, policy='drop_oldest')
 
     def message(self, client, userdata, msg):
+        payload = self.decay_payload(msg)
+        if payload is None:
+            return
+
         try:
-            data = json.loads(msg.payload.decode("utf-8"))
+            # callback MQTT: timeout corto; se il writer e' giu' il circuito si apre e si salta subito
+            r = self.writer.post('decay', json=payload, timeout=(1, 2))
+            log_decay('Sent decay for pole %s at %s: %s', payload['pole_id'], payload['timestamp'], payload['decay'])
+            if r.status_code not in (200, 201):
+                log_writer_error('Writer POST failed (%s): %s', r.status_code, r.text)
+        except Exception as e:
+            log_writer_error('Writer POST error: %s', e)
+
+    def decay_payload(self, msg):
+        # messaggio del palo -> record per il writer (None se va ignorato)
+        try:
+            data = self.decode(msg)
         except Exception:
-            return
+            return None
 
         # ignora config
         if data.get("message") == "config":
-            return
+            return None
 
         temperature = data.get("temperature")
         humidity = data.get("humidity")
@@ -26,24 +51,16 @@ class ComputeDecay(Client):
         timestamp = data.get("timestamp")
 
         if temperature is None or humidity is None or pole_id is None or timestamp is None:
-            return
+            return None
 
         decay = self.compute_decay(float(temperature), float(humidity))
 
-        payload = {
+        return {
             "pole_id": str(pole_id),
             "timestamp": int(timestamp),
             "decay": float(decay)
         }
 
-        try:
-            r = requests.post(f"{self._writer_url}/decay", json=payload, timeout=2)
-            print(f"[*] Sent decay for pole {pole_id} at {timestamp}: {decay}")
-            if r.status_code not in (200, 201):
-                print(f"[!] Writer POST failed ({r.status_code}): {r.text}")
-        except Exception as e:
-            print(f"[!] Writer POST error: {e}")
-
     def compute_decay(self, temperature, humidity):
             # Formula for humidity 
             # constants for humidity
@@ -78,7 +95,37 @@ class ComputeDecay(Client):
 
 
 
+class AsyncComputeDecay(AsyncClient):
+    # stesso servizio su asyncio: un task per messaggio, POST al writer senza bloccare il loop
+    decay_payload = ComputeDecay.decay_payload
+    compute_decay = ComputeDecay.compute_decay
+
+    def __init__(self, catalog_url: str):
+        super().__init__(catalog_url, type='computeDecay')
+
+    async def setup(self):
+        self.writer = AsyncRestSession(self.bootstrap_data.get("c_d_url"))
+
+    async def message(self, client, userdata, msg):
+        payload = self.decay_payload(msg)
+        if payload is None:
+            return
+        try:
+            r = await self.writer.post('decay', json=payload, timeout=(1, 2))
+            log_decay('Sent decay for pole %s at %s: %s', payload['pole_id'], payload['timestamp'], payload['decay'])
+            if r.status_code not in (200, 201):
+                log_writer_error('Writer POST failed (%s): %s', r.status_code, r.text)
+        except Exception as e:
+            log_writer_error('Writer POST error: %s', e)
+
+
 if __name__ == "__main__":
+    if "--async" in sys.argv:
+        try:
+            asyncio.run(AsyncComputeDecay("http://localhost:8080").run())
+        except KeyboardInterrupt:
+            print("Stopping...")
+        sys.exit(0)
     computeDecay = ComputeDecay("http://localhost:8080")
     computeDecay.start()
     try:
@@ -1,138 +1,605 @@
 import json
+import os
 import paho.mqtt.client as mqtt
-import requests
 import threading
 import time
-from mqtt_client import Client
+from mqtt_client import Client, payload_codec, pack_batch, BATCH_MAX_READINGS
+from metrics import REGISTRY
+from spool import Spool
+from service_log import get_logger, hot, WARNING, ERROR
+
+FORWARDED = REGISTRY.counter('gateway_forwarded_total', 'Messaggi dei pali inoltrati al broker centrale', ('gateway',))
+DROPPED = REGISTRY.counter('gateway_dropped_total', 'Messaggi dei pali non inoltrati', ('gateway', 'reason'))
+UPLINK_BATCHES = REGISTRY.counter('gateway_uplink_batches_total', 'Batch di letture pubblicati sul broker centrale', ('gateway',))
+UPLINK_BYTES = REGISTRY.counter('gateway_uplink_bytes_total', 'Byte delle letture inoltrate: payload originali e batch sul filo',
+                                ('gateway', 'kind'))
+SPOOLED = REGISTRY.counter('gateway_spooled_total', 'Messaggi per il broker centrale salvati nello spool', ('gateway',))
+REPLAYED = REGISTRY.counter('gateway_replayed_total', 'Messaggi dello spool ripubblicati sul broker centrale', ('gateway',))
+SPOOL_EVICTED = REGISTRY.counter('gateway_spool_evicted_total', 'Messaggi eliminati dallo spool senza essere ripubblicati',
+                                 ('gateway', 'reason'))
+SPOOL_DEPTH = REGISTRY.gauge('gateway_spool_messages', 'Messaggi in attesa nello spool', ('gateway',))
+SPOOL_BYTES = REGISTRY.gauge('gateway_spool_bytes', 'Byte su disco dello spool', ('gateway',))
+SPOOL_LAG = REGISTRY.gauge('gateway_spool_replay_lag_seconds', 'Eta\' del messaggio piu\' vecchio ancora nello spool', ('gateway',))
+EDGE_READINGS = REGISTRY.counter('gateway_edge_readings_total', 'Letture dei pali per decisione del filtro ai bordi',
+                                 ('gateway', 'decision'))
+EDGE_REDUCTION = REGISTRY.gauge('gateway_edge_reduction_ratio', 'Frazione di letture trattenute dal filtro ai bordi', ('gateway',))
+STATUS_AGE = REGISTRY.gauge('gateway_pole_status_age_seconds', 'Secondi dall\'ultimo allineamento della tabella dei pali', ('gateway',))
+STATUS_POLES = REGISTRY.gauge('gateway_pole_status_poles', 'Pali nella tabella di stato locale', ('gateway',))
+STATUS_FALLBACK = REGISTRY.counter('gateway_pole_status_fallback_total', 'Controlli decisi dalla policy fail-open/closed', ('gateway', 'reason'))
+STATUS_REFRESHES = REGISTRY.counter('gateway_pole_status_refreshes_total', 'Aggiornamenti della tabella dei pali dal catalog', ('gateway', 'kind'))
+
+log = get_logger('gateway')
+# una riga per messaggio: campionate e con un tetto al secondo
+log_forward = hot(log, 'forward', every=100, per_second=5)
+log_lost = hot(log, 'lost', WARNING, per_second=1)
+log_deactivate = hot(log, 'deactivate', WARNING, per_second=1)
+log_local_error = hot(log, 'local_error', ERROR, per_second=1)
+
+class UplinkBatcher:
+    """
+    Raccoglie le letture da inoltrare al broker centrale e le pubblica a blocchi
+    (mqtt_client.pack_batch), uno per radice del topic: il batch parte appena
+    raggiunge max_readings letture o max_bytes byte, al piu' tardi dopo
+    max_delay secondi dalla prima lettura. send(root, seq, payload, entries)
+    pubblica il batch; seq cresce di uno per batch.
+    """
+    def __init__(self, send, max_readings=200, max_bytes=65536, max_delay=0.5, compress=True):
+        self.send = send
+        self.max_readings = min(int(max_readings), BATCH_MAX_READINGS)
+        self.max_bytes = max_bytes
+        self.max_delay = max_delay
+        self.compress = compress
+        self.seq = 0
+        self._pending = {}   # root -> (entries, [byte], inizio)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._flush_loop, name='uplink-batcher', daemon=True)
+        self._thread.start()
+
+    def add(self, root, topic, payload):
+        with self._lock:
+            batch = self._pending.get(root)
+            if batch is None:
+                batch = self._pending[root] = ([], [0], time.monotonic())
+            batch[0].append((topic, payload))
+            batch[1][0] += len(topic) + len(payload)
+            if len(batch[0]) < self.max_readings and batch[1][0] < self.max_bytes:
+                return
+            ready = self._take(root)
+        self._publish(root, *ready)
+
+    def _take(self, root):
+        # sotto self._lock
+        entries = self._pending.pop(root)[0]
+        self.seq += 1
+        return self.seq, entries
+
+    def _publish(self, root, seq, entries):
+        self.send(root, seq, pack_batch(entries, seq, self.compress), entries)
+
+    def flush(self, older_than=0):
+        now = time.monotonic()
+        with self._lock:
+            ready = [(root, self._take(root)) for root, batch in list(self._pending.items())
+                     if now - batch[2] >= older_than]
+        for root, (seq, entries) in ready:
+            self._publish(root, seq, entries)
+
+    def _flush_loop(self):
+        while not self._stopped.wait(self.max_delay / 4):
+            try:
+                self.flush(older_than=self.max_delay)
+            except Exception as e:
+                log_local_error('Errore invio batch: %s', e)
+
+    def stop(self):
+        self._stopped.set()
+        self.flush()
+
+
+class EdgeFilter:
+    """
+    Deadband per sensore: una lettura va al broker centrale se almeno un
+    sensore si e' spostato di piu' della sua deadband rispetto all'ultima
+    lettura inoltrata per quel palo, se sono passati heartbeat secondi
+    dall'ultima inoltrata, oppure se il tilt e' oltre near_threshold volte la
+    threshold (gli allarmi non devono mai aspettare). La prima lettura di ogni
+    palo passa sempre.
+
+    sensors: {sensor_type: {"field": <campo della lettura>, "deadband": <delta>}}
+    """
+    def __init__(self, sensors, heartbeat=60, near_threshold=0.8, threshold=None):
+        self.rules = [(rule['field'], rule['deadband']) for rule in sensors.values()]
+        self.heartbeat = heartbeat
+        self.near_threshold = near_threshold
+        self.threshold = threshold
+        self.decisions = {}
+        self._decisions_lock = threading.Lock()   # accept() gira sui worker del dispatcher
+        self._last = {}   # pole_id -> (timestamp, {campo: valore}) dell'ultima lettura inoltrata
+
+    def accept(self, pole_id, data):
+        ts = data.get('timestamp')
+        if not isinstance(ts, (int, float)):
+            ts = time.time()
+        decision = self._decide(pole_id, data, ts)
+        with self._decisions_lock:
+            self.decisions[decision] = self.decisions.get(decision, 0) + 1
+        if decision == 'suppressed':
+            return False, decision
+        self._last[pole_id] = (ts, {field: data.get(field) for field, _ in self.rules})
+        return True, decision
+
+    def _decide(self, pole_id, data, ts):
+        tilt = data.get('tilt')
+        if self.threshold is not None and isinstance(tilt, (int, float)) and tilt >= self.threshold * self.near_threshold:
+            return 'near_threshold'
+        last = self._last.get(pole_id)
+        if last is None:
+            return 'first'
+        if ts - last[0] >= self.heartbeat:
+            return 'heartbeat'
+        for field, deadband in self.rules:
+            value, previous = data.get(field), last[1].get(field)
+            if not isinstance(value, (int, float)) or not isinstance(previous, (int, float)):
+                if value != previous:
+                    return 'changed'
+            elif abs(value - previous) > deadband:
+                return 'changed'
+        return 'suppressed'
+
+    def forget(self, pole_id):
+        self._last.pop(pole_id, None)
+
+    def reduction(self):
+        total = sum(self.decisions.values())
+        return self.decisions.get('suppressed', 0) / total if total else 0.0
+
 
 class GatewaySubscriber(Client):
     def __init__(self, coordinates, catalog_url):
         self.coordinates = coordinates
         super().__init__( catalog_url, type='gateway')
         self.catalog_url = catalog_url
-        regions = requests.get(f"{self.catalog_url}/regions").json()
-        self.region = self.get_region(coordinates['lat'], coordinates['long'], regions)      
-        self.local_broker_conf = self.get_broker_local()
+
+    def setup(self):
+        # regione, broker locale e id arrivano gia' con il bootstrap (parametri lat/lon)
+        self.region = self.bootstrap_data.get('region') or 'None'
+        self.local_broker_conf = self.bootstrap_data.get('local_broker')
         self.central_broker_conf = self.broker  # from parent class
-        #unique ID
-        self.client_id = self.get_client_id()
         self.client_local = mqtt.Client(
             callback_api_version=mqtt.CallbackAPIVersion.VERSION2, 
             client_id=self.client_id)        
         self.known_poles = set()  #cache dei pali già registrati
+        # registrazioni in attesa, inviate al catalog a blocchi (POST /pole batch)
+        self.register_batch_size = 200
+        self.register_batch_interval = 0.5
+        self._pending_poles = {}
+        self._pending_lock = threading.Lock()
+        self._pending_full = threading.Event()
+        self._register_thread = threading.Thread(target=self._registration_loop, daemon=True)
+        # heartbeat verso il catalog: senza, il gateway e i suoi pali scadono
+        self.heartbeat_interval = 30
+        self._seen_poles = set()   # pali da cui sono arrivati dati dall'ultimo heartbeat
+        self._heartbeat_thread = threading.Thread(target=self._heartbeat_loop, daemon=True)
+        # stato attivo/disattivo dei pali di questo gateway: caricato dal catalog (POST pole_status),
+        # aggiornato dal change feed e da un refresh periodico incrementale (since)
+        policy = self.bootstrap_data.get('pole_status') or {}
+        self.pole_status_fail_open = policy.get('fail_open', True)
+        self.pole_status_max_age = policy.get('max_age', 120)
+        self.pole_status_refresh = policy.get('refresh_interval', 60)
+        self.pole_status = {}   # pole_id -> registrato nel catalog (False: va disattivato)
+        self.pole_online = {}   # pole_id -> liveness del catalog: solo informativa, non disattiva mai
+        self.pole_status_version = None   # versione del catalog dell'ultimo refresh
+        self.pole_status_epoch = None     # epoch (avvio del catalog) di quella versione
+        self.pole_status_synced = None    # time.monotonic() dell'ultimo allineamento (refresh o feed)
+        self._status_lock = threading.Lock()
+        self._status_thread = threading.Thread(target=self._pole_status_loop, daemon=True)
+        # store-and-forward: senza broker centrale i messaggi vanno su disco e ripartono alla riconnessione,
+        # al piu' replay_rate al secondo, mescolati al traffico live (sezione "spool" del catalog)
+        cfg = self.bootstrap_data.get('spool') or {}
+        self.spool = None
+        self.replay_rate = cfg.get('replay_rate', 200)
+        self.replay_ack_timeout = cfg.get('ack_timeout', 5)   # attesa massima dei PUBACK di un blocco
+        if cfg.get('enabled'):
+            self.spool = Spool(os.path.join(cfg.get('directory', 'spool'), self.client_id),
+                               segment_bytes=cfg.get('segment_bytes', 4194304), max_bytes=cfg.get('max_bytes', 268435456),
+                               max_age=cfg.get('max_age', 86400))
+            SPOOL_DEPTH.set_function(self.spool.pending, self.client_id)
+            SPOOL_BYTES.set_function(self.spool.size, self.client_id)
+            SPOOL_LAG.set_function(self.spool_lag, self.client_id)
+            for reason in ('size', 'age'):
+                SPOOL_EVICTED.set_function(lambda reason=reason: self.spool.evicted[reason], self.client_id, reason)
+        self._replay_thread = threading.Thread(target=self._replay_loop, daemon=True)
+        # filtro ai bordi: solo le variazioni significative salgono al cloud (sezione "edge_filter")
+        self.edge_filter = None
+        self.configure_edge_filter(self.bootstrap_data.get('edge_filter') or {})
+        EDGE_REDUCTION.set_function(lambda: self.edge_filter.reduction() if self.edge_filter else 0.0, self.client_id)
+        # uplink a blocchi verso il broker centrale (sezione "uplink" del catalog)
+        self.batcher = None
+        self.configure_uplink(self.bootstrap_data.get('uplink') or {})
+        STATUS_AGE.set_function(self.pole_status_age, self.client_id)
+        STATUS_POLES.set_function(lambda: len(self.pole_status), self.client_id)
+        # messaggi dei pali su un pool di worker, in ordine per palo (config prima dei dati);
+        # con la coda piena si rallenta il broker locale invece di perdere messaggi
+        self.enable_dispatch(workers=8, maxsize=5000, policy='block', key=self.pole_key,
+                             handler=self.on_local_message, client=self.client_local)
+        self.instrument(self.client_local)
 
-    def get_client_id(self):
-        try:
-            r = requests.get(f"{self.catalog_url}/compute_id?type=gateway&lat={self.coordinates['lat']}&lon={self.coordinates['long']}").json()
-            self.client_id = r['id']
-            print(f'Mqtt client obtained: ', self.client_id)
-            return self.client_id
-        except Exception as e:
-            print('Impossible GET client id, error: ', e)
+    def bootstrap_params(self):
+        return {'type': 'gateway', 'lat': self.coordinates['lat'], 'lon': self.coordinates['long']}
 
-    def get_region(self, lat, long, regions):
+    def pole_key(self, msg):
+        # poleData/<region>/<pole_id>
+        return msg.topic.rsplit('/', 1)[-1]
 
-        for region_name, bounds in regions.items():
-            if (
-                bounds["minLat"] <= lat <= bounds["maxLat"] and
-                bounds["minLon"] <= long <= bounds["maxLon"]
-            ):
-                return region_name
-        return 'None'
-    
-    def get_broker_local(self):
-        resp_broker = requests.get(f"{self.catalog_url}/local_broker")
-        self.local_broker_conf = resp_broker.json()
-        print(f"[*] Broker Locale ottenuto: {self.local_broker_conf}")
-        return self.local_broker_conf
-    
     def get_pole_active(self, pole_id: str) -> bool:
+        # singolo palo via HTTP; il percorso dei messaggi usa la tabella locale (is_pole_active)
         try:
-            r = requests.get(f"{self.catalog_url}/pole_status/{pole_id}", timeout=2)
+            # chiamata dal thread MQTT: timeout corto e nessun retry, in caso di dubbio fail-open
+            r = self.http.get(f"pole_status/{pole_id}", timeout=(1, 2), retry=False)
             if r.status_code != 200:
                 return True
             return bool(r.json().get("active", True))
         except Exception:
             return True # fail-open
         
+    def get_poles_active(self, since=None, epoch=None):
+        # stato di tutti i pali di questo gateway in una sola chiamata;
+        # con since solo quelli cambiati dopo quella versione del catalog (dello stesso epoch)
+        body = {"gateway_id": self.client_id}
+        if since is not None:
+            body["since"] = since
+            body["epoch"] = epoch
+        r = self.http.post('pole_status', json=body, retry=True)
+        r.raise_for_status()
+        return r.json()
+
+    def refresh_pole_status(self, full=False):
+        # completo al primo giro (o se il catalog non copre piu' i delta), poi solo i pali cambiati;
+        # con il catalog ripartito (epoch diverso) le versioni vecchie non valgono piu'
+        if self.pole_status_epoch != self.catalog_epoch:
+            full = True
+        since = None if full else self.pole_status_version
+        try:
+            r = self.get_poles_active(since=since, epoch=self.pole_status_epoch)
+        except Exception as e:
+            print(f"[!] Refresh stato pali fallito: {e}")
+            return False
+        full = r.get('full', since is None)
+        with self._status_lock:
+            if full:
+                self.pole_status = dict(r['active'])
+                self.pole_online = dict(r.get('online') or {})
+                # i pali gia' nel catalog per questo gateway non vanno registrati di nuovo
+                self.known_poles.update(r['active'])
+            else:
+                self.pole_status.update(r['active'])
+                self.pole_online.update(r.get('online') or {})
+            self.pole_status_version = r['version']
+            self.pole_status_epoch = r.get('epoch')
+            self.pole_status_synced = time.monotonic()
+        STATUS_REFRESHES.inc(self.client_id, 'full' if full else 'delta')
+        return True
+
+    def _pole_status_loop(self):
+        while True:
+            time.sleep(self.pole_status_refresh)
+            self.refresh_pole_status()
+
+    def pole_status_age(self):
+        synced = self.pole_status_synced
+        return float('inf') if synced is None else time.monotonic() - synced
+
+    def is_pole_active(self, pole_id: str) -> bool:
+        # lookup nella tabella locale; palo assente o tabella troppo vecchia -> decide la policy
+        active = self.pole_status.get(pole_id)
+        if active is None:
+            STATUS_FALLBACK.inc(self.client_id, 'unknown')
+            return self.pole_status_fail_open
+        if self.pole_status_age() > self.pole_status_max_age:
+            STATUS_FALLBACK.inc(self.client_id, 'stale')
+            return self.pole_status_fail_open
+        return active
+
+    def set_pole_status(self, pole_id, active):
+        with self._status_lock:
+            if active is None:
+                self.pole_status.pop(pole_id, None)
+            else:
+                self.pole_status[pole_id] = active
+            if not active:
+                self.pole_online.pop(pole_id, None)
+
+    def set_pole_online(self, pole_id, online):
+        with self._status_lock:
+            if self.pole_status.get(pole_id):
+                self.pole_online[pole_id] = online
+
+    def configure_edge_filter(self, cfg):
+        if not cfg.get('enabled'):
+            self.edge_filter = None
+            print("[*] Filtro ai bordi disattivato: si inoltrano tutte le letture")
+            return
+        self.edge_filter = EdgeFilter(cfg.get('sensors') or {}, heartbeat=cfg.get('heartbeat', 60),
+                                      near_threshold=cfg.get('near_threshold', 0.8),
+                                      threshold=self.bootstrap_data.get('threshold'))
+        print(f"[*] Filtro ai bordi: {cfg}")
+
+    def configure_uplink(self, cfg):
+        old, self.batcher = self.batcher, None
+        if cfg.get('batch'):
+            self.batcher = UplinkBatcher(self.send_batch, max_readings=cfg.get('max_readings', 200),
+                                         max_bytes=cfg.get('max_bytes', 65536), max_delay=cfg.get('max_delay', 0.5),
+                                         compress=cfg.get('compress', True))
+        if old is not None:
+            old.stop()   # le letture gia' raccolte partono con il vecchio batcher
+        print(f"[*] Uplink: {'batch ' + str(cfg) if self.batcher else 'un messaggio per lettura'}")
+
+    def publish_central(self, topic, payload, readings=1):
+        # sul broker centrale se connesso, altrimenti nello spool; False se il messaggio e' perso
+        if self.client.is_connected():
+            # rc diverso da successo (link caduto nel frattempo, coda di paho piena): va nello spool
+            if self.client.publish(topic, payload, qos=1).rc == mqtt.MQTT_ERR_SUCCESS:
+                return True
+        if self.spool is not None:
+            try:
+                self.spool.append(topic, payload)
+                SPOOLED.inc(self.client_id)
+                return True
+            except OSError as e:
+                log_local_error('Spool non scrivibile: %s', e)
+        DROPPED.inc(self.client_id, 'cloud_disconnected', amount=readings)
+        log_lost('Cloud non connesso, %s letture su %s perse', readings, topic)
+        return False
+
+    def _replay_loop(self):
+        tick = 0.1
+        while self.spool is not None:
+            time.sleep(tick)
+            # un errore (I/O dello spool, publish non accodata) non deve fermare il thread:
+            # si salta il giro e si riprova dal cursore, che avanza solo sui record confermati
+            try:
+                self._replay_once(tick)
+            except Exception as e:
+                log_local_error('Replay dello spool fallito, nuovo tentativo: %s', e)
+
+    def _replay_once(self, tick):
+        if not self.spool.pending():
+            return
+        self.spool.expire()
+        if not self.client.is_connected():
+            return
+        # a piccoli blocchi: il traffico live continua a passare tra un blocco e l'altro
+        records, _ = self.spool.peek(max(1, int(self.replay_rate * tick)))
+        sent = []
+        for topic, payload, _, mark in records:
+            info = self.client.publish(topic, payload, qos=1)
+            if info.rc != mqtt.MQTT_ERR_SUCCESS:
+                break   # link di nuovo giu': si riparte dal primo record non confermato
+            sent.append((info, mark))
+        # il cursore avanza solo fino all'ultimo record con PUBACK: i successivi si
+        # ripubblicano al giro dopo (at-least-once)
+        acked = None
+        deadline = time.monotonic() + self.replay_ack_timeout
+        for info, mark in sent:
+            try:
+                info.wait_for_publish(max(0.0, deadline - time.monotonic()))
+            except (RuntimeError, ValueError):
+                break   # publish non accodata: si conferma fin qui
+            if not info.is_published():
+                break
+            acked = mark
+        if acked is not None:
+            self.spool.commit(acked)
+            REPLAYED.inc(self.client_id, amount=acked[2])
+            log_forward('Ripubblicati %s messaggi dallo spool, %s in attesa', acked[2], self.spool.pending())
+
+    def spool_lag(self):
+        oldest = self.spool.oldest()
+        return 0 if oldest is None else max(0.0, time.time() - oldest)
+
+    def send_batch(self, root, seq, payload, entries):
+        if not self.publish_central(f"{root}/{self.client_id}", payload, readings=len(entries)):
+            return
+        FORWARDED.inc(self.client_id, amount=len(entries))
+        UPLINK_BATCHES.inc(self.client_id)
+        UPLINK_BYTES.inc(self.client_id, 'readings', amount=sum(len(p) for _, p in entries))
+        UPLINK_BYTES.inc(self.client_id, 'wire', amount=len(payload))
+        log_forward('Batch %s inoltrato al Cloud: %s letture, %s byte', seq, len(entries), len(payload))
+
+    def on_catalog_event(self, event):
+        super().on_catalog_event(event)
+        kind = event['type']
+        if kind == 'value_changed' and event['path'] == ['uplink']:
+            self.configure_uplink(event['value'] or {})
+            return
+        if kind == 'value_changed' and event['path'] == ['edge_filter']:
+            self.configure_edge_filter(event['value'] or {})
+            return
+        if kind == 'threshold_changed':
+            self.bootstrap_data['threshold'] = event['threshold']
+            if self.edge_filter is not None:
+                self.edge_filter.threshold = event['threshold']
+            return
+        if kind in ('pole_added', 'pole_removed', 'pole_online', 'pole_offline'):
+            if event.get('gateway_id') != self.client_id:
+                return
+            # solo la cancellazione disattiva un palo; online/offline e' liveness e aggiorna solo pole_online
+            if kind == 'pole_added':
+                self.set_pole_status(event['pole']['id'], True)
+                self.set_pole_online(event['pole']['id'], event['pole'].get('online') is not False)
+            elif kind == 'pole_removed':
+                self.set_pole_status(event['pole_id'], False)
+            else:
+                self.set_pole_online(event['pole_id'], kind == 'pole_online')
+
+    def apply_catalog_change(self, change):
+        super().apply_catalog_change(change)
+        # delta applicato in ordine: la tabella e' allineata a questa versione
+        with self._feed_lock:
+            if self.catalog_seq == change['seq']:
+                self.pole_status_synced = time.monotonic()
+
+    def on_catalog_resync(self):
+        self.refresh_pole_status(full=True)
+
     def send_deactivate_cmd(self, pole_id: str):
-        cmd_base = requests.get(f"{self.catalog_url}/topic?type=cmd_topic").json()
+        cmd_base = self.bootstrap_data.get('cmd_topic') or 'poleCmd'
         topic = f"{cmd_base}/{pole_id}"
         payload = json.dumps({"cmd": "deactivate", "ts": time.time()})
         # pubblica sul broker locale
         self.client_local.publish(topic, payload, qos=1, retain=False)
-        print(f"[!] Sent deactivate to {topic}")
+        log_deactivate('Sent deactivate to %s', topic)
 
     def delete_pole_from_catalog(self, pole_id: str):
         try:
-            url = f"{self.catalog_url}/pole/{self.client_id}/{pole_id}"
-            r = requests.delete(url, timeout=5)
+            url = f"pole/{self.client_id}/{pole_id}"
+            r = self.http.delete(url)
             print(f"[*] DELETE {url} -> {r.status_code} {r.text}")
             # keep local cache consistent
             if pole_id in self.known_poles:
                 self.known_poles.remove(pole_id)
+            self.set_pole_status(pole_id, None)
+            if self.edge_filter is not None:
+                self.edge_filter.forget(pole_id)
+            with self._pending_lock:
+                self._pending_poles.pop(pole_id, None)
         except Exception as e:
             print(f"[!] Errore delete pole dal catalog: {e}")
 
+    def on_central_connect(self, client, userdata, flags, reason_code, properties):
+        print(f"[*] Cloud: Connesso (RC: {reason_code})")
+        self.subscribe_catalog_feed(client)
+
     def on_local_connect(self, client, userdata, flags, reason_code, properties):
         print(f"[*] Local: Connesso (RC: {reason_code})")
         client.subscribe(f"poleData/{self.region}/#", qos=1)
 
     
     #registering a new pole in the catalog with configuration data, da usare solo quando riceve messaggio da palo sconosciuto
-    def register_new_pole(self, pole_data):        
-            payload = pole_data
-            payload['gateway_id'] = self.client_id  #associo palo a questo gateway
-            
-            try:
-                resp = requests.post(f"{self.catalog_url}/pole", json=payload, timeout=5)
-                if resp.status_code in (200, 201):
-                    self.known_poles.add(payload["id"])
-                    print(f"[v] Palo {payload['id']} registrato con successo.")
-                    print("Known poles test funzione registra palo:",self.known_poles)
+    #la richiesta non parte subito: i pali in attesa vengono raggruppati in un'unica POST
+    def register_new_pole(self, pole_data):
+        payload = dict(pole_data)
+        payload['gateway_id'] = self.client_id  #associo palo a questo gateway
+        with self._pending_lock:
+            self._pending_poles[payload["id"]] = payload
+            full = len(self._pending_poles) >= self.register_batch_size
+        if full:
+            self._pending_full.set()
+
+    def _heartbeat_loop(self):
+        while True:
+            time.sleep(self.heartbeat_interval)
+            self.send_heartbeat()
+
+    def send_heartbeat(self):
+        with self._pending_lock:
+            poles, self._seen_poles = self._seen_poles, set()
+        try:
+            r = self.http.post(f"gateway/{self.client_id}/heartbeat", json={"poles": list(poles)}, retry=True)
+            if r.status_code == 404:
+                # il catalog non ci conosce piu' (es. ripartito da zero): nuova registrazione
+                print("[!] Gateway sconosciuto al catalog, mi registro di nuovo")
+                self.register_gateway()
+                return
+            self.heartbeat_interval = r.json().get("heartbeat_interval", self.heartbeat_interval)
+            if self.edge_filter is not None:
+                decisions = self.edge_filter.decisions
+                log.info('Filtro ai bordi: %s letture, riduzione %.1f%% (%s)',
+                         sum(decisions.values()), 100 * self.edge_filter.reduction(), decisions)
+        except Exception as e:
+            print(f"[!] Heartbeat al catalog fallito: {e}")
+
+    def _registration_loop(self):
+        while True:
+            self._pending_full.wait(self.register_batch_interval)
+            self._pending_full.clear()
+            self.flush_registrations()
+
+    def flush_registrations(self):
+        with self._pending_lock:
+            if not self._pending_poles:
+                return
+            batch = self._pending_poles
+            self._pending_poles = {}
 
+        payload = {"gateway_id": self.client_id, "poles": list(batch.values())}
+        try:
+            # la registrazione batch e' idempotente (pole_exists): si puo' ritentare
+            resp = self.http.post('pole', json=payload, retry=True)
+            if resp.status_code not in (200, 201):
+                print(f"[!] Errore registrazione pali ({resp.status_code}): {resp.text}")
+                return
+            for res in resp.json().get("results", []):
+                if res.get("status") in ("pole_created", "pole_exists"):
+                    self.known_poles.add(res["id"])
+                    # un palo appena registrato e' attivo; il feed correggera' se non lo e'
+                    with self._status_lock:
+                        self.pole_status.setdefault(res["id"], True)
                 else:
-                    print(f"[!] Errore registrazione palo ({resp.status_code}): {resp.text}")
-            except Exception as e:
-                print(f"[!] Errore registrazione palo: {e}")
+                    print(f"[!] Errore registrazione palo {res.get('id')}: {res.get('message')}")
+            print(f"[v] Registrati {len(batch)} pali, known poles: {len(self.known_poles)}")
+        except Exception as e:
+            print(f"[!] Errore registrazione pali: {e}")
+            # riprova al prossimo giro, senza sovrascrivere config piu' recenti
+            with self._pending_lock:
+                for pole_id, pole in batch.items():
+                    self._pending_poles.setdefault(pole_id, pole)
 
     def on_local_message(self, client, userdata, msg):
-        print("DEBUG: dentro on_local_message", msg.topic)
+        log.debug('Messaggio locale su %s', msg.topic)
         try:
-            payload_str = msg.payload.decode('utf-8')
-            data = json.loads(payload_str)
+            data = self.decode(msg)
             pole_id = data.get('id')
             msg_type = data.get('message', 'data')
 
-            print(f'DEBUG: Messaggio ricevuto da {pole_id} ({msg_type})')
+            log.debug('Messaggio ricevuto da %s (%s)', pole_id, msg_type)
 
             if msg_type in ("unregister", "offline"):
-                print(f"[*] Request to remove pole {pole_id} from catalog")
+                log.info('Request to remove pole %s from catalog', pole_id)
                 self.delete_pole_from_catalog(pole_id)
                 return
 
             if msg_type == "config":
                 if pole_id not in self.known_poles:
-                    print(f"[+] Registro nuovo palo: {pole_id}")
-                    t = threading.Thread(target=self.register_new_pole, args=(data,))
-                    t.start()
+                    log.info('Registro nuovo palo: %s', pole_id)
+                    self.register_new_pole(data)
                 return
 
             elif pole_id in self.known_poles:
-                print("DEBUG entro in ramo dati")
+                with self._pending_lock:
+                    self._seen_poles.add(pole_id)
 
-                if not self.get_pole_active(pole_id):
+                if not self.is_pole_active(pole_id):
+                    DROPPED.inc(self.client_id, 'pole_inactive')
                     self.send_deactivate_cmd(pole_id)
                     return
 
-                if self.client.is_connected():
-                    central_topic = f"{data.get('topic', 'poleData')}/{self.client_id}"
-                    print(f"-> Forwarding data from {pole_id} to Cloud ({central_topic}) port {self.central_broker_conf['port']}")
-                    self.client.publish(central_topic, payload_str, qos=1)
-                else:
-                    print(f"[!] Cloud non connesso, messaggio da {pole_id} perso.")
+                edge_filter = self.edge_filter
+                if edge_filter is not None:
+                    passed, decision = edge_filter.accept(pole_id, data)
+                    EDGE_READINGS.inc(self.client_id, decision)
+                    if not passed:
+                        return
+
+                central_topic = f"{data.get('topic', 'poleData')}/{self.client_id}"
+                # si inoltra il payload cosi' com'e' se e' gia' nel codec che il catalog vuole sul broker centrale
+                payload = msg.payload
+                if payload_codec(payload) != self.codec_for(central_topic):
+                    payload = self.encode(central_topic, data)
+                batcher = self.batcher
+                if batcher is not None:
+                    # il controllo della connessione si fa all'invio del batch
+                    batcher.add(central_topic.split('/', 1)[0], central_topic, payload)
+                elif self.publish_central(central_topic, payload):
+                    log_forward('Forwarding data from %s to Cloud (%s)', pole_id, central_topic)
+                    FORWARDED.inc(self.client_id)
+                    UPLINK_BYTES.inc(self.client_id, 'readings', amount=len(payload))
+                    UPLINK_BYTES.inc(self.client_id, 'wire', amount=len(payload))
+            else:
+                DROPPED.inc(self.client_id, 'unknown_pole')
         except Exception as e:
-            print(f"[!] Errore gestione messaggio locale: {e}")
+            log_local_error('Errore gestione messaggio locale: %s', e)
 
 
     def register_gateway(self):
@@ -145,7 +612,7 @@ class GatewaySubscriber(Client):
         }
         try:
             print(f"[*] Mi sto registrando al Catalog: {self.catalog_url}")
-            response = requests.post(f"{self.catalog_url}/{self.type}", json=payload)           
+            response = self.http.post(self.type, json=payload, retry=True)           
             if response.status_code == 200 or response.status_code == 201:
                 print("[*] Registrazione OK!")
                 return True
@@ -158,12 +625,21 @@ class GatewaySubscriber(Client):
     
     #GEMINI
     def start(self):
+        self.prepare()
         if not self.register_gateway():
             print("Chiusura: Impossibile registrarsi.")
             return
 
+        self.refresh_pole_status(full=True)
+        self._register_thread.start()
+        self._heartbeat_thread.start()
+        self._status_thread.start()
+        if self.spool is not None:
+            self._replay_thread.start()
+        self.start_metrics()
+
         # 1. Setup Central Client FIRST (with its own connect log)
-        self.client.on_connect = lambda c, u, f, rc, p: print(f"[*] Cloud: Connesso (RC: {rc})")
+        self.client.on_connect = self.on_central_connect
         
         print("[*] Avvio loop di rete...")
         self.client.loop_start() # Start the loop BEFORE connecting to avoid publish-hangs
@@ -171,12 +647,10 @@ class GatewaySubscriber(Client):
         try:
             print(f"[*] Connessione Local ({self.local_broker_conf['address']})...")
             self.client_local.on_connect = self.on_local_connect
-            self.client_local.on_message = self.on_local_message
             self.client_local.connect(self.local_broker_conf["address"], self.local_broker_conf["port"])
             self.client_local.loop_start()
 
             print(f"[*] Connessione Central ({self.central_broker_conf['address']}) {self.central_broker_conf['port']}...")
-            self.client.on_connect = lambda c,u,f,rc,p: print(f"[*] Cloud: Connesso (RC: {rc})")
             self.client.connect(self.central_broker_conf["address"], self.central_broker_conf["port"])
             self.client.loop_start()
 
@@ -185,6 +659,12 @@ class GatewaySubscriber(Client):
 
     def finalize(self):
         print("Finalizing subscriber...")
+        print(f"[*] Dispatch: {self.dispatcher.stats()}")
+        self.dispatcher.stop()
+        if self.batcher is not None:
+            self.batcher.stop()
+        if self.spool is not None:
+            self.spool.close()
         self.client_local.loop_stop()
         self.client_local.disconnect()
         self.client.loop_stop()
@@ -192,8 +672,6 @@ class GatewaySubscriber(Client):
 
 
 if __name__ == "__main__":
-    import time
-
     gateway1 = GatewaySubscriber({'lat': 45.0, 'long': 7.0}, "http://localhost:8080")
     gateway1.start()
     gateway2 = GatewaySubscriber({'lat': 46.0, 'long': 10.0}, "http://localhost:8080")
@@ -1,11 +1,17 @@
-import json
 import time
 import threading
 import cherrypy
-import requests
-import paho.mqtt.client as mqtt
 from influxdb_client_3 import InfluxDBClient3, Point
 from mqtt_client import Client
+from metrics import REGISTRY, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from service_log import get_logger, hot
+
+log = get_logger('interfaccia')
+log_written = hot(log, 'written', every=100, per_second=5)
+
+JOIN_BUFFER = REGISTRY.gauge('writer_join_buffer_size', 'Elementi in attesa di join nel writer', ('buffer',))
+WRITE_SECONDS = REGISTRY.histogram('writer_influx_write_seconds', 'Durata delle scritture su InfluxDB')
+WRITES = REGISTRY.counter('writer_points_total', 'Punti uniti e scritti (o falliti) su InfluxDB', ('result',))
 
 class InfluxWriter:
     def __init__(self, host: str, token: str, database: str, table: str = "pole_measurements"):
@@ -77,30 +83,38 @@ class WriterCore(Client):
         self.influx_token =''
         self.influx_db = ''
         self.table=''
-        self.get_influxdb_info()
+        self.influx = None   # creato in setup(), con i dati di InfluxDB dal bootstrap
         self.join = JoinBuffer(ttl_s=300)
+
+        JOIN_BUFFER.set_function(lambda: len(self.join.mqtt_cache), 'mqtt')
+        JOIN_BUFFER.set_function(lambda: len(self.join.decay_cache), 'decay')
+
+        self._gc_thread = threading.Thread(target=self._gc_loop, daemon=True)
+        self._gc_thread.start()
+
+    def setup(self):
+        self.get_influxdb_info()
         self.influx = InfluxWriter(self.influx_host, 
                                    self.influx_token, 
                                    self.influx_db, 
                                    self.table
                                    )
 
-        self._gc_thread = threading.Thread(target=self._gc_loop, daemon=True)
-        self._gc_thread.start()
-
     def get_influxdb_info(self):
         try:
-            self.http_port = requests.get(f"{self.catalog_url}/writer_port").json().get("writer_port", 8090)
-            self.influx_host = requests.get(f"{self.catalog_url}/db_info").json().get("influx_host", "http://localhost:8181")
-            self.influx_token = requests.get(f"{self.catalog_url}/db_info").json().get("token", "")
-            self.influx_db = requests.get(f"{self.catalog_url}/db_info").json().get("db", "pole_measurements")
-            self.table = requests.get(f"{self.catalog_url}/db_info").json().get("table", "pole_measurements")
+            # gia' nel bootstrap: nessuna richiesta in piu' al catalog
+            self.http_port = self.bootstrap_data.get("writer_port", 8090)
+            db_info = self.bootstrap_data.get("db_info", {})
+            self.influx_host = db_info.get("influx_host", "http://localhost:8181")
+            self.influx_token = db_info.get("token", "")
+            self.influx_db = db_info.get("db", "pole_measurements")
+            self.table = db_info.get("table", "pole_measurements")
         except Exception as e:
             print('Error in GET influxdb info, error: ',e)
 
     def message(self, client, userdata, msg):
         try:
-            data = json.loads(msg.payload.decode("utf-8"))
+            data = self.decode(msg)
         except Exception:
             return
 
@@ -141,16 +155,25 @@ class WriterCore(Client):
         return {"status": "cached_waiting_mqtt"}
 
     def _write(self, pkt: dict, decay: float):
-        self.influx.write_joined(
-            pole_id=pkt["pole_id"],
-            gateway_id=pkt["gateway_id"],
-            ts=int(pkt["timestamp"]),
-            temperature=float(pkt["temperature"]),
-            humidity=float(pkt["humidity"]),
-            tilt=float(pkt["tilt"]),
-            decay=float(decay),
-        )
-        print(f"[v] Written joined point pole={pkt['pole_id']} ts={pkt['timestamp']} gateway={pkt['gateway_id']} decay={decay}")
+        start = time.perf_counter()
+        try:
+            self.influx.write_joined(
+                pole_id=pkt["pole_id"],
+                gateway_id=pkt["gateway_id"],
+                ts=int(pkt["timestamp"]),
+                temperature=float(pkt["temperature"]),
+                humidity=float(pkt["humidity"]),
+                tilt=float(pkt["tilt"]),
+                decay=float(decay),
+            )
+        except Exception:
+            WRITES.inc('error')
+            raise
+        finally:
+            WRITE_SECONDS.observe(time.perf_counter() - start)
+        WRITES.inc('ok')
+        log_written('Written joined point pole=%s ts=%s gateway=%s decay=%s',
+                    pkt['pole_id'], pkt['timestamp'], pkt['gateway_id'], decay)
 
     def _gc_loop(self):
         while True:
@@ -176,18 +199,27 @@ class DecayAPI:
         return self.core.submit_decay(pole_id, int(ts), float(decay))
 
 
+class MetricsAPI:
+    exposed = True
+
+    def GET(self):
+        cherrypy.response.headers["Content-Type"] = METRICS_CONTENT_TYPE
+        return REGISTRY.render()
+
+
 class Root:
     def __init__(self, core: WriterCore):
         self.decay = DecayAPI(core)  # POST /decay
+        self.metrics = MetricsAPI()  # GET /metrics
 
 
 def main():
     CATALOG_URL = "http://localhost:8080"
-    WRITER_PORT = requests.get(f"{CATALOG_URL}/writer_port").json().get("writer_port", 8090)
     core = WriterCore(
         catalog_url=CATALOG_URL
     )
     core.start()
+    WRITER_PORT = core.http_port   # dal bootstrap, letto in start()
 
     conf = {"/": {"request.dispatch": cherrypy.dispatch.MethodDispatcher()}}
     cherrypy.tree.mount(Root(core), "/", conf)
@@ -0,0 +1,55 @@
+# Avvia N istanze di un servizio senza stato (computeDecay, checkThreshold)
+# in processi separati, uno per core. Ogni istanza chiede al catalog il suo
+# client id (POST /instance) e si iscrive con la shared subscription del
+# gruppo ("scaling" nel catalog): il broker divide i messaggi tra le istanze.
+#
+#   python launch_workers.py computeDecay --instances 4 [--async]
+#
+# Le istanze morte vengono riavviate; Ctrl-C ferma tutto. interfaccia_db,
+# gateway e dashboard hanno stato e restano a istanza singola.
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+SERVICES = {'computeDecay': 'computeDecay.py', 'checkThreshold': 'checkThreshold.py'}
+
+
+def spawn(script, index, extra):
+    env = dict(os.environ, METRICS_PORT_OFFSET=str(index))
+    return subprocess.Popen([sys.executable, script] + extra, env=env, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('service', choices=sorted(SERVICES))
+    parser.add_argument('--instances', type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--async', dest='use_async', action='store_true', help='AsyncClient (solo computeDecay)')
+    args = parser.parse_args()
+    extra = ['--async'] if args.use_async else []
+
+    script = SERVICES[args.service]
+    workers = [spawn(script, k, extra) for k in range(args.instances)]
+    print(f'[*] {args.instances} istanze di {args.service} avviate')
+    try:
+        while True:
+            time.sleep(1)
+            for k, proc in enumerate(workers):
+                if proc.poll() is not None:
+                    print(f'Istanza {k} terminata (exit {proc.returncode}), riavvio')
+                    workers[k] = spawn(script, k, extra)
+    except KeyboardInterrupt:
+        print('Stopping...')
+    finally:
+        for proc in workers:
+            proc.terminate()
+        for proc in workers:
+            try:
+                proc.wait(5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,193 @@
+# Metriche dei servizi in formato testo Prometheus (text exposition 0.0.4).
+# Un registry per processo (REGISTRY): i Client, le RestSession e i servizi
+# ci registrano contatori, gauge e istogrammi; /metrics restituisce render().
+#
+# Dove c'e' gia' un server web la route /metrics e' montata li' (CherryPy nel
+# catalog e nel writer, Flask nella dashboard); gli altri processi avviano
+# start_server(port), un http.server minimale in un thread daemon.
+#
+# Costo: un lock e un'addizione per inc(), una bisect per observe(). Le label
+# vanno tenute a bassa cardinalita' (radice del topic, non l'id del palo).
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# secondi: da 0.5 ms (handler in memoria) a 10 s (timeout HTTP)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names, values, extra=()):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    pairs += [f'{n}="{_escape(v)}"' for n, v in extra]
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self._values = {}
+        self._functions = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def set_function(self, fn, *labels):
+        # valore letto al momento dello scrape (es. profondita' di una coda, contatori di un altro oggetto)
+        with self._lock:
+            self._functions[labels] = fn
+
+    def remove(self, *labels):
+        with self._lock:
+            self._values.pop(labels, None)
+            self._functions.pop(labels, None)
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+            functions = list(self._functions.items())
+        out = [(self.name, _labels(self.labelnames, k), v) for k, v in items]
+        for k, fn in functions:
+            try:
+                out.append((self.name, _labels(self.labelnames, k), fn()))
+            except Exception:
+                continue
+        return out
+
+
+class Gauge(Counter):
+    kind = 'gauge'
+
+    def set(self, value, *labels):
+        with self._lock:
+            self._values[labels] = value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self.buckets = tuple(sorted(buckets))
+        self._values = {}   # labels -> [conteggi per bucket..., +Inf, somma]
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        k = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            row = self._values.get(labels)
+            if row is None:
+                row = self._values[labels] = [0] * (len(self.buckets) + 2)
+            row[k] += 1
+            row[-1] += value
+
+    def samples(self):
+        with self._lock:
+            items = [(k, list(row)) for k, row in self._values.items()]
+        out = []
+        for k, row in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),), row):
+                cumulative += count
+                out.append((self.name + '_bucket', _labels(self.labelnames, k, [('le', _number(bound))]), cumulative))
+            out.append((self.name + '_count', _labels(self.labelnames, k), cumulative))
+            out.append((self.name + '_sum', _labels(self.labelnames, k), row[-1]))
+        return out
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help, labels, **kwargs):
+        # stessa metrica richiesta da piu' istanze (es. due gateway nello stesso processo): la si condivide
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help, labels, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError(f'metrica {name} gia\' registrata come {metric.kind}')
+            return metric
+
+    def counter(self, name, help, labels=()):
+        return self._get(Counter, name, help, labels)
+
+    def gauge(self, name, help, labels=()):
+        return self._get(Gauge, name, help, labels)
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, labels, buckets=buckets)
+
+    def render(self):
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        lines = []
+        for metric in metrics:
+            samples = metric.samples()
+            if not samples:
+                continue
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            lines.extend(f'{name}{labels} {_number(value)}' for name, labels, value in samples)
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split('?', 1)[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass   # niente log per ogni scrape
+
+
+_servers = {}
+_servers_lock = threading.Lock()
+
+
+def start_server(port, host='0.0.0.0', registry=REGISTRY):
+    # un server per porta e per processo: piu' Client nello stesso processo lo condividono
+    with _servers_lock:
+        if port in _servers:
+            return _servers[port]
+        handler = type('MetricsHandler', (_Handler,), {'registry': registry})
+        server = ThreadingHTTPServer((host, port), handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, name=f'metrics-{port}', daemon=True).start()
+        _servers[port] = server
+        print(f'[*] Metriche su http://{host}:{port}/metrics')
+        return server
@@ -0,0 +1,63 @@
+# Migrazione del catalog tra backend di storage (vedi catalog_storage.py).
+#
+#   python migrate_catalog.py catalog.json catalog.db     # JSON -> SQLite
+#   python migrate_catalog.py catalog.db catalog.json     # e ritorno
+#
+# Il journal del file JSON viene riapplicato prima della copia, quindi si puo'
+# migrare anche un catalog fermato senza snapshot finale.
+import argparse
+import os
+import sys
+
+from Catalog1 import CatalogSnapshot
+from catalog_storage import open_storage
+
+
+def count(data):
+    gateways = data.get("gateways", [])
+    return len(gateways), sum(len(gw.get("smart_poles", [])) for gw in gateways)
+
+
+def migrate(source, target, force=False):
+    if os.path.exists(target) and not force:
+        raise SystemExit(f"{target} esiste gia' (usa --force per sovrascriverlo)")
+    src = open_storage(source)
+    data = src.load()
+    if data is None:
+        raise SystemExit(f"{source} non trovato o vuoto")
+
+    snap = CatalogSnapshot(data, None).clone()
+    replayed = 0
+    for op in src.replay():
+        snap.apply(op)
+        replayed += 1
+    src.close()
+
+    dst = open_storage(target)
+    dst.write_all(snap.data)
+    dst.close()
+
+    # verifica: il target riletto deve avere gli stessi gateway e pali
+    check = open_storage(target)
+    expected, found = count(snap.data), count(check.load())
+    check.close()
+    print(f"{source} -> {target}: {expected[0]} gateway, {expected[1]} pali, {replayed} op dal journal")
+    if expected != found:
+        raise SystemExit(f"Verifica fallita: attesi {expected}, trovati {found}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('source')
+    parser.add_argument('target')
+    parser.add_argument('--force', action='store_true')
+    args = parser.parse_args()
+    if args.force:
+        for path in (args.target, args.target + '-wal', args.target + '-shm'):
+            if os.path.exists(path):
+                os.remove(path)
+    migrate(args.source, args.target, force=args.force)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,97 +5,821 @@
 # 4. funzione PUT
 # 5. funzione DELETE
 import requests
+from requests.adapters import HTTPAdapter
 import time
+import random
 import paho.mqtt.client as mqtt
 import threading
 import json
+import os
+import struct
+import uuid
+import zlib
+from collections import deque
+from metrics import REGISTRY, start_server
+from service_log import get_logger, hot, ERROR
+
+
+# metriche comuni a tutti i servizi (label a bassa cardinalita': radice del topic, prima parte del path)
+MQTT_RECEIVED = REGISTRY.counter('mqtt_messages_received_total', 'Messaggi MQTT ricevuti', ('client', 'topic'))
+MQTT_PUBLISHED = REGISTRY.counter('mqtt_messages_published_total', 'Messaggi MQTT pubblicati', ('client', 'topic'))
+MQTT_DECODE_ERRORS = REGISTRY.counter('mqtt_decode_errors_total', 'Payload MQTT non decodificabili', ('client', 'topic'))
+MQTT_HANDLER_SECONDS = REGISTRY.histogram('mqtt_handler_seconds', 'Durata degli handler dei messaggi MQTT', ('client', 'topic'))
+DISPATCH_DEPTH = REGISTRY.gauge('mqtt_dispatch_queue_depth', 'Messaggi in coda nel dispatcher', ('client',))
+DISPATCH_DROPPED = REGISTRY.counter('mqtt_dispatch_dropped_total', 'Messaggi scartati dal dispatcher a coda piena', ('client', 'policy'))
+DISPATCH_BLOCKED = REGISTRY.counter('mqtt_dispatch_blocked_total', 'Consegne bloccate dal dispatcher a coda piena', ('client',))
+MQTT_BATCHES = REGISTRY.counter('mqtt_batches_received_total', 'Batch di letture ricevuti dai gateway', ('client', 'topic'))
+MQTT_BATCH_GAPS = REGISTRY.counter('mqtt_batch_gaps_total', 'Batch mancanti nella sequenza di un gateway', ('client', 'topic'))
+CATALOG_SEQ = REGISTRY.gauge('catalog_feed_seq', 'Ultima versione del catalog applicata dal change feed', ('client',))
+REST_SECONDS = REGISTRY.histogram('rest_request_seconds', 'Latenza delle chiamate REST (catalog, writer)',
+                                  ('service', 'method', 'route', 'status'))
+
+
+log = get_logger('client')
+log_handler_error = hot(log, 'handler_error', ERROR, per_second=1)
+
+
+def _topic_root(topic):
+    return topic.split('/', 1)[0]
+
+
+class ServiceUnavailable(Exception):
+    """Circuito aperto: il servizio ha fallito troppe volte di seguito, la chiamata non parte."""
+
+
+class RestSession:
+    """
+    Sessione HTTP condivisa verso un servizio REST (catalog, writer):
+    - pool di connessioni keep-alive (niente handshake TCP a ogni chiamata)
+    - timeout sempre impostato (connect, read)
+    - retry con backoff esponenziale e jitter su errori di rete e 502/503/504;
+      le POST vengono ripetute solo se il chiamante lo chiede (retry=True)
+    - circuit breaker: dopo failure_threshold fallimenti consecutivi le chiamate
+      falliscono subito per reset_timeout secondi, poi ne passa una di prova
+    """
+    RETRY_STATUS = (502, 503, 504)
+
+    def __init__(self, base_url, timeout=(2, 5), retries=2, backoff=0.2, backoff_max=2.0,
+                 failure_threshold=5, reset_timeout=15, pool_size=10):
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._lock = threading.Lock()
+        self._failures = 0
+        self._opened_at = None
+        self._trial = False
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_timeout or self._trial:
+                return False
+            self._trial = True   # half-open: una sola chiamata di prova
+            return True
+
+    def record(self, ok):
+        with self._lock:
+            self._trial = False
+            if ok:
+                self._failures = 0
+                self._opened_at = None
+                return
+            self._failures += 1
+            if self._failures >= self.failure_threshold:
+                if self._opened_at is None:
+                    print(f'[!] {self.base_url} non risponde: circuito aperto per {self.reset_timeout}s')
+                self._opened_at = time.monotonic()
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def request(self, method, path, retry=None, timeout=None, **kwargs):
+        if not self.allow():
+            raise ServiceUnavailable(f'{self.base_url} temporaneamente non disponibile')
+        if retry is None:
+            retry = method in ('GET', 'PUT', 'DELETE', 'HEAD')
+        attempts = 1 + (self.retries if retry else 0)
+        url = f"{self.base_url}/{path.lstrip('/')}"
+        route = path.lstrip('/').split('/', 1)[0]
+        for attempt in range(attempts):
+            error = None
+            start = time.perf_counter()
+            try:
+                r = self.session.request(method, url, timeout=timeout or self.timeout, **kwargs)
+                REST_SECONDS.observe(time.perf_counter() - start, self.base_url, method, route, r.status_code)
+                if r.status_code not in self.RETRY_STATUS:
+                    self.record(True)
+                    return r
+            except (requests.ConnectionError, requests.Timeout) as e:
+                REST_SECONDS.observe(time.perf_counter() - start, self.base_url, method, route, 'error')
+                error = e
+            except Exception:
+                self.record(False)   # chiude anche l'eventuale prova half-open
+                raise
+            if attempt + 1 < attempts:
+                # full jitter: i client non ritentano tutti nello stesso istante
+                time.sleep(random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt)))
+        self.record(False)
+        if error is not None:
+            raise error
+        return r
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request('PUT', path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request('DELETE', path, **kwargs)
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+def rest_session(base_url):
+    # una sola sessione (e un solo pool) per servizio in tutto il processo
+    key = base_url.rstrip('/')
+    with _sessions_lock:
+        if key not in _sessions:
+            _sessions[key] = RestSession(key)
+        return _sessions[key]
+
+
+# --- codec dei payload MQTT ---
+# Il codec di ogni topic e' scelto nel catalog (sezione "codecs"). I payload
+# binari iniziano con un byte di intestazione che identifica il codec; quelli
+# JSON no (iniziano con '{' o '['), quindi pali e servizi vecchi e nuovi
+# possono convivere sugli stessi topic: chi decodifica riconosce il formato.
+try:
+    import orjson as _fast_json
+except ImportError:
+    _fast_json = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JsonCodec:
+    """JSON testuale; con orjson installato si usa quello (stesso formato sul filo)."""
+    name = 'json'
+    header = None
+
+    def can_encode(self, obj):
+        return True
+
+    def encode(self, obj):
+        if _fast_json is not None:
+            return _fast_json.dumps(obj)
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
+    def decode(self, payload):
+        if _fast_json is not None:
+            return _fast_json.loads(payload)
+        return json.loads(payload)
+
+
+class MsgpackCodec:
+    """MessagePack (libreria msgpack, opzionale): senza la libreria si codifica in JSON."""
+    name = 'msgpack'
+    header = b'\x01'
+
+    def can_encode(self, obj):
+        return msgpack is not None
+
+    def encode(self, obj):
+        return self.header + msgpack.packb(obj, use_bin_type=True)
+
+    def decode(self, payload):
+        if msgpack is None:
+            raise ValueError('payload msgpack ma la libreria msgpack non e\' installata')
+        return msgpack.unpackb(payload[1:], raw=False)
+
+
+class TelemetryCodec:
+    """
+    Record fisso per le misure dei pali (il messaggio dati di PolePublisher):
+    header, timestamp uint32, temperature/humidity/tilt float32, poi id e topic
+    come stringhe con lunghezza su un byte. I float32 vengono riportati a 2
+    decimali, la precisione del publisher. Gli altri messaggi (config,
+    unregister, ...) non hanno questa forma e restano JSON.
+    """
+    name = 'telemetry'
+    header = b'\x02'
+    FIELDS = ('id', 'timestamp', 'temperature', 'humidity', 'tilt', 'topic')
+    _record = struct.Struct('<cIfff')
+
+    def can_encode(self, obj):
+        if not isinstance(obj, dict) or obj.keys() != set(self.FIELDS):
+            return False
+        if not isinstance(obj['id'], str) or not isinstance(obj['topic'], str):
+            return False
+        if len(obj['id'].encode('utf-8')) > 255 or len(obj['topic'].encode('utf-8')) > 255:
+            return False
+        return (isinstance(obj['timestamp'], int) and 0 <= obj['timestamp'] < 2 ** 32
+                and all(isinstance(obj[k], (int, float)) and not isinstance(obj[k], bool)
+                        for k in ('temperature', 'humidity', 'tilt')))
+
+    def encode(self, obj):
+        pole_id = obj['id'].encode('utf-8')
+        topic = obj['topic'].encode('utf-8')
+        return (self._record.pack(self.header, obj['timestamp'], obj['temperature'], obj['humidity'], obj['tilt'])
+                + bytes((len(pole_id),)) + pole_id + bytes((len(topic),)) + topic)
+
+    def decode(self, payload):
+        try:
+            _, timestamp, temperature, humidity, tilt = self._record.unpack_from(payload)
+            pos = self._record.size
+            n = payload[pos]
+            pole_id = payload[pos + 1:pos + 1 + n].decode('utf-8')
+            pos += 1 + n
+            n = payload[pos]
+            topic = payload[pos + 1:pos + 1 + n].decode('utf-8')
+        except (struct.error, IndexError) as e:
+            raise ValueError(f'record telemetry non valido: {e}')
+        return {'id': pole_id, 'timestamp': timestamp, 'temperature': round(temperature, 2),
+                'humidity': round(humidity, 2), 'tilt': round(tilt, 2), 'topic': topic}
+
+
+CODECS = {codec.name: codec for codec in (JsonCodec(), MsgpackCodec(), TelemetryCodec())}
+_CODEC_BY_HEADER = {codec.header[0]: codec for codec in CODECS.values() if codec.header}
+
+
+def get_codec(name):
+    # codec sconosciuto (catalog piu' nuovo del servizio): JSON, che tutti sanno leggere
+    return CODECS.get(name) or CODECS['json']
+
+
+def encode_payload(obj, codec='json'):
+    codec = get_codec(codec)
+    if not codec.can_encode(obj):
+        codec = CODECS['json']
+    return codec.encode(obj)
+
+
+def payload_codec(payload):
+    # nome del codec con cui e' stato codificato un payload (dal primo byte)
+    codec = _CODEC_BY_HEADER.get(payload[0]) if payload else None
+    return codec.name if codec else 'json'
+
+
+def decode_payload(payload):
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    codec = _CODEC_BY_HEADER.get(payload[0]) if payload else None
+    return (codec or CODECS['json']).decode(payload)
+
+
+# Batch di letture dei gateway verso il broker centrale (uplink a blocchi):
+# header 0x03, flags, seq uint32, numero di letture uint16, poi per ogni lettura
+# topic originale (lunghezza uint16) e payload gia' codificato (lunghezza uint32).
+# Con il flag zlib tutto cio' che segue l'intestazione e' compresso.
+BATCH_HEADER = b'\x03'
+BATCH_ZLIB = 0x01
+BATCH_MAX_READINGS = 0xFFFF
+_batch_head = struct.Struct('<cBIH')
+_u16 = struct.Struct('<H')
+_u32 = struct.Struct('<I')
+
+
+def pack_batch(entries, seq, compress=True):
+    # entries: [(topic, payload)]; si comprime solo se conviene
+    parts = []
+    for topic, payload in entries:
+        topic = topic.encode('utf-8')
+        parts += (_u16.pack(len(topic)), topic, _u32.pack(len(payload)), payload)
+    body = b''.join(parts)
+    flags = 0
+    if compress:
+        packed = zlib.compress(body, 6)
+        if len(packed) < len(body):
+            body, flags = packed, BATCH_ZLIB
+    return _batch_head.pack(BATCH_HEADER, flags, seq & 0xFFFFFFFF, len(entries)) + body
+
+
+def is_batch(payload):
+    return payload[:1] == BATCH_HEADER
+
+
+def unpack_batch(payload):
+    # -> (seq, [(topic, payload)])
+    try:
+        _, flags, seq, count = _batch_head.unpack_from(payload)
+        body = payload[_batch_head.size:]
+        if flags & BATCH_ZLIB:
+            body = zlib.decompress(body)
+        entries = []
+        pos = 0
+        for _ in range(count):
+            (n,) = _u16.unpack_from(body, pos)
+            topic = body[pos + 2:pos + 2 + n].decode('utf-8')
+            pos += 2 + n
+            (n,) = _u32.unpack_from(body, pos)
+            entries.append((topic, body[pos + 4:pos + 4 + n]))
+            pos += 4 + n
+    except (struct.error, zlib.error, UnicodeDecodeError) as e:
+        raise ValueError(f'batch non valido: {e}')
+    return seq, entries
+
+
+class BatchedMessage:
+    # una lettura estratta da un batch: agli handler arriva come un messaggio paho
+    __slots__ = ('topic', 'payload', 'qos', 'retain', 'mid')
+
+    def __init__(self, topic, payload, qos=0):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = False
+        self.mid = 0
+
+
+class _Shard:
+    # una coda del dispatcher con i suoi contatori (aggiornati sotto il suo lock)
+    def __init__(self, capacity):
+        self.items = deque()
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.not_empty = threading.Condition(self.lock)
+        self.not_full = threading.Condition(self.lock)
+        self.received = 0
+        self.handled = 0
+        self.errors = 0
+        self.dropped_oldest = 0
+        self.dropped_newest = 0
+        self.blocked = 0
+        self.max_depth = 0
+
+
+class MessageDispatcher:
+    """
+    Gli handler MQTT girano su un pool di worker invece che sul thread di rete
+    di paho, che resta libero per keepalive e altre consegne.
+    - coda limitata a maxsize messaggi; quando e' piena la policy decide:
+      'block' (il thread di rete aspetta: backpressure verso il broker),
+      'drop_oldest' (si scarta il messaggio in coda da piu' tempo),
+      'drop_newest' (si scarta quello appena arrivato)
+    - key(msg) opzionale: i messaggi con la stessa chiave (es. id del palo)
+      vanno sempre allo stesso worker e vengono gestiti in ordine
+    - stats(): profondita' della coda e contatori
+    """
+    POLICIES = ('block', 'drop_oldest', 'drop_newest')
+
+    def __init__(self, handler, workers=4, maxsize=1000, policy='block', key=None, name='dispatch'):
+        if policy not in self.POLICIES:
+            raise ValueError(f'policy sconosciuta: {policy} (ammesse: {", ".join(self.POLICIES)})')
+        self.handler = handler
+        self.workers = workers
+        self.maxsize = maxsize
+        self.policy = policy
+        self.key = key
+        self._closed = False
+        # con la chiave una coda per worker (l'ordine per chiave e' garantito), senza una coda condivisa
+        n_shards = workers if key else 1
+        self._shards = [_Shard(max(1, maxsize // n_shards)) for _ in range(n_shards)]
+        self._threads = []
+        for i in range(workers):
+            shard = self._shards[i % n_shards]
+            t = threading.Thread(target=self._worker, args=(shard,), name=f'{name}-worker-{i}', daemon=True)
+            t.start()
+            self._threads.append(t)
+
+    def submit(self, client, userdata, msg):
+        # firma di on_message: si puo' assegnare direttamente al client paho
+        shard = self._shards[0]
+        if self.key is not None and len(self._shards) > 1:
+            try:
+                shard = self._shards[hash(self.key(msg)) % len(self._shards)]
+            except Exception:
+                pass
+        with shard.lock:
+            shard.received += 1
+            if len(shard.items) >= shard.capacity:
+                if self.policy == 'drop_newest':
+                    shard.dropped_newest += 1
+                    return False
+                if self.policy == 'drop_oldest':
+                    shard.items.popleft()
+                    shard.dropped_oldest += 1
+                else:
+                    shard.blocked += 1
+                    while len(shard.items) >= shard.capacity and not self._closed:
+                        shard.not_full.wait()
+            shard.items.append((client, userdata, msg))
+            shard.max_depth = max(shard.max_depth, len(shard.items))
+            shard.not_empty.notify()
+        return True
+
+    def _worker(self, shard):
+        while True:
+            with shard.lock:
+                while not shard.items and not self._closed:
+                    shard.not_empty.wait()
+                if not shard.items:
+                    return
+                item = shard.items.popleft()
+                shard.not_full.notify()
+            ok = True
+            try:
+                self.handler(*item)
+            except Exception as e:
+                ok = False
+                log_handler_error('Error on mqtt message: %s', e)
+            with shard.lock:
+                shard.handled += 1
+                if not ok:
+                    shard.errors += 1
+
+    def depth(self):
+        return sum(len(shard.items) for shard in self._shards)
+
+    def stats(self):
+        totals = {'depth': 0, 'max_depth': 0, 'received': 0, 'handled': 0, 'errors': 0,
+                  'dropped_oldest': 0, 'dropped_newest': 0, 'blocked': 0}
+        for shard in self._shards:
+            with shard.lock:
+                totals['depth'] += len(shard.items)
+                totals['max_depth'] = max(totals['max_depth'], shard.max_depth)
+                for k in ('received', 'handled', 'errors', 'dropped_oldest', 'dropped_newest', 'blocked'):
+                    totals[k] += getattr(shard, k)
+        totals.update(workers=self.workers, maxsize=self.maxsize, policy=self.policy)
+        return totals
+
+    def stop(self, timeout=5):
+        # i worker finiscono quello che e' gia' in coda e poi escono
+        self._closed = True
+        for shard in self._shards:
+            with shard.lock:
+                shard.not_empty.notify_all()
+                shard.not_full.notify_all()
+        deadline = time.monotonic() + timeout
+        for t in self._threads:
+            t.join(max(0, deadline - time.monotonic()))
+
 
 class Client():
     def __init__(self, catalog_url, type=''):
         self.catalog_url = catalog_url
+        self.http = rest_session(catalog_url)   # tutte le chiamate al catalog passano da qui
         self.client_id = ''
         self.broker = {}
         self.topics = []
         self.type = type
+        self._catalog_cache = {}  # (path, params) -> (ETag, body)
+        # change feed del catalog: ultima versione applicata
+        self.feed_topic = 'catalog/changes'
+        self.catalog_epoch = None
+        self.catalog_seq = 0
+        self._feed_lock = threading.RLock()
+        # ultimo bootstrap valido salvato su disco: si parte anche con il catalog lento o giu'
+        self.bootstrap_data = {}
+        self.codecs = {}   # sezione "codecs" del catalog: topic -> codec dei payload
+        # servizi scalati: gruppo della shared subscription e id della singola istanza
+        self.share_group = None
+        self.instance_id = None
+        self.bootstrap_file = 'bootstrap_' + '_'.join(str(v) for v in self.bootstrap_params().values()) + '.json'
+        self.client = None   # creato da prepare(): il client id arriva dal bootstrap
+        self.ready = False   # True dopo prepare(): client paho creato e setup() eseguito
+        self._batch_seq = {}   # topic del batch -> ultimo seq visto
+        self.on_publish = self.publish
 
-        # Get initial info and register
-        self.get_connection_info()
+        self.updater_thread = threading.Thread(target=self.refresh_get, daemon=True)
+        self.dispatcher = None   # None: gli handler girano sul thread di rete di paho
+
+        # Get initial info (dal catalog o dal bootstrap salvato); se manca tutto si aspetta in prepare()
+        self.get_connection_info(use_cache=True)
+
+    def setup(self):
+        # le sottoclassi leggono qui bootstrap_data: chiamato una volta da prepare(),
+        # con il bootstrap applicato e il client paho gia' creato
+        pass
+
+    def prepare(self):
+        # bootstrap -> id dell'istanza -> client paho -> setup() della sottoclasse
+        if self.ready:
+            return
+        while True:
+            # senza catalog e senza bootstrap salvato non si sa a quale broker collegarsi: si aspetta
+            if self.broker and self.share_group and self.instance_id is None:
+                self.request_instance_id()
+            if self.broker:
+                break
+            print('Catalog non raggiungibile e nessun bootstrap salvato, nuovo tentativo tra 5s...')
+            time.sleep(5)
+            self.get_connection_info()
 
         self.client = mqtt.Client(
             callback_api_version=mqtt.CallbackAPIVersion.VERSION2,
             client_id=self.client_id
         )
-
-        self.client.on_connect = self.connect
-        self.client.on_message = self.message
+        self.client.on_connect = self._on_connect
+        self.client.on_message = self._unbatch(self._metered(self.message))
+        self.client.message_callback_add(self.feed_topic, self.on_catalog_feed)
+        self.instrument(self.client)
+        CATALOG_SEQ.set_function(lambda: self.catalog_seq, self.client_id)
         self.client.on_disconnect = self.disconnect
-        self.on_publish = self.publish
+        self.setup()
+        self.ready = True
 
-        self.updater_thread = threading.Thread(target=self.refresh_get, daemon=True)
+    def enable_dispatch(self, workers=4, maxsize=1000, policy='block', key=None, handler=None, client=None):
+        # message() (o handler) passa da una coda limitata servita da un pool di worker
+        dispatcher = MessageDispatcher(self._metered(handler or self.message), workers=workers, maxsize=maxsize,
+                                       policy=policy, key=key, name=self.type or 'client')
+        (client or self.client).on_message = self._unbatch(dispatcher.submit)
+        DISPATCH_DEPTH.set_function(dispatcher.depth, self.client_id)
+        DISPATCH_DROPPED.set_function(lambda: dispatcher.stats()['dropped_oldest'], self.client_id, 'drop_oldest')
+        DISPATCH_DROPPED.set_function(lambda: dispatcher.stats()['dropped_newest'], self.client_id, 'drop_newest')
+        DISPATCH_BLOCKED.set_function(lambda: dispatcher.stats()['blocked'], self.client_id)
+        self.dispatcher = dispatcher
+        return dispatcher
+
+    def _metered(self, handler):
+        # conteggio dei messaggi e durata dell'handler, per radice del topic
+        def run(client, userdata, msg):
+            topic = _topic_root(msg.topic)
+            MQTT_RECEIVED.inc(self.client_id, topic)
+            start = time.perf_counter()
+            try:
+                return handler(client, userdata, msg)
+            finally:
+                MQTT_HANDLER_SECONDS.observe(time.perf_counter() - start, self.client_id, topic)
+        return run
+
+    def _unbatch(self, handler):
+        # i batch dei gateway diventano una consegna per lettura, con il topic originale:
+        # gli handler (e il dispatcher, con la sua chiave per palo) non vedono la differenza
+        def run(client, userdata, msg):
+            if not is_batch(msg.payload):
+                return handler(client, userdata, msg)
+            try:
+                seq, entries = unpack_batch(msg.payload)
+            except ValueError:
+                MQTT_DECODE_ERRORS.inc(self.client_id, _topic_root(msg.topic))
+                return
+            self.track_batch(msg.topic, seq)
+            for topic, payload in entries:
+                try:
+                    handler(client, userdata, BatchedMessage(topic, payload, msg.qos))
+                except Exception as e:
+                    log_handler_error('Error on mqtt message: %s', e)
+        return run
+
+    def track_batch(self, topic, seq):
+        root = _topic_root(topic)
+        MQTT_BATCHES.inc(self.client_id, root)
+        last = self._batch_seq.get(topic)
+        self._batch_seq[topic] = seq
+        # con una shared subscription i batch si dividono tra le istanze: i buchi sono normali
+        if last is not None and seq > last + 1 and not self.share_group:
+            MQTT_BATCH_GAPS.inc(self.client_id, root, amount=seq - last - 1)
+
+    def instrument(self, client):
+        # conta le publish di un client paho senza toccare le chiamate client.publish(...) dei servizi
+        publish = client.publish
+
+        def counted(topic, payload=None, qos=0, retain=False, properties=None):
+            MQTT_PUBLISHED.inc(self.client_id, _topic_root(topic))
+            return publish(topic, payload, qos, retain, properties)
+        client.publish = counted
 
     def register(self):
         data = {'type': self.type, 'id': self.client_id}
         try:
-            r = requests.post(f'{self.catalog_url}/{self.type}', json=data)
+            r = self.http.post(self.type, json=data, retry=True)
             print('Registration status code: ', r.status_code)
         except Exception as e:
             print('Impossible registration, error: ', e)
 
-    def get_connection_info(self):
+    def request_instance_id(self):
+        # piu' istanze dello stesso servizio: ognuna ha il suo client id (il broker disconnette i doppioni)
         try:
-            self.get_broker()
-            self.get_topics()
-            self.get_client_id()
+            r = self.http.post('instance', json={'type': self.type}, retry=False)
+            r.raise_for_status()
+            self.instance_id = r.json()['client_id']
         except Exception as e:
-            print('GET connection info error: ', e)
+            # catalog non raggiungibile (avvio dal bootstrap salvato): id locale, comunque univoco
+            self.instance_id = f'{self.type}-{uuid.uuid4().hex[:8]}'
+            print(f'Impossible POST instance ({e}), id locale {self.instance_id}')
+        self.client_id = self.instance_id
+        print(f'Istanza {self.client_id}, shared subscription {self.share_group}')
 
-    def get_broker(self):
+    def subscription(self, topic):
+        # con un gruppo condiviso il broker consegna ogni messaggio a una sola istanza del servizio
+        if self.share_group:
+            return f'$share/{self.share_group}/{topic}/#'
+        return f'{topic}/#'
+
+    def bootstrap_params(self):
+        # le sottoclassi aggiungono i parametri che identificano l'istanza (es. coordinate)
+        return {'type': self.type}
+
+    def get_connection_info(self, use_cache=False):
+        # GET /bootstrap: broker, topics, client id e versione del catalog in una sola richiesta
+        cached = self.load_bootstrap() if use_cache else None
         try:
-            r = requests.get(f'{self.catalog_url}/central_broker').json()
-            self.broker = r
-            print('Broker info successfully obtained: ', r)
+            # con una copia locale non si aspetta un catalog lento: timeout corto, nessun retry
+            kwargs = {'timeout': (1, 2), 'retry': False} if cached else {}
+            data = self.get_catalog('bootstrap', params=list(self.bootstrap_params().items()), **kwargs)
         except Exception as e:
-            print('Impossibile GET broker info, error: ', e)
+            if cached is None:
+                print('GET bootstrap error: ', e)
+                return False
+            print(f'Catalog non raggiungibile ({e}): avvio dal bootstrap salvato, riallineamento in background')
+            self.apply_bootstrap(cached)
+            threading.Thread(target=self._reconcile_bootstrap, daemon=True).start()
+            return False
+        self.apply_bootstrap(data)
+        self.save_bootstrap(data)
+        return True
 
-    def get_topics(self):
+    def apply_bootstrap(self, data):
+        with self._feed_lock:
+            self.bootstrap_data = data
+            # la versione viene letta insieme ai dati: i delta successivi arrivano dal change feed
+            self.catalog_epoch = data['epoch']
+            self.catalog_seq = data['version']
+            self.broker = data['central_broker']
+            self.topics = data['topics']
+            self.client_id = self.instance_id or data['client_id']
+            self.share_group = data.get('share_group')
+            self.codecs = data.get('codecs') or {}
+        print(f'Bootstrap: broker {self.broker}, topics {self.topics}, id {self.client_id}')
+
+    def load_bootstrap(self):
         try:
-            r = requests.get(f'{self.catalog_url}/topic', params=[('type', self.type)]).json()
-            self.topics = r
-            print('Topics info successfully obtained: ', self.topics)
-        except Exception as e:
-            print('Impossibile GET topics, error', e)
+            with open(self.bootstrap_file) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return saved['bootstrap'] if saved.get('catalog_url') == self.catalog_url else None
 
-    def get_client_id(self):
+    def save_bootstrap(self, data):
         try:
-            r = requests.get(f'{self.catalog_url}/compute_id', params=[('type', self.type)]).json()
-            self.client_id = r['id']
-            print(f'Mqtt client obtained: ', self.client_id)
+            tmp = self.bootstrap_file + '.tmp'
+            with open(tmp, 'w') as f:
+                json.dump({'catalog_url': self.catalog_url, 'saved_at': time.time(), 'bootstrap': data}, f)
+            os.replace(tmp, self.bootstrap_file)
+        except OSError as e:
+            print('Impossible to save bootstrap, error: ', e)
+
+    def _reconcile_bootstrap(self):
+        # partiti dalla copia su disco: appena il catalog risponde si riallinea tutto
+        delay = 1
+        while not self.get_connection_info():
+            time.sleep(delay)
+            delay = min(delay * 2, 30)
+        print('Bootstrap riallineato con il catalog')
+        # prima di prepare() non c'e' niente da riallineare: setup() leggera' il bootstrap nuovo
+        if self.ready:
+            self.on_catalog_resync()
+
+    def get_catalog(self, path, params=None, **kwargs):
+        # GET condizionale: se il catalog non e' cambiato risponde 304 e si riusa la copia locale
+        key = (path, tuple(params or ()))
+        cached = self._catalog_cache.get(key)
+        headers = {'If-None-Match': cached[0]} if cached else {}
+        r = self.http.get(path, params=params, headers=headers, **kwargs)
+        if r.status_code == 304 and cached:
+            return json.loads(cached[1])
+        r.raise_for_status()
+        data = r.json()
+        if r.headers.get('ETag'):
+            self._catalog_cache[key] = (r.headers['ETag'], r.content)
+        return data
+
+    def get_catalog_version(self):
+        try:
+            r = self.http.get('version').json()
+            with self._feed_lock:
+                self.catalog_epoch = r['epoch']
+                self.catalog_seq = r['version']
         except Exception as e:
-            print('Impossible GET client id, error: ', e)
+            print('Impossible GET catalog version, error: ', e)
+
+    def on_catalog_feed(self, client, userdata, msg):
+        try:
+            change = json.loads(msg.payload)
+        except ValueError:
+            return
+        self.apply_catalog_change(change)
+
+    def apply_catalog_change(self, change):
+        with self._feed_lock:
+            if change.get('epoch') != self.catalog_epoch or change['seq'] > self.catalog_seq + 1:
+                # buco nella sequenza (o catalog riavviato): recupera i delta mancanti
+                self.catch_up()
+                return
+            if change['seq'] <= self.catalog_seq:
+                return  # gia' applicato (es. messaggio retained)
+            for event in change['events']:
+                self.on_catalog_event(event)
+            self.catalog_seq = change['seq']
+
+    def catch_up(self):
+        with self._feed_lock:
+            try:
+                r = self.http.get('changes', params={'since': self.catalog_seq}).json()
+            except Exception as e:
+                print('Impossible GET catalog changes, error: ', e)
+                return
+            if r.get('resync') or r.get('epoch') != self.catalog_epoch:
+                print('Catalog change feed out of sync, full refresh...')
+                self.resync()
+                return
+            for change in r['changes']:
+                for event in change['events']:
+                    self.on_catalog_event(event)
+                self.catalog_seq = change['seq']
+
+    def resync(self):
+        with self._feed_lock:
+            self.get_connection_info()
+            self.on_catalog_resync()
+
+    def on_catalog_event(self, event):
+        # le sottoclassi estendono questo metodo per i delta che le riguardano
+        if event['type'] == 'topics_changed' and event['service'] == self.type:
+            old = self._topic_list(self.topics)
+            self.topics = event['topics']
+            if self.client.is_connected():
+                for topic in self._topic_list(self.topics):
+                    if topic not in old:
+                        self.client.subscribe(self.subscription(topic))
+                for topic in old:
+                    if topic not in self._topic_list(self.topics):
+                        self.client.unsubscribe(self.subscription(topic))
+        elif event['type'] == 'value_changed' and event['path'] == ['central_broker']:
+            self.broker = event['value']  # usato alla prossima connessione
+        elif event['type'] == 'value_changed' and event['path'] == ['codecs']:
+            self.codecs = event['value']
+
+    def on_catalog_resync(self):
+        pass
+
+    def codec_for(self, topic):
+        # il catalog indica il codec per radice del topic (es. "poleData"), altrimenti quello di default
+        root = topic.split('/', 1)[0]
+        return self.codecs.get('topics', {}).get(root) or self.codecs.get('default') or 'json'
+
+    def encode(self, topic, obj):
+        return encode_payload(obj, self.codec_for(topic))
+
+    def decode(self, msg):
+        try:
+            return decode_payload(msg.payload)
+        except Exception:
+            MQTT_DECODE_ERRORS.inc(self.client_id, _topic_root(msg.topic))
+            raise
+
+    def _topic_list(self, topics):
+        if isinstance(topics, dict):
+            return list(topics.get('subscribe', []))
+        return list(topics)
 
     def refresh_get(self):
         while True:
             time.sleep(300) # Increased to 5 minutes to be polite to the server
             print('Refreshing info from catalog...')
             try:
-                self.get_connection_info()
+                self.resync()
             except Exception as e:
                 print(f"Update failed: {e}")
 
+    def _on_connect(self, client, userdata, flags, reason_code, properties):
+        self.connect(client, userdata, flags, reason_code, properties)
+        self.subscribe_catalog_feed(client)
+
+    def subscribe_catalog_feed(self, client):
+        client.subscribe(self.feed_topic, qos=1)
+
     def connect(self, client, userdata, flags, reason_code, properties):
         print(f"Connection status: {reason_code}")
         # Automatically subscribe to topics found in catalog upon connection
         for topic in self.topics:
-            client.subscribe(f'{topic}/#')
+            client.subscribe(self.subscription(topic))
             print(f"Subscribed to {topic}")
 
     def message(self, client, userdata, msg):
         try:
-            payload = msg.payload.decode()
-            data = json.loads(payload)
-            print(f"Received data on {msg.topic}: {data}")
+            data = self.decode(msg)
+            log.debug('Received data on %s: %s', msg.topic, data)
         except Exception as e:
-            print('Error on mqtt message: ', e)
+            log_handler_error('Error on mqtt message: %s', e)
 
     def disconnect(self, client, userdata, disconnect_flags, reason_code, properties):
         print('Disconnection code: ', reason_code)
@@ -103,10 +827,10 @@ class Client():
     def subscribe(self, topic, qos=0):
         if topic not in self.topics:
             try:
-                self.client.subscribe(f'{topic}/#', qos)
+                self.client.subscribe(self.subscription(topic), qos)
                 self.topics.append(topic)
                 data = {'new_topics': self.topics}
-                requests.put(f'{self.catalog_url}/topic', params=[('type', self.type)], json=data)
+                self.http.put('topic', params=[('type', self.type)], json=data)
                 print(f'Successfully subscribed to {topic}')
             except Exception as e:
                 print('Impossible to subscribe, error: ', e)
@@ -116,10 +840,10 @@ class Client():
     def unsubscribe(self, topic):
         if topic in self.topics:
             try:
-                self.client.unsubscribe(topic)
+                self.client.unsubscribe(self.subscription(topic))
                 self.topics.remove(topic)
                 data = {'new_topics': self.topics}
-                requests.put(f'{self.catalog_url}/topic', params=[('type', self.type)], json=data)
+                self.http.put('topic', params=[('type', self.type)], json=data)
                 print(f'Successfully unsubscribed from {topic}')
             except Exception as e:
                 print('Impossible to unsubscribe, error: ', e)
@@ -129,7 +853,20 @@ class Client():
     def publish(self, client, userdata, mid, reason_code=None, properties=None):
         print(f"Message {mid} published successfully.")
 
+    def start_metrics(self):
+        # /metrics su un server proprio, se il catalog assegna una porta a questo servizio
+        port = self.bootstrap_data.get('metrics_port')
+        if port:
+            # piu' istanze sulla stessa macchina (launch_workers.py): una porta ciascuna
+            port = int(port) + int(os.environ.get('METRICS_PORT_OFFSET', 0))
+            try:
+                start_server(port)
+            except OSError as e:
+                print('Impossible to start metrics server, error: ', e)
+
     def start(self):
+        self.prepare()
+        self.start_metrics()
         # Use loop_start() so it doesn't block the main thread
         self.register()
         self.client.connect(self.broker['address'], int(self.broker['port']))
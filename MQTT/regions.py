@@ -0,0 +1,83 @@
+# Indice spaziale delle regioni condiviso da catalog, gateway e publisher.
+# I bounding box delle regioni si sovrappongono: vince sempre la regione con
+# area minore (a parita' di area, il nome), quindi il risultato non dipende
+# dall'ordine del dizionario.
+import math
+
+try:
+    import numpy as np
+except ImportError:  # lookup_many ricade sulla griglia, punto per punto
+    np = None
+
+
+ITALIAN_REGIONS = {
+    "Piemonte": {"minLat": 44.1, "maxLat": 46.5, "minLon": 6.6, "maxLon": 9.2},
+    "Valle d'Aosta": {"minLat": 45.6, "maxLat": 46.5, "minLon": 6.8, "maxLon": 7.9},
+    "Lombardia": {"minLat": 44.8, "maxLat": 46.6, "minLon": 8.5, "maxLon": 11.5},
+    "Trentino-Alto Adige": {"minLat": 45.7, "maxLat": 47.1, "minLon": 10.4, "maxLon": 12.5},
+    "Veneto": {"minLat": 44.8, "maxLat": 46.6, "minLon": 10.7, "maxLon": 13.1},
+    "Friuli-Venezia Giulia": {"minLat": 45.5, "maxLat": 46.7, "minLon": 12.3, "maxLon": 13.9},
+    "Liguria": {"minLat": 43.8, "maxLat": 44.7, "minLon": 7.5, "maxLon": 10.1},
+    "Emilia-Romagna": {"minLat": 43.7, "maxLat": 45.1, "minLon": 9.2, "maxLon": 12.8},
+    "Toscana": {"minLat": 42.2, "maxLat": 44.5, "minLon": 9.6, "maxLon": 11.8},
+    "Umbria": {"minLat": 42.6, "maxLat": 43.6, "minLon": 11.9, "maxLon": 12.9},
+    "Marche": {"minLat": 42.7, "maxLat": 44.0, "minLon": 12.2, "maxLon": 13.9},
+    "Lazio": {"minLat": 41.2, "maxLat": 42.9, "minLon": 11.4, "maxLon": 14.0},
+    "Abruzzo": {"minLat": 41.6, "maxLat": 42.9, "minLon": 13.0, "maxLon": 14.8},
+    "Molise": {"minLat": 41.4, "maxLat": 42.0, "minLon": 14.3, "maxLon": 15.1},
+    "Campania": {"minLat": 40.0, "maxLat": 41.5, "minLon": 13.7, "maxLon": 15.8},
+    "Puglia": {"minLat": 39.8, "maxLat": 42.1, "minLon": 14.8, "maxLon": 18.5},
+    "Basilicata": {"minLat": 39.9, "maxLat": 41.3, "minLon": 15.3, "maxLon": 16.9},
+    "Calabria": {"minLat": 37.9, "maxLat": 40.2, "minLon": 15.6, "maxLon": 17.2},
+    "Sicilia": {"minLat": 36.6, "maxLat": 38.3, "minLon": 12.3, "maxLon": 15.7},
+    "Sardegna": {"minLat": 38.9, "maxLat": 41.3, "minLon": 8.1, "maxLon": 9.9},
+}
+
+
+class RegionIndex:
+    """
+    Griglia regolare (cell gradi per lato): ogni cella conosce le sole regioni
+    che la toccano, gia' ordinate per area. Un lookup controlla 1-3 box invece di 20.
+    """
+    def __init__(self, regions=None, cell=0.1):
+        regions = ITALIAN_REGIONS if regions is None else regions
+        area = lambda b: (b["maxLat"] - b["minLat"]) * (b["maxLon"] - b["minLon"])
+        self.names = sorted(regions, key=lambda n: (area(regions[n]), n))
+        self.boxes = [
+            (regions[n]["minLat"], regions[n]["maxLat"], regions[n]["minLon"], regions[n]["maxLon"])
+            for n in self.names
+        ]
+        self.cell = cell
+        self.min_lat = min((b[0] for b in self.boxes), default=0.0)
+        self.min_lon = min((b[2] for b in self.boxes), default=0.0)
+        self.grid = {}  # (riga, colonna) -> indici delle regioni, in ordine di area
+        for k, (min_lat, max_lat, min_lon, max_lon) in enumerate(self.boxes):
+            for i in range(self._row(min_lat), self._row(max_lat) + 1):
+                for j in range(self._col(min_lon), self._col(max_lon) + 1):
+                    self.grid.setdefault((i, j), []).append(k)
+
+    def _row(self, lat):
+        return math.floor((lat - self.min_lat) / self.cell)
+
+    def _col(self, lon):
+        return math.floor((lon - self.min_lon) / self.cell)
+
+    def lookup(self, lat, lon):
+        for k in self.grid.get((self._row(lat), self._col(lon)), ()):
+            min_lat, max_lat, min_lon, max_lon = self.boxes[k]
+            if min_lat <= lat <= max_lat and min_lon <= lon <= max_lon:
+                return self.names[k]
+        return None
+
+    def lookup_many(self, points):
+        # points: sequenza di (lat, lon); con numpy un solo passaggio vettoriale per regione
+        if np is None:
+            return [self.lookup(lat, lon) for lat, lon in points]
+        pts = np.asarray(points, dtype=float).reshape(-1, 2)
+        lat, lon = pts[:, 0], pts[:, 1]
+        found = np.full(len(pts), -1)
+        # dalla regione piu' grande alla piu' piccola: l'ultima assegnazione vince
+        for k in reversed(range(len(self.boxes))):
+            min_lat, max_lat, min_lon, max_lon = self.boxes[k]
+            found[(lat >= min_lat) & (lat <= max_lat) & (lon >= min_lon) & (lon <= max_lon)] = k
+        return [self.names[k] if k >= 0 else None for k in found.tolist()]
@@ -3,6 +3,11 @@ import paho.mqtt.client as mqtt
 import json
 import random
 import threading # Aggiunto per gestire il loop senza bloccare MQTT
+from mqtt_client import encode_payload, decode_payload, rest_session
+from service_log import get_logger, hot, DEBUG
+
+log = get_logger('pole')
+log_published = hot(log, 'published', DEBUG, per_second=1)
 
 # Limitare intervallo publish
 
@@ -12,8 +17,11 @@ class PolePublisher:
     
     broker = config["broker"]["address"]
     port = config["broker"]["port"]
-    regions = config["regions"] 
+    # le regioni stanno solo nel catalog: il palo chiede la sua (GET /regions/lookup)
+    catalog = rest_session(config.get("catalog_url", "http://localhost:8080"))
     topic = config["topic"]
+    # codec delle misure: json, msgpack o telemetry (record binario fisso), vedi mqtt_client.CODECS
+    codec = config.get("codec", "json")
 
     def __init__(self, coordinates):
         # Caratteristiche del palo
@@ -22,7 +30,7 @@ class PolePublisher:
         self.sensors = PolePublisher.config["sensors"]
         self.lat = coordinates['lat']
         self.long = coordinates['long']
-        self.region = self.get_region(self.lat, self.long, PolePublisher.regions)
+        self.region = self.get_region(self.lat, self.long)
         self.tilt = round(random.uniform(0.0, 2.0), 2)  # quasi dritto all'inizio
 
         # ID unico
@@ -63,7 +71,7 @@ class PolePublisher:
     def publish_unregister(self):
         msg = {"id": self.client_id, "message": "unregister"}
         # publish on the same topic the gateway already listens to
-        self.client.publish(self.this_topic, json.dumps(msg), qos=1)
+        self.client.publish(self.this_topic, encode_payload(msg), qos=1)
 
     
     def run(self):
@@ -84,7 +92,7 @@ class PolePublisher:
             "sensors": self.sensors,
             "message": "config"
         }
-        self.client.publish(self.this_topic, json.dumps(config_msg), qos=1)
+        self.client.publish(self.this_topic, encode_payload(config_msg), qos=1)
         print(f"[*] Configurazione inviata per {self.client_id}")
 
         # Aspetta un secondo per dare tempo al Gateway di registrarsi
@@ -96,8 +104,8 @@ class PolePublisher:
             measurements = self.generate_measurements()
             if self.stopped:
                 break
-            self.client.publish(self.this_topic, json.dumps(measurements), qos=0)
-            print(f"Published measurements from {self.client_id} to {self.this_topic} in port {PolePublisher.port}")
+            self.client.publish(self.this_topic, encode_payload(measurements, PolePublisher.codec), qos=0)
+            log_published('Published measurements from %s to %s', self.client_id, self.this_topic)
             time.sleep(self.interval)
 
     def My_on_connect(self, client, userdata, flags, reason_code, properties):
@@ -108,7 +116,7 @@ class PolePublisher:
 
     def on_cmd_message(self, client, userdata, msg):
         try:
-            data = json.loads(msg.payload.decode("utf-8"))
+            data = decode_payload(msg.payload)
         except Exception:
             return
 
@@ -140,14 +148,15 @@ class PolePublisher:
 
 
 
-    def get_region(self, lat, long, regions):
-        for region_name, bounds in regions.items():
-            if (
-                bounds["minLat"] <= lat <= bounds["maxLat"] and
-                bounds["minLon"] <= long <= bounds["maxLon"]
-            ):
-                return region_name
-        return None
+    def get_region(self, lat, long):
+        # stessa risposta del gateway: il catalog risolve le sovrapposizioni (vince la regione piu' piccola)
+        try:
+            r = PolePublisher.catalog.get('regions/lookup', params={'lat': lat, 'lon': long}, retry=True)
+            r.raise_for_status()
+            return r.json().get('region')
+        except Exception as e:
+            print('Impossible GET region, error: ', e)
+            return None
 
 if __name__ == "__main__":
     # Creazione istanze
@@ -0,0 +1,105 @@
+# Logging condiviso dai servizi.
+#
+# - livelli standard di logging; il livello si sceglie con LOG_LEVEL (default INFO)
+# - gli handler sono asincroni: il logger mette il record in una coda e un
+#   thread (QueueListener) lo scrive su stdout, l'I/O non rallenta i callback MQTT
+# - sui percorsi caldi (un log per messaggio) si usa hot(): campionamento
+#   1 ogni N e tetto di righe al secondo per categoria; le righe saltate
+#   vengono contate e riportate nella successiva
+# - disabilitato, un log costa un confronto di livello (niente formattazione)
+#
+#   log = get_logger('gateway')
+#   log_forward = hot(log, 'forward', every=100, per_second=5)
+#   log_forward('Inoltrato %s su %s', pole_id, topic)
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+from logging import DEBUG, INFO, WARNING, ERROR
+
+FORMAT = '%(asctime)s %(levelname)-7s %(name)s: %(message)s'
+
+_listener = None
+_setup_lock = threading.Lock()
+
+
+def setup_logging(level=None, stream=None):
+    # idempotente: la prima chiamata configura il logger 'smartcity' per tutto il processo
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            return
+        level = level or os.environ.get('LOG_LEVEL', 'INFO')
+        handler = logging.StreamHandler(stream or sys.stdout)
+        handler.setFormatter(logging.Formatter(FORMAT))
+        records = queue.SimpleQueue()
+        root = logging.getLogger('smartcity')
+        root.setLevel(level.upper() if isinstance(level, str) else level)
+        root.addHandler(logging.handlers.QueueHandler(records))
+        root.propagate = False
+        _listener = logging.handlers.QueueListener(records, handler, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)   # svuota la coda all'uscita
+
+
+def get_logger(name):
+    setup_logging()
+    return logging.getLogger(f'smartcity.{name}')
+
+
+class HotLog:
+    """
+    Log di una categoria sul percorso caldo: scrive un messaggio ogni `every`
+    e al massimo `per_second` righe al secondo (None = nessun tetto).
+    """
+    def __init__(self, logger, category, level=logging.INFO, every=1, per_second=None):
+        self.logger = logger
+        self.category = category
+        self.level = level
+        self.every = max(1, int(every))
+        self.per_second = per_second
+        self._count = 0
+        self._suppressed = 0
+        self._window = 0
+        self._window_lines = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, msg, *args):
+        if not self.logger.isEnabledFor(self.level):
+            return
+        with self._lock:
+            self._count += 1
+            if self._count % self.every:
+                self._suppressed += 1
+                return
+            if self.per_second is not None:
+                window = int(time.monotonic())
+                if window != self._window:
+                    self._window, self._window_lines = window, 0
+                if self._window_lines >= self.per_second:
+                    self._suppressed += 1
+                    return
+                self._window_lines += 1
+            suppressed, self._suppressed = self._suppressed, 0
+        if suppressed:
+            msg = f'{msg} [{self.category}: +{suppressed} non mostrati]'
+        self.logger.log(self.level, msg, *args)
+
+
+def hot(logger, category, level=logging.INFO, every=None, per_second=None):
+    # LOG_SAMPLE=forward=100,decay=10 cambia il campionamento di una categoria senza toccare il codice
+    every = _sampling().get(category, every or 1)
+    return HotLog(logger, category, level=level, every=every, per_second=per_second)
+
+
+def _sampling():
+    out = {}
+    for item in os.environ.get('LOG_SAMPLE', '').split(','):
+        name, _, value = item.partition('=')
+        if value.strip().isdigit():
+            out[name.strip()] = int(value)
+    return out
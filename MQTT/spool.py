@@ -0,0 +1,219 @@
+# Spool su disco del gateway (store-and-forward): con il broker centrale
+# irraggiungibile i messaggi da inoltrare finiscono qui e vengono
+# ripubblicati alla riconnessione.
+#
+# - segmenti append-only <numero>.seg di al piu' segment_bytes byte
+# - record: crc32, lunghezza payload uint32, timestamp double, lunghezza
+#   topic uint16, topic, payload; la coda troncata da un crash si scarta
+# - file "cursor": primo record non ancora ripubblicato (segmento, offset),
+#   riscritto con rename atomico; alla ripartenza si riprende da li'
+#   (at-least-once: dopo un crash qualche record puo' essere ripubblicato)
+# - limiti: max_bytes (si eliminano i segmenti piu' vecchi, anche non letti)
+#   e max_age secondi (retention); i record persi cosi' vengono contati
+#
+#   spool.append(topic, payload)
+#   records, mark = spool.peek(100)   # [(topic, payload, timestamp, mark del record)]
+#   ... publish ...
+#   spool.commit(mark)                # oppure records[k][3]: confermati solo i primi k+1
+import os
+import struct
+import threading
+import time
+import zlib
+
+_record = struct.Struct('<IIdH')
+_crc = struct.Struct('<I')
+
+
+def _read(f):
+    # (timestamp, topic, payload, byte letti) oppure None a fine file / record incompleto
+    head = f.read(_record.size)
+    if len(head) < _record.size:
+        return None
+    crc, n, ts, t = _record.unpack(head)
+    body = f.read(t + n)
+    if len(body) < t + n or zlib.crc32(head[4:] + body) != crc:
+        return None
+    return ts, body[:t].decode('utf-8'), body[t:], _record.size + t + n
+
+
+class Spool:
+    def __init__(self, directory, segment_bytes=4 * 1024 * 1024, max_bytes=256 * 1024 * 1024, max_age=86400, fsync=False):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.fsync = fsync
+        self.evicted = {'size': 0, 'age': 0}   # record eliminati senza essere ripubblicati
+        self._lock = threading.Lock()
+        self._writer = None
+        os.makedirs(directory, exist_ok=True)
+        # numero -> [byte, record, timestamp dell'ultimo record]
+        self._segments = {int(name[:-4]): self._scan(int(name[:-4]))
+                          for name in os.listdir(directory) if name.endswith('.seg')}
+        self._write_segment = max(self._segments, default=0)
+        self._cursor = self._load_cursor()
+        number, offset = self._cursor
+        self._pending = sum(seg[1] for n, seg in self._segments.items() if n > number)
+        if number in self._segments:
+            self._pending += self._count(number, offset)
+
+    def _path(self, number):
+        return os.path.join(self.directory, f'{number:010d}.seg')
+
+    def _scan(self, number):
+        # all'avvio: record validi del segmento; un record scritto a meta' viene tagliato
+        size = count = 0
+        last = 0.0
+        with open(self._path(number), 'r+b') as f:
+            while True:
+                rec = _read(f)
+                if rec is None:
+                    break
+                size, count, last = size + rec[3], count + 1, rec[0]
+            f.truncate(size)
+        return [size, count, last]
+
+    def _count(self, number, offset):
+        with open(self._path(number), 'rb') as f:
+            f.seek(offset)
+            count = 0
+            while _read(f) is not None:
+                count += 1
+        return count
+
+    def _load_cursor(self):
+        try:
+            with open(os.path.join(self.directory, 'cursor'), 'r') as f:
+                number, offset = (int(v) for v in f.read().split())
+        except (OSError, ValueError):
+            return min(self._segments, default=1), 0
+        if number not in self._segments:
+            return min((n for n in self._segments if n > number), default=number), 0
+        return number, offset
+
+    def _save_cursor(self):
+        path = os.path.join(self.directory, 'cursor')
+        with open(path + '.tmp', 'w') as f:
+            f.write(f'{self._cursor[0]} {self._cursor[1]}')
+        os.replace(path + '.tmp', path)
+
+    # --- scrittura ---
+
+    def append(self, topic, payload, ts=None):
+        topic = topic.encode('utf-8')
+        ts = time.time() if ts is None else ts
+        body = _record.pack(0, len(payload), ts, len(topic))[4:] + topic + bytes(payload)
+        record = _crc.pack(zlib.crc32(body)) + body
+        with self._lock:
+            seg = self._segments.get(self._write_segment)
+            if self._writer is None or seg[0] + len(record) > self.segment_bytes:
+                seg = self._roll()
+            self._writer.write(record)
+            self._writer.flush()
+            if self.fsync:
+                os.fsync(self._writer.fileno())
+            seg[0] += len(record)
+            seg[1] += 1
+            seg[2] = ts
+            self._pending += 1
+            self._evict(time.time())
+
+    def _roll(self):
+        # un segmento nuovo per ogni avvio e quando il corrente e' pieno
+        if self._writer is not None:
+            self._writer.close()
+        self._write_segment += 1
+        seg = self._segments[self._write_segment] = [0, 0, 0.0]
+        self._writer = open(self._path(self._write_segment), 'ab')
+        return seg
+
+    def _evict(self, now):
+        # dal segmento piu' vecchio: scaduti per eta', poi oltre max_bytes (mai quello in scrittura)
+        for number in sorted(self._segments):
+            seg = self._segments[number]
+            expired = self.max_age and seg[1] and now - seg[2] > self.max_age
+            if expired:
+                self._drop(number, 'age')
+            elif number != self._write_segment and self.size() > self.max_bytes:
+                self._drop(number, 'size')
+            else:
+                break
+
+    def _drop(self, number, reason):
+        cursor, offset = self._cursor
+        # si perde solo cio' che non e' ancora stato ripubblicato
+        lost = 0 if number < cursor else self._count(number, offset if number == cursor else 0)
+        if number == self._write_segment and self._writer is not None:
+            self._writer.close()
+            self._writer = None
+        del self._segments[number]
+        os.remove(self._path(number))
+        self.evicted[reason] += lost
+        self._pending -= lost
+        if number >= cursor:
+            self._cursor = (min((n for n in self._segments if n > number), default=number + 1), 0)
+            self._save_cursor()
+
+    def expire(self):
+        # retention anche senza nuovi append (es. link appena tornato, spool vecchio)
+        with self._lock:
+            self._evict(time.time())
+
+    # --- lettura ---
+
+    def peek(self, limit):
+        # fino a limit record dal cursore; mark va passato a commit() dopo averli ripubblicati,
+        # il mark di ogni record conferma solo fino a quel record
+        with self._lock:
+            out = []
+            number, offset = self._cursor
+            while len(out) < limit:
+                if number not in self._segments:
+                    later = [n for n in self._segments if n > number]
+                    if not later:
+                        break
+                    number, offset = min(later), 0
+                with open(self._path(number), 'rb') as f:
+                    f.seek(offset)
+                    while len(out) < limit:
+                        rec = _read(f)
+                        if rec is None:
+                            break
+                        offset += rec[3]
+                        out.append((rec[1], rec[2], rec[0], (number, offset, len(out) + 1)))
+                if len(out) < limit:
+                    if number == self._write_segment:
+                        break
+                    number, offset = number + 1, 0
+            return out, (number, offset, len(out))
+
+    def commit(self, mark):
+        number, offset, count = mark
+        with self._lock:
+            # segmenti interamente ripubblicati: non servono piu'
+            for n in [n for n in self._segments if n < number]:
+                del self._segments[n]
+                os.remove(self._path(n))
+            if number not in self._segments and number <= self._write_segment:
+                number, offset = min((n for n in self._segments if n > number), default=self._write_segment), 0
+            self._cursor = (number, offset)
+            self._pending = max(0, self._pending - count)
+            self._save_cursor()
+
+    def oldest(self):
+        # timestamp del primo record in attesa (None se lo spool e' vuoto)
+        records, _ = self.peek(1)
+        return records[0][2] if records else None
+
+    def pending(self):
+        return self._pending
+
+    def size(self):
+        return sum(seg[0] for seg in self._segments.values())
+
+    def close(self):
+        with self._lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None